@@ -0,0 +1,244 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+import json
+import os
+import random
+import time
+from os import environ
+
+# Tuning profiles are kept in a JSON file, by adapter class and USB
+# serial number. XVCD_PROFILES names another file, or disables the
+# profiles when it is set to an empty string.
+PROFILES_ENV = 'XVCD_PROFILES'
+DEFAULT_PROFILES = os.path.join(os.path.expanduser('~'), '.config', 'xvcd_server', 'profiles.json')
+
+# The loopback patterns assume at most this many devices in the chain
+# and at most this many IR bits in all of them
+MAX_DEVICES = 32
+MAX_IR_BITS = 1024
+
+# Bits shifted through the BYPASS registers by each pattern
+BYPASS_BITS = 16384
+
+# Every setting must pass this many rounds of patterns
+ROUNDS = 8
+
+# Lowest frequency tried when the chain fails at the adapter MAX_FREQ
+MIN_FREQ = 100e3
+
+
+class TuneError(Exception):
+    """ The chain does not answer the loopback patterns. """
+
+
+def profiles_path():
+    """ Return the path of the profile file, None if disabled. """
+    return environ.get(PROFILES_ENV, DEFAULT_PROFILES) or None
+
+
+def profile_key(adapter):
+    """ Return the key of the adapter in the profile file, None if its
+        board has no serial number to tell it from others. """
+    serial = adapter.serial
+    if serial is None:
+        return None
+    return '{}:{}'.format(type(adapter).__name__, serial)
+
+
+def load_profiles():
+    """ Return all the profiles of the profile file, by key. """
+    path = profiles_path()
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_profile(adapter):
+    """ Return the profile saved for the board of adapter, or None. A
+        broken profile file is reported and otherwise ignored. """
+    key = profile_key(adapter)
+    if key is None:
+        return None
+    try:
+        return load_profiles().get(key)
+    except (OSError, ValueError) as e:
+        print('Ignoring tuning profiles in {}: {}'.format(profiles_path(), e))
+        return None
+
+
+def save_profile(adapter, profile):
+    """ Save profile as the one of the board of adapter. Returns the key
+        it was saved under, None if the board cannot be told apart. """
+    key = profile_key(adapter)
+    path = profiles_path()
+    if key is None or path is None:
+        return None
+    profiles = load_profiles()
+    profiles[key] = profile
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write a copy and rename it, so a server starting meanwhile never
+    # reads half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    return key
+
+
+class _Pattern:
+    """ TMS and TDI vectors of a shift built run by run, as integers
+        with the first bit in the lsb. """
+
+    def __init__(self):
+        self.tms = 0
+        self.tdi = 0
+        self.num_bits = 0
+
+    def add(self, tms, tdi, count):
+        """ Add count bits of TMS tms, TDI from the integer tdi. """
+        if tms:
+            self.tms |= ((1 << count) - 1) << self.num_bits
+        self.tdi |= tdi << self.num_bits
+        self.num_bits += count
+
+    def moves(self, tms):
+        """ Add TMS moves given as a string of '0's and '1's. """
+        for bit in tms:
+            self.add(bit == '1', 0, 1)
+
+    def scan(self, tdi, count):
+        """ Add a scan of count bits in Shift-DR/IR, leaving on the last. """
+        self.add(False, tdi, count-1)
+        self.add(True, tdi >> (count-1), 1)
+
+    def send(self, adapter):
+        """ Shift the pattern and return its TDO as an integer. """
+        nbytes = (self.num_bits+7)//8
+        tdo = adapter.send_bytes(self.num_bits, self.tms.to_bytes(nbytes, 'little'),
+                                 self.tdi.to_bytes(nbytes, 'little'))
+        return int.from_bytes(tdo, 'little')
+
+
+def idcode_pattern(adapter):
+    """ Reset the TAPs, which loads IDCODE or BYPASS, and return the TDO
+        of MAX_DEVICES IDCODEs worth of '1's shifted through the chain. """
+    pattern = _Pattern()
+    pattern.moves('111110100')
+    pattern.scan((1 << 32*MAX_DEVICES) - 1, 32*MAX_DEVICES)
+    pattern.moves('10')
+    return pattern.send(adapter)
+
+
+def bypass_pattern(adapter, rng):
+    """ Load BYPASS in every device, shift BYPASS_BITS random bits through
+        the chain and return the number of devices, as the delay of the
+        bits coming out, or None if they do not come out at all. """
+    pattern = _Pattern()
+    pattern.moves('1111101100')
+    pattern.scan((1 << MAX_IR_BITS) - 1, MAX_IR_BITS)
+    pattern.moves('10100')
+    head = pattern.num_bits
+    data = rng.getrandbits(BYPASS_BITS)
+    pattern.scan(data, BYPASS_BITS)
+    pattern.moves('10')
+    tdo = pattern.send(adapter) >> head
+
+    mask = (1 << BYPASS_BITS) - 1
+    for delay in range(1, MAX_DEVICES+1):
+        if (tdo >> delay) & (mask >> delay) == data & (mask >> delay):
+            return delay
+    return None
+
+
+class Autotuner:
+    """
+        Find the fastest settings of adapter that the chain still answers
+        the loopback patterns to without a single error. The adapter
+        tells the settings it can take with tune_candidates() and takes
+        them with set_tuning().
+
+        The TCK frequency is raised from the adapter MAX_FREQ until the
+        patterns fail, then the chunk size and the latency timer are
+        picked by the time the patterns take at that frequency.
+    """
+
+    def __init__(self, adapter, rounds=ROUNDS, seed=None, log=print):
+        self.adapter = adapter
+        self.rounds = rounds
+        self.rng = random.Random(seed)
+        self.log = log
+        self.idcodes = None
+        self.devices = None
+
+    def passes(self):
+        """ Return the time rounds of patterns took with the current
+            settings, or None if any of them failed. """
+        start = time.perf_counter()
+        for k in range(self.rounds):
+            if (idcode_pattern(self.adapter) != self.idcodes or
+                bypass_pattern(self.adapter, self.rng) != self.devices):
+                return None
+        return time.perf_counter() - start
+
+    def reference(self):
+        """ Find a frequency, from MAX_FREQ down, at which the chain
+            answers the same way twice and keep its answers. """
+        frequency = self.adapter.MAX_FREQ
+        while frequency >= MIN_FREQ:
+            self.adapter.set_tuning({'frequency': frequency})
+            self.idcodes = idcode_pattern(self.adapter)
+            self.devices = bypass_pattern(self.adapter, self.rng)
+            if self.devices is not None and self.passes() is not None:
+                self.log('Chain of {} devices answers at {:.0f} Hz'.format(self.devices, frequency))
+                return frequency
+            frequency /= 2
+        raise TuneError('The chain does not answer the loopback patterns, even at {:.0f} Hz'.format(MIN_FREQ))
+
+    def tune(self):
+        """ Return the profile of the fastest reliable settings, which
+            are left set. """
+        candidates = self.adapter.tune_candidates()
+        tuning = self.adapter.get_tuning()
+        tuning['frequency'] = self.reference()
+
+        for frequency in sorted(candidates['frequency']):
+            if frequency <= tuning['frequency']:
+                continue
+            self.adapter.set_tuning({'frequency': frequency})
+            if self.passes() is None:
+                self.log('Patterns fail at {:.0f} Hz'.format(frequency))
+                break
+            self.log('Patterns pass at {:.0f} Hz'.format(frequency))
+            tuning['frequency'] = frequency
+        self.adapter.set_tuning(tuning)
+
+        for name in ('chunk_size', 'latency'):
+            best = None
+            for value in candidates.get(name, ()):
+                self.adapter.set_tuning({name: value})
+                elapsed = self.passes()
+                if elapsed is None:
+                    self.log('Patterns fail with {} {}'.format(name, value))
+                    continue
+                self.log('{} {}: {:.3f} s'.format(name, value, elapsed))
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, value)
+            if best is not None:
+                tuning[name] = best[1]
+            self.adapter.set_tuning(tuning)
+
+        return tuning
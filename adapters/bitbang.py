@@ -0,0 +1,210 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+import time
+
+from adapters.planner import PlannedJtag, vector_bits, TMS, SCAN, WRITE, IDLE
+
+
+class SyncBitbang:
+    """
+        An FTDI port in synchronous bitbang mode, clocking whole shifts
+        as waveforms of pin states instead of a USB access per pin change.
+
+        Every TCK takes two samples: TCK low with TMS and TDI set, then
+        TCK high. The FTDI writes the samples to the pins at the bitbang
+        rate and reads the pins back just before writing each of them, so
+        the sample read for the TCK high one holds TDO as it was on the
+        rising edge.
+
+        Subclasses move the samples through their FTDI library with
+        write_samples() and read_samples() and set the bitbang rate with
+        set_sample_rate().
+    """
+
+    def __init__(self, tck, tdi, tdo, tms, chunk, others=0, timeout=10.0):
+        """
+            tck, tdi, tdo, tms -- The pin numbers of the JTAG lines.
+            chunk -- Samples written before reading theirs back, at most
+                     what the Read FIFO holds.
+            others -- The level of the other outputs.
+            timeout -- Seconds without any sample coming back before
+                       giving up.
+        """
+        self.chunk = max((chunk // 2) * 2, 2)
+        self.timeout = timeout
+        self.frequency = 0
+        self.waves = 0
+
+        # The 8 samples of 4 TCKs, at index TMS << 4 | TDI with 4 bits
+        # of each, the first one in the lsb
+        low = [others | (tms_bit << tms) | (tdi_bit << tdi)
+               for tms_bit in (0, 1) for tdi_bit in (0, 1)]
+        samples = [bytes((pins, pins | (1 << tck))) for pins in low]
+        self._waves = tuple(
+            b''.join(samples[((index >> (4+k)) & 1) << 1 | ((index >> k) & 1)] for k in range(4))
+            for index in range(256))
+        # Sample read back to the ASCII TDO bit
+        self._tdo_char = bytes(ord('1') if (pins >> tdo) & 1 else ord('0') for pins in range(256))
+
+    def set_frequency(self, frequency):
+        """
+            Set the TCK frequency, at two samples per TCK, and return the
+            actual one.
+        """
+        self.frequency = self.set_sample_rate(int(2*frequency)) / 2
+        return self.frequency
+
+    def waveform(self, num_bits, tms, tdi):
+        """
+            Return the samples that clock num_bits of the TMS and TDI
+            vectors, in the XVC layout.
+        """
+        waves = self._waves
+        parts = []
+        for (t, d) in zip(tms[:(num_bits+7)//8], tdi):
+            parts.append(waves[(t & 0x0f) << 4 | (d & 0x0f)])
+            parts.append(waves[(t & 0xf0) | (d >> 4)])
+        return b''.join(parts)[:2*num_bits]
+
+    def shift(self, num_bits, tms, tdi):
+        """
+            Clock num_bits of the TMS and TDI vectors and return TDO as
+            an integer with the first bit in the lsb.
+        """
+        wave = self.waveform(num_bits, tms, tdi)
+        samples = bytearray()
+        for start in range(0, len(wave), self.chunk):
+            chunk = wave[start:start+self.chunk]
+            self.write_samples(chunk)
+            samples.extend(self._read(len(chunk)))
+            self.waves += 1
+        if not num_bits:
+            return 0
+        # TDO of each TCK is in the sample read for its TCK high one
+        return int(bytes(samples[1::2]).translate(self._tdo_char)[::-1], 2)
+
+    def _read(self, count):
+        """
+            Read count samples back, giving up after timeout without any
+            of them.
+        """
+        data = bytearray()
+        deadline = time.monotonic() + self.timeout
+        while len(data) < count:
+            chunk = self.read_samples(count-len(data))
+            if chunk:
+                data.extend(chunk)
+                deadline = time.monotonic() + self.timeout
+            elif time.monotonic() > deadline:
+                raise IOError('Not all samples read! Expected {} bytes but only read {} bytes'.format(count, len(data)))
+        return data
+
+    def set_sample_rate(self, rate):
+        """
+            Set the bitbang rate in samples per second and return the
+            actual one.
+        """
+        raise NotImplementedError
+
+    def write_samples(self, samples):
+        """
+            Write samples, a bytes object, to the port.
+        """
+        raise NotImplementedError
+
+    def read_samples(self, count):
+        """
+            Return up to count of the samples read back, maybe none.
+        """
+        raise NotImplementedError
+
+
+class BitbangJtag(PlannedJtag):
+    """
+        Base of the adapters that drive the JTAG pins of an FTDI port in
+        bitbang mode. Subclasses give tick(), which clocks a single bit
+        through the port, and may set a SyncBitbang with set_bitbang()
+        to clock whole shifts as waveforms instead.
+    """
+
+    # Write-only and idle bits are clocked without reading the port
+    plan_ops = (TMS, SCAN, WRITE, IDLE)
+
+    def __init__(self):
+        super().__init__()
+
+        # SyncBitbang the shifts are clocked with, if any. Otherwise the
+        # pins are set a TCK at a time with tick().
+        self.bitbang = None
+
+    def set_bitbang(self, bitbang):
+        """
+            Clock the shifts with a SyncBitbang, or a TCK at a time with
+            tick() if None.
+        """
+        self.bitbang = bitbang
+        # Plans were costed for the other way of clocking
+        self.plan_cache.clear()
+
+    def set_tck_period(self, period):
+        """
+            Handle the settck virtual cable command which requests a certain TCK period. Return the actual period.
+        """
+
+        if self.bitbang is not None:
+            return int(1e9/self.bitbang.set_frequency(1e9/period))
+
+        ## Actual Period depends on many factors since this tries to simply go as fast as it can. So nothing to set. Respond that it goes at 100 Hz or 10e6 ns
+        return int(10e6)
+
+    def op_cost(self, kind, num_bits):
+        """
+            Port accesses for an op of num_bits. Bits whose TDO is not
+            needed are clocked without reading the port. A SyncBitbang
+            clocks every bit the same way, so its plans are all TMS and
+            SCAN ops.
+        """
+        if self.bitbang is not None:
+            return num_bits
+        if kind == WRITE or kind == IDLE:
+            return 2*num_bits
+        return 3*num_bits
+
+    def send_plan(self, ops, num_bits, tms, tdi, cached=None):
+        """
+            Clock the ops a bit at a time and return the TDO vector.
+            A SyncBitbang clocks the whole shift at once instead.
+        """
+        if self.bitbang is not None:
+            tdo = self.bitbang.shift(num_bits, tms, tdi)
+            return tdo.to_bytes((num_bits+7)//8, byteorder='little')
+
+        tdo = 0
+        for (kind, head, tail, state) in ops:
+            tms_bits = vector_bits(tms, head, tail)
+            tdi_bits = vector_bits(tdi, head, tail)
+            read = kind == TMS or kind == SCAN
+            for k in range(tail-head):
+                if self.tick((tms_bits >> k) & 1, (tdi_bits >> k) & 1, read=read):
+                    tdo |= 1 << (head+k)
+
+        return tdo.to_bytes((num_bits+7)//8, byteorder='little')
+
+    def tick(self, tms, tdi, clock_delays=0, read=True):
+        """
+            Clock a bit with tms and tdi and return TDO, False if not read.
+        """
+        raise NotImplementedError
@@ -0,0 +1,157 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+class BitVector:
+    """
+        A bit vector stored like the vectors of the XVC shift: command:
+        bit k is bit k%8 of byte k//8, so bit 0 is the first bit and
+        converting to and from the XVC layout is a plain byte copy.
+
+        The bytes live in a bytearray that grows by doubling, so append()
+        and extend() add bits in place. Bits past the length are kept at
+        '0' in the bytearray.
+
+        This only has what the adapters need: indexing, slicing,
+        iterating, find() for the end of a run of bits, appending and
+        conversion to and from bytes and integers.
+    """
+
+    __slots__ = ('_data', '_len')
+
+    # Bits looked at per step by find()
+    FIND_CHUNK_BITS = 512
+
+    def __init__(self, length=0, capacity=0):
+        """
+            Create a vector of length '0' bits with room for capacity bits
+            before it has to grow.
+        """
+        self._data = bytearray((max(length, capacity)+7)//8)
+        self._len = length
+
+    @classmethod
+    def from_bytes(cls, data, length):
+        """ The first length bits of data, a byte vector in the XVC layout. """
+        vect = cls()
+        vect._data = bytearray(data[:(length+7)//8])
+        vect._len = length
+        if length & 7:
+            vect._data[-1] &= (1 << (length & 7))-1
+        return vect
+
+    @classmethod
+    def from_int(cls, value, length):
+        """ The first length bits of value, with bit 0 as the lsb. """
+        vect = cls()
+        vect._data = bytearray((value & ((1 << length)-1)).to_bytes((length+7)//8, byteorder='little'))
+        vect._len = length
+        return vect
+
+    def to_bytes(self):
+        """ Return the vector in the XVC layout, padded with '0's. """
+        return bytes(self._data[:(self._len+7)//8])
+
+    def to_int(self):
+        """ Return the vector as an integer with bit 0 as the lsb. """
+        return int.from_bytes(self._data[:(self._len+7)//8], byteorder='little')
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self._len)
+            if step != 1:
+                raise ValueError('BitVector slices must have a step of 1')
+            return BitVector.from_int(self._bits(start, stop), max(stop-start, 0))
+
+        if key < 0:
+            key += self._len
+        if not (0 <= key < self._len):
+            raise IndexError('BitVector index out of range')
+        return bool((self._data[key >> 3] >> (key & 7)) & 1)
+
+    def __iter__(self):
+        data = self._data
+        for k in range(self._len):
+            yield bool((data[k >> 3] >> (k & 7)) & 1)
+
+    def __eq__(self, other):
+        if not isinstance(other, BitVector):
+            return NotImplemented
+        return self._len == other._len and self.to_bytes() == other.to_bytes()
+
+    def __repr__(self):
+        return 'BitVector.from_bytes({!r}, {})'.format(self.to_bytes(), self._len)
+
+    def _bits(self, start, stop):
+        """ Bits start to stop-1 as an integer, bit start as the lsb. """
+        if stop <= start:
+            return 0
+        value = int.from_bytes(self._data[start >> 3:(stop+7) >> 3], byteorder='little')
+        return (value >> (start & 7)) & ((1 << (stop-start))-1)
+
+    def find(self, bit, start=0, end=None):
+        """
+            Return the index of the first bit equal to bit from start up
+            to end, or -1. Only the bits up to the one found are looked
+            at, so walking a vector run by run costs its length once.
+        """
+        end = self._len if end is None else min(end, self._len)
+        pos = max(start, 0)
+        while pos < end:
+            stop = min(end, (pos - pos % self.FIND_CHUNK_BITS) + self.FIND_CHUNK_BITS)
+            value = self._bits(pos, stop)
+            if not bit:
+                value ^= (1 << (stop-pos))-1
+            if value:
+                return pos + (value & -value).bit_length() - 1
+            pos = stop
+        return -1
+
+    def _reserve(self, length):
+        """ Grow the bytearray to hold at least length bits. """
+        size = (length+7)//8
+        if size > len(self._data):
+            self._data.extend(bytes(max(size, 2*len(self._data)) - len(self._data)))
+
+    def append(self, bit):
+        """ Add one bit at the end. """
+        pos = self._len
+        self._reserve(pos+1)
+        if bit:
+            self._data[pos >> 3] |= 1 << (pos & 7)
+        self._len = pos+1
+
+    def extend_int(self, value, length):
+        """ Add length bits at the end, taken from value lsb first. """
+        if length <= 0:
+            return
+        pos = self._len
+        self._reserve(pos+length)
+        first = pos >> 3
+        count = ((pos & 7) + length + 7)//8
+        value = ((value & ((1 << length)-1)) << (pos & 7)) | self._data[first]
+        self._data[first:first+count] = value.to_bytes(count, byteorder='little')
+        self._len = pos+length
+
+    def extend(self, other):
+        """ Add the bits of another BitVector at the end. """
+        self.extend_int(other.to_int(), len(other))
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
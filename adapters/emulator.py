@@ -0,0 +1,584 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+#
+# An FTDI device emulated in the process, for running and benchmarking
+# the adapters without a board. EmulatedFtdi takes the place of the
+# PyFTDI Ftdi (and GpioController) of an adapter, interprets the MPSSE
+# commands or bitbang samples written to it, clocks a simulated chain of
+# TAPs with them and returns TDO. It counts the USB transactions and
+# bytes and estimates the time they would take, see UsbModel.
+#
+# As an adapter, 'xvcd_server.py emulator' serves XVC on the emulated
+# chain, and 'python3 -m adapters.emulator' runs the benchmarks.
+#
+#------------------------------------------------------------------------------
+
+import argparse
+import random
+import sys
+import time
+from array import array
+from threading import Condition
+
+from adapters.autotune import _Pattern, idcode_pattern, bypass_pattern
+from adapters.jtag import jtag
+from adapters.pyftdi import PyFTDIAdapter
+from adapters.pyftdi_jtagc import JtagController
+
+
+class EmulatedTap:
+    """
+        A device of an EmulatedChain, with an IR of ir_len bits, an IDCODE
+        register and BYPASS for every other instruction.
+    """
+
+    def __init__(self, ir_len=6, idcode=0x0362D093, idcode_ir=0b001001):
+        self.ir_len = ir_len
+        self.idcode = idcode
+        self.idcode_ir = idcode_ir
+        self.ir = idcode_ir
+        # Register between TDI and TDO and its length
+        self.reg = 0
+        self.reg_len = 1
+
+    def reset(self):
+        self.ir = self.idcode_ir
+
+    def capture_ir(self):
+        # IEEE 1149.1 wants '01' in the two bits next to TDO
+        (self.reg, self.reg_len) = (0b01, self.ir_len)
+
+    def capture_dr(self):
+        if self.ir == self.idcode_ir:
+            (self.reg, self.reg_len) = (self.idcode, 32)
+        else:
+            (self.reg, self.reg_len) = (0, 1)
+
+    def shift(self, tdi):
+        """ Shift tdi in and return the bit shifted out. """
+        tdo = self.reg & 1
+        self.reg = (self.reg >> 1) | (tdi << (self.reg_len-1))
+        return tdo
+
+    def update_ir(self):
+        self.ir = self.reg & ((1 << self.ir_len)-1)
+
+
+class EmulatedChain:
+    """
+        A JTAG chain of EmulatedTaps, the first one on TDI and the last
+        one on TDO. All of them follow the same TAP state.
+    """
+
+    def __init__(self, taps=None):
+        self.taps = taps or [EmulatedTap()]
+        self.state = jtag.TEST_LOGIC_RESET
+        self.clocks = 0
+
+    def clock(self, tms, tdi):
+        """ Clock TCK with TMS and TDI and return TDO as it was on the
+            rising edge. """
+        self.clocks += 1
+        state = self.state
+        tdo = 0
+        if state == jtag.SHIFT_DR or state == jtag.SHIFT_IR:
+            bit = tdi
+            for tap in self.taps:
+                bit = tap.shift(bit)
+            tdo = bit
+        elif state == jtag.CAPTURE_DR:
+            for tap in self.taps:
+                tap.capture_dr()
+        elif state == jtag.CAPTURE_IR:
+            for tap in self.taps:
+                tap.capture_ir()
+
+        state = jtag.jtag_states[state][2 if tms else 1]
+        if state == jtag.UPDATE_IR:
+            for tap in self.taps:
+                tap.update_ir()
+        elif state == jtag.TEST_LOGIC_RESET:
+            for tap in self.taps:
+                tap.reset()
+        self.state = state
+        return tdo
+
+    @property
+    def tdo(self):
+        """ Level of TDO between clocks, '0' when not shifting. """
+        if self.state == jtag.SHIFT_DR or self.state == jtag.SHIFT_IR:
+            return self.taps[-1].reg & 1
+        return 0
+
+
+class UsbModel:
+    """
+        Cost of the USB transfers of an EmulatedFtdi. Each transaction
+        costs transaction_time, each packet of up to packet_size bytes
+        packet_time, and a read of less than a packet of data that was
+        not flushed with SEND_IMMEDIATE also waits for the latency timer.
+        The defaults are those of a high speed FT2232H.
+    """
+
+    def __init__(self, packet_size=512, transaction_time=125e-6, packet_time=10e-6):
+        self.packet_size = packet_size
+        self.transaction_time = transaction_time
+        self.packet_time = packet_time
+
+
+class EmulatedFtdi:
+    """
+        An FTDI port emulated in the process, with the part of the PyFTDI
+        Ftdi API that the adapters use, and read_port()/write_port() of
+        the GpioController. It runs the MPSSE or bitbang mode it is
+        opened in, with pins 0 to 3 as TCK, TDI, TDO and TMS.
+
+        Counters, see stats(): writes, reads, write_bytes, read_bytes and
+        packets of the USB transactions, usb_time, the time UsbModel
+        estimates all of them took, clocks of TCK and pin_time, the time
+        the pins took to clock them at the set frequency or sample rate.
+    """
+
+    TCK_BIT = 0x01
+    TDI_BIT = 0x02
+    TDO_BIT = 0x04
+    TMS_BIT = 0x08
+
+    # Length of the MPSSE commands that are not data commands
+    MPSSE_CMD_LENGTHS = {
+        0x80: 3, 0x81: 1, 0x82: 3, 0x83: 1, 0x84: 1, 0x85: 1, 0x86: 3,
+        0x87: 1, 0x8a: 1, 0x8b: 1, 0x8c: 1, 0x8d: 1, 0x8e: 2, 0x8f: 3,
+        0x96: 1, 0x97: 1, 0x9e: 3,
+    }
+
+    # Commands of the H series only
+    H_SERIES_CMDS = (0x8a, 0x8b, 0x8c, 0x8d, 0x8e, 0x8f, 0x96, 0x97, 0x9e)
+
+    def __init__(self, chain=None, fifo_sizes=(4096, 4096), is_H_series=True,
+                 usb=None, stall_timeout=2.0):
+        """
+            chain -- The EmulatedChain on the JTAG pins.
+            fifo_sizes -- The (TX, RX) FIFO sizes. The MPSSE stalls when
+                          the RX one is full, and raises an error after
+                          stall_timeout seconds without a read.
+            is_H_series -- Whether to take the H series only commands.
+            usb -- The UsbModel of the transfer costs.
+        """
+        self.chain = chain or EmulatedChain()
+        self.fifo_sizes = fifo_sizes
+        self.is_H_series = is_H_series
+        self.frequency_max = 30e6 if is_H_series else 6e6
+        self.usb = usb or UsbModel()
+        self.stall_timeout = stall_timeout
+        self.timeouts = (5000, 5000)
+        self.usb_dev = None
+
+        self.mode = None
+        self.frequency = 0
+        self.latency = 16
+        self._pins = 0
+        # Level of TDO, see _set_pins()
+        self._tdo = 0
+        self._pending = bytearray()
+        self._rx = bytearray()
+        # Bytes at the head of _rx flushed with SEND_IMMEDIATE
+        self._flushed = 0
+        self._cv = Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.writes = 0
+        self.reads = 0
+        self.write_bytes = 0
+        self.read_bytes = 0
+        self.packets = 0
+        self.usb_time = 0.0
+        self.pin_time = 0.0
+        self.chain.clocks = 0
+
+    def stats(self):
+        """ Return the counters as a dict. """
+        return {'writes': self.writes, 'reads': self.reads,
+                'write_bytes': self.write_bytes, 'read_bytes': self.read_bytes,
+                'packets': self.packets, 'clocks': self.chain.clocks,
+                'usb_time': self.usb_time, 'pin_time': self.pin_time}
+
+    # Opening and configuration
+
+    def open_mpsse_from_url(self, url, direction=0, initial=0, frequency=6.0E6, latency=16, debug=False):
+        self.mode = 'mpsse'
+        self.latency = latency
+        return self.set_frequency(frequency)
+
+    def open_bitbang_from_url(self, url, direction=0xff, latency=16, baudrate=1000000, sync=False):
+        self.mode = 'syncbb' if sync else 'bitbang'
+        self.latency = latency
+        return self.set_baudrate(baudrate)
+
+    def open_from_url(self, url, direction=0):
+        """ GpioController.open_from_url() of older PyFTDI """
+        self.open_bitbang_from_url(url, direction)
+
+    def set_bitmode(self, bitmask, mode):
+        # Ftdi.BitMode.SYNCBB or Ftdi.BITMODE_SYNCBB
+        self.mode = 'syncbb' if int(mode) == 0x04 else 'bitbang'
+
+    def set_frequency(self, frequency):
+        self.frequency = min(frequency, self.frequency_max)
+        return self.frequency
+
+    def set_baudrate(self, baudrate, constrain=True):
+        # One sample per baud, in the range of the FTDI baud rate
+        # generator, which PyFTDI enforces with ValueError
+        clock = 12000000 if self.is_H_series else 3000000
+        if baudrate > clock:
+            raise ValueError('Invalid baudrate (too high)')
+        if baudrate < (clock >> 14) + 1:
+            raise ValueError('Invalid baudrate (too low)')
+        self.frequency = baudrate
+        return baudrate
+
+    def set_latency_timer(self, latency):
+        self._control()
+        self.latency = latency
+
+    def write_data_set_chunksize(self, chunksize=0):
+        pass
+
+    def read_data_set_chunksize(self, chunksize=0):
+        pass
+
+    def purge_buffers(self):
+        self._control()
+        with self._cv:
+            self._rx = bytearray()
+            self._flushed = 0
+            self._pending = bytearray()
+
+    def close(self):
+        self.mode = None
+
+    # USB transfers
+
+    def _control(self):
+        """ Count a control transfer. """
+        self.usb_time += self.usb.transaction_time
+
+    def _transfer(self, length):
+        """ Count a bulk transaction of length bytes. """
+        packets = max((length + self.usb.packet_size - 1) // self.usb.packet_size, 1)
+        self.packets += packets
+        self.usb_time += self.usb.transaction_time + packets*self.usb.packet_time
+
+    def write_data(self, data):
+        data = bytes(data)
+        self.writes += 1
+        self.write_bytes += len(data)
+        self._transfer(len(data))
+        if self.mode == 'mpsse':
+            clocks = self.chain.clocks
+            self._pending += data
+            self._run_mpsse()
+            self.pin_time += (self.chain.clocks - clocks) / self.frequency
+        else:
+            for pins in data:
+                if self.mode == 'syncbb':
+                    self._out(self._sample())
+                self._set_pins(pins)
+            self.pin_time += len(data) / self.frequency
+        return len(data)
+
+    def read_data_bytes(self, size, attempt=1, request_gen=None):
+        with self._cv:
+            data = self._rx[:size]
+            del self._rx[:size]
+            unflushed = max(len(data) - self._flushed, 0)
+            self._flushed = max(self._flushed - len(data), 0)
+            self._cv.notify_all()
+        self.reads += 1
+        self.read_bytes += len(data)
+        # Two status bytes per packet
+        self._transfer(len(data) + 2)
+        if unflushed and unflushed < self.usb.packet_size - 2:
+            self.usb_time += self.latency / 1000
+        return array('B', data)
+
+    def read_port(self):
+        """ GpioController.read_port() of older PyFTDI """
+        self.reads += 1
+        self._transfer(1)
+        return self._sample()
+
+    def write_port(self, state):
+        """ GpioController.write_port() of older PyFTDI """
+        self.write_data(bytes((state,)))
+
+    # Pins and the chain
+
+    def _sample(self):
+        """ Level of the pins, with TDO driven by the chain. """
+        return (self._pins & ~self.TDO_BIT) | (self.TDO_BIT if self._tdo else 0)
+
+    def _set_pins(self, pins):
+        """ Drive the output pins, clocking the chain on a rising TCK.
+            TDO only follows the chain while TCK is low, as the TAPs
+            change it on the falling edge. """
+        if pins & self.TCK_BIT and not self._pins & self.TCK_BIT:
+            self.chain.clock(1 if pins & self.TMS_BIT else 0, 1 if pins & self.TDI_BIT else 0)
+        else:
+            self._tdo = self.chain.tdo
+        self._pins = pins
+
+    def _out(self, byte):
+        """ Put a byte in the RX FIFO, waiting for room like the MPSSE. """
+        with self._cv:
+            if not self._cv.wait_for(lambda: len(self._rx) < self.fifo_sizes[1], timeout=self.stall_timeout):
+                raise IOError('Emulated RX FIFO full, the MPSSE would stall')
+            self._rx.append(byte)
+
+    # MPSSE
+
+    def _run_mpsse(self):
+        """ Run the complete commands of the written bytes. """
+        p = self._pending
+        i = 0
+        while i < len(p):
+            op = p[i]
+            length = self.MPSSE_CMD_LENGTHS.get(op)
+            if length is None:
+                if op & 0x80:
+                    length = 1
+                elif op & 0x02:
+                    # Bit commands: length, then a data byte if they write
+                    length = 3 if op & 0x50 else 2
+                else:
+                    if i + 3 > len(p):
+                        break
+                    length = 3 + ((p[i+1] | p[i+2] << 8) + 1 if op & 0x10 else 0)
+            if i + length > len(p):
+                break
+            self._mpsse(bytes(p[i:i+length]))
+            i += length
+        del p[:i]
+
+    def _mpsse(self, cmd):
+        op = cmd[0]
+        if op & 0x80:
+            if op not in self.MPSSE_CMD_LENGTHS or (op in self.H_SERIES_CMDS and not self.is_H_series):
+                # Bad command, the FTDI answers with 0xfa and the opcode
+                self._out(0xfa)
+                self._out(op)
+            elif op == 0x80:
+                self._pins = (self._pins & ~0xff) | (cmd[1] & cmd[2] & ~self.TCK_BIT)
+            elif op == 0x81:
+                self._out(self._sample())
+            elif op == 0x83:
+                self._out(0)
+            elif op == 0x87:
+                with self._cv:
+                    self._flushed = len(self._rx)
+            elif op == 0x8e:
+                self._clocks(cmd[1] + 1)
+            elif op == 0x8f:
+                self._clocks(8*((cmd[1] | cmd[2] << 8) + 1))
+            return
+
+        write_tdi = op & 0x10
+        write_tms = op & 0x40
+        read = op & 0x20
+        lsb = op & 0x08
+        if write_tms:
+            # TMS bits from the lsb, TDI held at bit 7
+            count = cmd[1] + 1
+            tdi = cmd[2] >> 7
+            self._set_level(self.TDI_BIT, tdi)
+            tdo = 0
+            for k in range(count):
+                self._set_level(self.TMS_BIT, (cmd[2] >> k) & 1)
+                tdo = (tdo >> 1) | (self._tick() << 7)
+            if read:
+                self._out(tdo)
+        elif op & 0x02:
+            count = cmd[1] + 1
+            tdo = 0
+            for k in range(count):
+                if write_tdi:
+                    self._set_level(self.TDI_BIT, (cmd[2] >> k) & 1 if lsb else (cmd[2] >> (7-k)) & 1)
+                bit = self._tick()
+                tdo = ((tdo >> 1) | (bit << 7)) if lsb else ((tdo << 1) | bit) & 0xff
+            if read:
+                self._out(tdo)
+        else:
+            count = (cmd[1] | cmd[2] << 8) + 1
+            for j in range(count):
+                tdo = 0
+                for k in range(8):
+                    if write_tdi:
+                        self._set_level(self.TDI_BIT, (cmd[3+j] >> k) & 1 if lsb else (cmd[3+j] >> (7-k)) & 1)
+                    bit = self._tick()
+                    tdo |= bit << k if lsb else bit << (7-k)
+                if read:
+                    self._out(tdo)
+
+    def _set_level(self, bit, level):
+        self._pins = (self._pins | bit) if level else (self._pins & ~bit)
+
+    def _tick(self):
+        """ Clock TCK once with the TMS and TDI pins and return TDO. """
+        tdo = self.chain.clock(1 if self._pins & self.TMS_BIT else 0, 1 if self._pins & self.TDI_BIT else 0)
+        self._tdo = self.chain.tdo
+        return tdo
+
+    def _clocks(self, count):
+        for k in range(count):
+            self._tick()
+
+
+class Emulator(PyFTDIAdapter):
+    """
+        A PyFTDIAdapter on an EmulatedFtdi, for running the server and
+        the benchmarks without a board.
+    """
+
+    MAX_FREQ = 6.0e6
+
+    def __init__(self, debug=False, ftdi=None):
+        """
+            ftdi -- The EmulatedFtdi to use, a new one on an emulated
+                    chain of a single 7 series FPGA by default.
+        """
+        self.ftdi = ftdi or EmulatedFtdi()
+        self._jtag = JtagController(trst=False, frequency=self.MAX_FREQ, debug=debug, ftdi=self.ftdi)
+        self._jtag.configure('ftdi://emulated/1')
+        super().__init__(self._jtag)
+
+    def set_frequency(self, frequency):
+        return self._jtag.set_frequency(min(frequency, self.max_freq))
+
+    def set_tck_period(self, period):
+        return int(1e9/self.set_frequency(1e9/period))
+
+
+# General name of class for server
+jtag_adapter = Emulator
+
+
+# Benchmarks: the adapter setups and the workloads they run, each a
+# function that does one shift and returns whether its TDO was right
+
+def _mpsse(**options):
+    return Emulator(ftdi=EmulatedFtdi(**options))
+
+def _unbatched():
+    adapter = _mpsse()
+    adapter.batch = False
+    return adapter
+
+def _streaming():
+    adapter = _mpsse()
+    adapter.set_streaming(True)
+    return adapter
+
+def _sync_bitbang():
+    # Imported here, the GPIO adapters are not needed otherwise
+    from adapters.papilio_one import PapilioOne
+    return PapilioOne(ftdi=EmulatedFtdi(fifo_sizes=(384, 128), is_H_series=False))
+
+SETUPS = {
+    'mpsse': _mpsse,
+    'mpsse-unbatched': _unbatched,
+    'mpsse-streaming': _streaming,
+    'mpsse-ft2232d': lambda: _mpsse(fifo_sizes=(384, 128), is_H_series=False),
+    'sync-bitbang': _sync_bitbang,
+}
+
+def _idcode(adapter, rng):
+    # The IDCODE comes after the 9 TMS moves to Shift-DR
+    return (idcode_pattern(adapter) >> 9) & 0xffffffff == EmulatedTap().idcode
+
+def _bypass(adapter, rng):
+    return bypass_pattern(adapter, rng) == 1
+
+def _cfg_in(adapter, rng):
+    # Load CFG_IN and write a vector's worth of configuration data,
+    # whose TDO is not needed
+    pattern = _Pattern()
+    pattern.moves('1111101100')
+    pattern.scan(0b000101, 6)
+    pattern.moves('1100')
+    pattern.scan(rng.getrandbits(CFG_IN_BITS), CFG_IN_BITS)
+    pattern.moves('10')
+    pattern.send(adapter)
+    return True
+
+WORKLOADS = {
+    'idcode': _idcode,
+    'bypass': _bypass,
+    'cfg_in': _cfg_in,
+}
+
+# Configuration data bits per CFG_IN shift, about what fits in the
+# xvc_vector_len of the MPSSE adapters
+CFG_IN_BITS = 32000
+
+
+def benchmark(setup, workload, shifts, seed=0):
+    """
+        Run shifts of workload on a new adapter of setup and return the
+        counters of its EmulatedFtdi, with the wall clock time taken as
+        elapsed and the number of wrong TDOs as errors.
+    """
+    adapter = SETUPS[setup]()
+    ftdi = adapter.ftdi if hasattr(adapter, 'ftdi') else adapter.device
+    rng = random.Random(seed)
+    # Leave the setup out of the counts
+    ftdi.reset_stats()
+    errors = 0
+    start = time.perf_counter()
+    for k in range(shifts):
+        if not WORKLOADS[workload](adapter, rng):
+            errors += 1
+    stats = ftdi.stats()
+    stats['elapsed'] = time.perf_counter() - start
+    stats['errors'] = errors
+    if hasattr(adapter, 'set_streaming'):
+        adapter.set_streaming(False)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the adapters on an emulated FTDI device')
+    parser.add_argument('-n', '--shifts', type=int, default=20, help='Shifts of each workload')
+    parser.add_argument('-s', '--setup', action='append', choices=sorted(SETUPS), help='Adapter setup, all of them by default')
+    parser.add_argument('-w', '--workload', action='append', choices=sorted(WORKLOADS), help='Workload, all of them by default')
+    args = parser.parse_args(argv)
+
+    print('{:16} {:8} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+        'setup', 'workload', 'writes', 'reads', 'bytes out', 'bytes in', 'usb ms', 'pins ms', 'errors'))
+    failed = False
+    for setup in args.setup or SETUPS:
+        for workload in args.workload or WORKLOADS:
+            stats = benchmark(setup, workload, args.shifts)
+            n = args.shifts
+            print('{:16} {:8} {:8.1f} {:8.1f} {:10.1f} {:10.1f} {:10.3f} {:10.3f} {:7}'.format(
+                setup, workload, stats['writes']/n, stats['reads']/n,
+                stats['write_bytes']/n, stats['read_bytes']/n,
+                1000*stats['usb_time']/n, 1000*stats['pin_time']/n, stats['errors']))
+            failed |= stats['errors'] > 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
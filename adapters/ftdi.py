@@ -15,9 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
-import bitstring
-from bitstring import BitStream
-from adapters.jtag import jtag
+from adapters.bitbang import SyncBitbang, BitbangJtag
 
 from pylibftdi import BitBangDevice
 
@@ -27,7 +25,41 @@ import sys
 import struct
 import time
 
-class FTDIAdapter(jtag):
+
+class LibftdiSyncBitbang(SyncBitbang):
+    """
+        A SyncBitbang on a pylibftdi BitBangDevice.
+    """
+
+    # Read FIFO of the FT2232D and FT232R, less two bytes of status
+    CHUNK = 126
+
+    # Lowest and highest bitbang rates of the FT2232D and FT232R, as
+    # libftdi sets four times the bitbang rate as the baud rate
+    SAMPLE_RATES = (46, 750000)
+
+    def __init__(self, device, tck, tdi, tdo, tms, others=0, chunk=CHUNK):
+        """
+            device -- The pylibftdi BitBangDevice, opened with sync=True
+                      and the JTAG outputs as outputs.
+            tck, tdi, tdo, tms, others, chunk -- See SyncBitbang.
+        """
+        super().__init__(tck, tdi, tdo, tms, chunk, others)
+        self.device = device
+
+    def set_sample_rate(self, rate):
+        (low, high) = self.SAMPLE_RATES
+        self.device.baudrate = min(max(rate, low), high)
+        return self.device.baudrate
+
+    def write_samples(self, samples):
+        self.device.write(samples)
+
+    def read_samples(self, count):
+        return self.device.read(count)
+
+
+class FTDIAdapter(BitbangJtag):
     """ 
         A JTAG adapter for FTDI-based devices.
     """
@@ -55,50 +87,14 @@ class FTDIAdapter(jtag):
         self.verbosity_level = level
 
 
-    def set_tck_period(self, period):
-        """
-            Handle the settck virtual cable command which requests a certain TCK period. Return the actual period.
-        """
-
-        ## Actual Period depends on many factors since this tries to simply go as fast as it can. So nothing to set. Respond that it goes at 100 Hz or 10e6 ns
-        return int(10e6)
-
-
-    #def jtag_general(self, tms_stream, tdi_stream):
-    def send_data(self, tms_stream, tdi_stream):
-        """
-            Performs a general-purpose JTAG communication.
-
-            tms_stream -- The values to be transmitted over the Test Most Select (TMS) line.
-            tdi_stream -- The values to be transmitted to the target device.
-        """
-        
-        #Create a new bitstream object to store the result of the transmission.
-        tdo_stream = BitStream()
-
-        #For each simulatenous pair of bits in the transmission...
-        for (tms, tdi) in zip(tms_stream, tdi_stream):
-
-            #...perform the core transmission...
-            tdo = self.tick(tms, tdi)
-
-            #... and add the result to our resultant stream.
-            tdo_stream += BitStream(bool=tdo)
-
-            #Track where we are the JTAG state machine, in case TMS changes.
-            self.track_tms(tms)
-
-        #... return the values returned over TDO.
-        return tdo_stream
-
-
-    def tick(self, tms, tdi, clock_delays = 0):
+    def tick(self, tms, tdi, clock_delays = 0, read=True):
         """
             Sets the values of the TMS and TDI lines for a single cycle of JTAG communication,
             and samples TDO at the appropriate time.
 
             tms: The value of TMS.
             tdi: The value of TDI.
+            read: Sample TDO. If False, TDO is returned as False.
         """
 
         #Apply a falling edge of the clock.
@@ -114,7 +110,7 @@ class FTDIAdapter(jtag):
 
         #Apply a rising edge, and sample the input.
         self.set_tck(1);
-        tdo = self.get_tdo()
+        tdo = self.get_tdo() if read else False
 
         #If requested, wait.
         if clock_delays:
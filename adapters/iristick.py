@@ -18,7 +18,6 @@
 from os import environ
 import atexit
 
-from bitstring              import BitStream
 from adapters.jtag          import jtag
 from adapters.pyftdi        import PyFTDIAdapter
 
@@ -69,7 +68,7 @@ class Iristick(PyFTDIAdapter):
             Set the TCK Frequency
         """
 
-        frequency = min(frequency, self.MAX_FREQ)
+        frequency = min(frequency, self.max_freq)
         actualFreq = self._jtag.set_frequency(frequency)
 
         return actualFreq
@@ -15,23 +15,170 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
+from adapters.bitvector import BitVector
+
+
+def tms_walk(state, tms, num_bits):
+    """ Return the TAP state reached from state after clocking the first
+        num_bits of tms, a byte vector in the XVC layout. Whole bytes are
+        looked up in TMS_BYTE_NEXT, only a trailing partial byte is
+        stepped bit by bit. """
+    (nbytes, tail) = divmod(num_bits, 8)
+    table = TMS_BYTE_NEXT
+    for b in tms[:nbytes]:
+        state = table[state << 8 | b]
+    if tail:
+        b = tms[nbytes]
+        states = jtag.jtag_states
+        for k in range(tail):
+            state = states[state][1 + ((b >> k) & 1)]
+    return state
+
 
 class jtag:
+
+    # What to do with the TDO of a Shift-DR scan, by instruction, as
+    # (IR length, IR value) with the first bit shifted in as the lsb.
+    # They also apply to the IR of a chain with the instruction in the
+    # IR of one device and the others in BYPASS, see ir_policy().
+    WRITE_ONLY = 'write-only'   # TDO is not needed, see send_bytes()
+
+    IR_POLICIES = {
+        (6, 0b000101): WRITE_ONLY,      # CFG_IN of 7 series and UltraScale
+    }
+
+    # USER1 to USER4 of 7 series and UltraScale. SPI flash loaders send
+    # the flash data through these, but also poll the flash status.
+    USER_IRS = ((6, 0b000010), (6, 0b000011), (6, 0b100010), (6, 0b100011))
+
+    # IR as left by Test-Logic-Reset
+    RESET_IR = ()
+
     def __init__(self):
         self.state = self.RUN_TEST_IDLE
 
+        # Instruction in the IR as (IR length, IR value) from the last
+        # IR scan, RESET_IR or None if not known. Only kept up to date
+        # by track_shift().
+        self.live_ir = None
+        self._ir_bits = 0
+        self._ir_len = 0
+
+        self.ir_policies = dict(self.IR_POLICIES)
+
+    def ir_policy(self, ir):
+        """ Return the policy of ir_policies for ir, a live_ir, or None.
+            An instruction also matches any slice of the IR of a longer
+            chain, such as the 10 bit IR of a Zynq, whose other bits are
+            all '1', which is BYPASS for every device. """
+        if not ir:
+            return None
+        policy = self.ir_policies.get(ir)
+        if policy is not None:
+            return policy
+        (length, bits) = ir
+        ones = (1 << length) - 1
+        for ((ir_len, ir_bits), policy) in self.ir_policies.items():
+            mask = (1 << ir_len) - 1
+            for shift in range(length - ir_len + 1):
+                if (bits >> shift) & mask == ir_bits and bits | (mask << shift) == ones:
+                    return policy
+        return None
+
+    def send_bytes(self, num_bits, tms, tdi):
+        """
+            Shift num_bits of the TMS and TDI vectors of a XVC shift:
+            command and return the TDO vector. All three are byte
+            vectors with bit 0 of byte 0 as the first bit.
+
+            This goes through send_data() with the vectors as
+            BitVectors. Adapters that can work with the XVC layout
+            directly should override it.
+        """
+        tdo = self.send_data(BitVector.from_bytes(tms, num_bits), BitVector.from_bytes(tdi, num_bits))
+        return tdo.to_bytes()
+
     def set_state(self, state):
         self.state = state
 
     def get_state(self):
         return self.state
 
+    def get_tracking(self):
+        """ What track_shift() knows of the TAP, for set_tracking(). """
+        return (self.state, self.live_ir, self._ir_bits, self._ir_len)
+
+    def set_tracking(self, tracking):
+        (self.state, self.live_ir, self._ir_bits, self._ir_len) = tracking
+
     def track_tms(self, tms):
         self.state = self.jtag_states[self.state][2] if tms else self.jtag_states[self.state][1]
 
-    def track_tms_stream(self, bitstream):
-        for bit in bitstream:
-            self.state = self.jtag_states[self.state][2] if bit else self.jtag_states[self.state][1]
+    def track_tms_stream(self, bits):
+        """ Track a TMS BitVector. """
+        self.state = tms_walk(self.state, bits.to_bytes(), len(bits))
+
+    def track_tms_bytes(self, tms, num_bits):
+        """ Track num_bits of a TMS vector in the XVC layout. """
+        self.state = tms_walk(self.state, tms, num_bits)
+
+    def track_shift(self, num_bits, tms, tdi):
+        """
+            Track the state and the IR through the TMS and TDI vectors,
+            in the XVC layout, of a shift. Return the runs of bits clocked
+            with TMS at '0' in one of RUN_STATES, as [first bit, end bit,
+            state, live_ir].
+
+            Bytes that stay away from RUN_STATES and the IR states only
+            need a lookup in TMS_BYTE_NEXT, so do whole bytes of a run.
+        """
+        state = self.state
+        runs = []
+        run_states = self.RUN_STATES
+        slow = self.IR_EVENT_STATES | self.RUN_STATES_MASK
+        k = 0
+        for b in tms[:num_bits // 8]:
+            if not b and state in run_states:
+                if runs and runs[-1][1] == k:
+                    runs[-1][1] = k+8
+                else:
+                    runs.append([k, k+8, state, self.live_ir])
+            else:
+                index = state << 8 | b
+                if (state != self.SHIFT_IR and state not in run_states and not TMS_BYTE_VISIT[index] & slow):
+                    state = TMS_BYTE_NEXT[index]
+                else:
+                    state = self._track_shift_bits(state, k, k+8, tms, tdi, runs)
+            k += 8
+        if k < num_bits:
+            state = self._track_shift_bits(state, k, num_bits, tms, tdi, runs)
+        self.state = state
+        return runs
+
+    def _track_shift_bits(self, state, k, end, tms, tdi, runs):
+        """ Bit by bit track_shift() of bits k to end. Returns the state. """
+        states = self.jtag_states
+        run_states = self.RUN_STATES
+        for k in range(k, end):
+            bit = (tms[k >> 3] >> (k & 7)) & 1
+            if state == self.SHIFT_IR:
+                self._ir_bits |= ((tdi[k >> 3] >> (k & 7)) & 1) << self._ir_len
+                self._ir_len += 1
+            elif not bit and state in run_states:
+                if runs and runs[-1][1] == k:
+                    runs[-1][1] = k+1
+                else:
+                    runs.append([k, k+1, state, self.live_ir])
+            state = states[state][1 + bit]
+
+            if state == self.CAPTURE_IR:
+                self._ir_bits = 0
+                self._ir_len = 0
+            elif state == self.UPDATE_IR:
+                self.live_ir = (self._ir_len, self._ir_bits)
+            elif state == self.TEST_LOGIC_RESET:
+                self.live_ir = self.RESET_IR
+        return state
 
     RUN_TEST_IDLE = 0
     SELECT_DR = 1
@@ -69,4 +216,51 @@ class jtag:
         ['Exit 2 IR',		SHIFT_IR,		UPDATE_IR],
         ['Update IR',		RUN_TEST_IDLE,	SELECT_DR]]
 
+    # States whose visit changes what track_shift() records about the IR
+    IR_EVENT_STATES = ((1 << CAPTURE_IR) | (1 << SHIFT_IR) |
+                       (1 << UPDATE_IR) | (1 << TEST_LOGIC_RESET))
+
+    # States that TMS '0' does not leave, whose runs track_shift()
+    # returns. Shift-IR is left out as it is handled with the IR.
+    RUN_STATES = (RUN_TEST_IDLE, SHIFT_DR, PAUSE_DR, PAUSE_IR)
+    RUN_STATES_MASK = ((1 << RUN_TEST_IDLE) | (1 << SHIFT_DR) |
+                       (1 << PAUSE_DR) | (1 << PAUSE_IR))
+
+    # Run states where TDI and TDO do not matter
+    IDLE_STATES = (RUN_TEST_IDLE, PAUSE_DR, PAUSE_IR)
+
+
+def _build_tms_byte_tables():
+    """
+        For every (state, TMS byte) pair, clock the 8 bits of the byte
+        (bit 0 first) through the TAP and record, at index state << 8 | byte:
+
+        TMS_BYTE_NEXT  -- the state after the 8 clocks.
+        TMS_BYTE_SHIFT -- a mask with bit k set when clock k shifts a bit,
+                          i.e. the TAP is in Shift-DR or Shift-IR before it.
+                          The lowest set bit, if any, is where the byte
+                          enters (or already is in) a shift.
+        TMS_BYTE_VISIT -- a mask with bit s set for every state s the TAP
+                          is in after one of the clocks.
+    """
+    states = jtag.jtag_states
+    shifts = (jtag.SHIFT_DR, jtag.SHIFT_IR)
+    next_states = []
+    shift_masks = []
+    visit_masks = []
+    for start in range(16):
+        for byte in range(256):
+            state = start
+            shift = 0
+            visit = 0
+            for k in range(8):
+                if state in shifts:
+                    shift |= 1 << k
+                state = states[state][1 + ((byte >> k) & 1)]
+                visit |= 1 << state
+            next_states.append(state)
+            shift_masks.append(shift)
+            visit_masks.append(visit)
+    return (bytes(next_states), bytes(shift_masks), tuple(visit_masks))
 
+(TMS_BYTE_NEXT, TMS_BYTE_SHIFT, TMS_BYTE_VISIT) = _build_tms_byte_tables()
@@ -25,10 +25,10 @@ import logging
 from os import environ
 import atexit
 
-from bitstring      import BitStream
 from adapters.jtag  import jtag
-from adapters.pyftdi_gpio  import PyFTDIGPIOAdapter
+from adapters.pyftdi_gpio  import PyFTDIGPIOAdapter, PyFTDISyncBitbang
 
+from pyftdi.ftdi import Ftdi
 from pyftdi.gpio import GpioController, GpioException
 
 
@@ -48,30 +48,46 @@ class PapilioOne(PyFTDIGPIOAdapter):
     TMS_PORT = 3
 
     DEFAULT_FREQ = int(1e6)
+
+    # Clock the shifts in synchronous bitbang mode, see PyFTDISyncBitbang,
+    # instead of a GpioController access per pin change
+    SYNC_BITBANG = True
     FTDI_URL = 'ftdi://0x{:04x}:0x{:04x}/1'.format(VENDOR_ID, PRODUCT_ID)
 
-    def __init__(self, serial_number=None, debug=False):
+    def __init__(self, serial_number=None, debug=False, ftdi=None):
         """
             Create a new instance of the Papilio One.
 
             serial_number -- The serial number of the board to connect to, or None to use
                              the first available bitbangable FTDI. Use caution with this one!
                              NOTE: This is IGNORED.
+            ftdi -- The Ftdi or GpioController to use instead of a new one,
+                    such as an EmulatedFtdi.
         """
 
-	# Instead of using BitBangDevice(), use GpioController() from PyFTDI
-        self._gpio = GpioController()
-
         # If FTDI_DEVICE environment variable, use it instead of self.FTDI_URL
         url = environ.get('FTDI_DEVICE', self.FTDI_URL)
 
-        # Open the PyFTDI URL with outputs set as per set_up_jtag_port()
-        self._gpio.open_from_url(url, direction=self.set_up_jtag_port())
+        if self.SYNC_BITBANG:
+            # Open the port in bitbang mode and switch it to synchronous
+            # bitbang, with outputs set as per set_up_jtag_port()
+            self._gpio = ftdi or Ftdi()
+            self._gpio.open_bitbang_from_url(url, direction=self.set_up_jtag_port())
+            bitbang = PyFTDISyncBitbang(self._gpio, self.TCK_PORT, self.TDI_PORT, self.TDO_PORT, self.TMS_PORT)
+            bitbang.start(self.set_up_jtag_port(), self.DEFAULT_FREQ)
+        else:
+            # Instead of using BitBangDevice(), use GpioController() from PyFTDI
+            self._gpio = ftdi or GpioController()
+
+            # Open the PyFTDI URL with outputs set as per set_up_jtag_port()
+            self._gpio.open_from_url(url, direction=self.set_up_jtag_port())
+            bitbang = None
 
         atexit.register(self.cleanup)
         
         #Initiatialize the core JTAG subsystem.
         super().__init__(self._gpio)
+        self.set_bitbang(bitbang)
 
 
     def cleanup(self):
@@ -84,8 +100,9 @@ class PapilioOne(PyFTDIGPIOAdapter):
             Handle the settck virtual cable command which requests a certain TCK period. Return the actual period.
         """
 
-        #@@@# Modify to actually change frequency using PyFTDI functions.
-        
+        if self.bitbang is not None:
+            return super().set_tck_period(period)
+
         ## Actual Period depends on many factors since this tries to simply go as fast as it can. So nothing to set. Respond that it goes at 100 Hz or 10e6 ns
         return int(1e9//self.DEFAULT_FREQ)
         
@@ -0,0 +1,87 @@
+#------------------------------------------------------------------------------
+# Copyright 2018 S. Goadhouse <sgoadhouse@virginia.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+from os import environ
+import atexit
+
+from adapters.jtag          import jtag
+from adapters.pyftdi        import PyFTDIAdapter
+
+from adapters.pyftdi_jtagc  import JtagController, JtagError
+
+
+class PapilioOneMPSSE(PyFTDIAdapter):
+    """ 
+        A JTAG adapter for Papilio One boards in MPSSE mode. Their FT2232D
+        has TCK, TDI, TDO and TMS on ADBUS0-3, the pins of the MPSSE, so
+        this is the papilio_one adapter without the bitbang.
+    """
+
+    #VID/PID constants, as in papilio_one.py
+    VENDOR_ID  = 0x0403
+    PRODUCT_ID = 0x6010
+
+    # The FT2232D clocks at most 6 MHz, the Papilio One leaves a margin
+    # until --autotune has found what the board takes
+    MAX_FREQ = 3.0e6
+    FTDI_URL = 'ftdi://0x{:04x}:0x{:04x}/1'.format(VENDOR_ID, PRODUCT_ID)
+
+    def __init__(self, debug=False):
+        """
+            Create a new instance of the Papilio One.
+        """
+
+        ## Getting USB Timeout errors, try 10000 ms for both
+        self._jtag = JtagController(trst=False, frequency=self.MAX_FREQ, debug=debug, usb_read_timeout=10000, usb_write_timeout=10000)
+
+        # If FTDI_DEVICE environment variable, use it instead of self.FTDI_URL
+        url = environ.get('FTDI_DEVICE', self.FTDI_URL)
+
+        # Open the PyFTDI URL configured for MPSSE JTAG
+        self._jtag.configure(url)
+
+        atexit.register(self.cleanup)
+
+        #Initiatialize the core JTAG subsystem.
+        super().__init__(self._jtag)
+
+
+    def cleanup(self):
+        print("Running PyFTDI JTAG cleanup...")
+        self._jtag.close()
+
+
+    def set_frequency(self, frequency):
+        """
+            Set the TCK Frequency
+        """
+
+        frequency = min(frequency, self.max_freq)
+        actualFreq = self._jtag.set_frequency(frequency)
+
+        return actualFreq
+
+    def set_tck_period(self, period):
+        """
+            Handle the settck virtual cable command which requests a certain TCK period. Return the actual period.
+        """
+
+        return int(1e9/self.set_frequency(1e9/period))
+
+
+# General name of class for server
+jtag_adapter = PapilioOneMPSSE
@@ -0,0 +1,366 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+import re
+from collections import OrderedDict
+
+from adapters.jtag import jtag
+from adapters.bitvector import BitVector
+
+# NumPy is optional. When it is installed, long shifts are segmented
+# with a few vectorized passes instead of a Python loop over the runs.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Shifts shorter than this are faster to segment without NumPy
+NUMPY_MIN_BITS = 8192
+
+# The ops of a plan. Each clocks bits head to tail-1 of the shift.
+TMS = 'tms'         # TMS moves with TDI constant, TDO read back
+SCAN = 'scan'       # TMS at '0', TDI written and TDO read back
+WRITE = 'write'     # TMS at '0', TDI written, TDO not needed
+READ = 'read'       # TMS at '0', TDI constant, TDO read back
+IDLE = 'idle'       # TMS at '0' in IDLE_STATES, neither TDI nor TDO needed
+
+# Runs of TDI bytes that are all '0's or all '1's, which plan_shift()
+# offers as READ ops
+CONSTANT_TDI_RUN = re.compile(rb'\x00{2,}|\xff{2,}')
+
+# Longer shifts are not kept in the PlanCache
+PLAN_CACHE_MAX_BITS = 4096
+
+
+class PlanCache:
+    """
+        A bounded LRU cache of the plans of shifts, by the tracked TAP
+        state and IR and the vectors of the shift. Hardware managers and
+        ILA dashboards poll with the same short shifts over and over, and
+        a hit skips plan_shift() and whatever an adapter compiles from a
+        plan. TDO is never cached, it always comes from the cable.
+    """
+
+    def __init__(self, size=256):
+        # At most size plans are kept, none with a size of 0
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get(self, key):
+        plan = self._plans.get(key)
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._plans.move_to_end(key)
+        return plan
+
+    def put(self, key, plan):
+        self._plans[key] = plan
+        while len(self._plans) > self.size:
+            self._plans.popitem(last=False)
+
+    def clear(self):
+        """ Drop all of the plans, as needed after ir_policies changed. """
+        self._plans.clear()
+
+
+class CachedPlan:
+    """
+        A plan in the PlanCache: the ops of the shift and the tracking
+        the shift ends with. Adapters keep what they compile from the
+        ops in compiled, by whatever else it depends on.
+    """
+
+    __slots__ = ('ops', 'tracking', 'compiled')
+
+    def __init__(self, ops, tracking):
+        self.ops = ops
+        self.tracking = tracking
+        self.compiled = {}
+
+
+class PlannedJtag(jtag):
+    """
+        Base of the adapters whose shifts go through plan_shift(). The
+        planner does the walk over the TMS and TDI vectors and the TAP
+        and IR tracking, so an adapter only declares which ops it can
+        send in plan_ops, what they cost in op_cost() and sends a plan
+        in send_plan(). Ops it cannot send are planned as SCANs.
+    """
+
+    plan_ops = (TMS, SCAN)
+
+    def __init__(self):
+        super().__init__()
+
+        # Segment long shifts with numpy_segments() when NumPy is there
+        self.use_numpy = numpy is not None
+
+        self.plan_cache = PlanCache()
+
+    def op_cost(self, kind, num_bits):
+        """
+            Cost of sending num_bits as one op of kind, in any unit as
+            long as all of the ops of the adapter use the same one.
+            plan_shift() only makes an op of its own of a run when that
+            costs less than leaving its bits in the SCAN around it.
+        """
+        return num_bits
+
+    def send_bytes(self, num_bits, tms, tdi):
+        if num_bits > PLAN_CACHE_MAX_BITS or not self.plan_cache.size:
+            return self.send_plan(plan_shift(self, num_bits, tms, tdi), num_bits, tms, tdi)
+
+        key = (self.get_tracking(), num_bits, bytes(tms), bytes(tdi))
+        cached = self.plan_cache.get(key)
+        if cached is None:
+            ops = plan_shift(self, num_bits, tms, tdi)
+            cached = CachedPlan(ops, self.get_tracking())
+            self.plan_cache.put(key, cached)
+        else:
+            self.set_tracking(cached.tracking)
+        return self.send_plan(cached.ops, num_bits, tms, tdi, cached)
+
+    def send_data(self, tms_stream, tdi_stream):
+        num_bits = len(tms_stream)
+        tdo = self.send_bytes(num_bits, tms_stream.to_bytes(), tdi_stream.to_bytes())
+        return BitVector.from_bytes(tdo, num_bits)
+
+    def send_plan(self, ops, num_bits, tms, tdi, cached=None):
+        """
+            Send the ops of a shift from plan_shift() and return the TDO
+            vector. tms and tdi are the vectors of the shift, all three
+            in the XVC layout. The TDO bits of WRITE and IDLE ops, and of
+            TMS ops the adapter does not read back, are '0's. cached is
+            the CachedPlan of the ops, if they are in the PlanCache.
+        """
+        raise NotImplementedError
+
+
+def vector_bits(data, head, tail):
+    """ Bits head to tail-1 of a vector in the XVC layout, as an integer
+        with bit head as the lsb. """
+    value = int.from_bytes(data[head >> 3:(tail+7) >> 3], byteorder='little')
+    return (value >> (head & 7)) & ((1 << (tail-head))-1)
+
+
+def plan_shift(tap, num_bits, tms, tdi):
+    """
+        Compile a shift into a list of ops for tap, a PlannedJtag, and
+        track the TAP state and IR of tap through it. Each op is a tuple
+        (kind, head, tail, state) for bits head to tail-1 of the shift,
+        with state the TAP state before bit head.
+
+        Bits with TMS at '1', and the '0' that follows each run of them,
+        are TMS ops, cut wherever TDI changes. The other bits are SCANs,
+        except for the runs that need less: IDLE in Run-Test/Idle and
+        the Pause states, WRITE in Shift-DR for an instruction that
+        ir_policies marks as WRITE_ONLY and READ where TDI is constant.
+        Those are only used when tap has them in plan_ops and they cost
+        less than the SCAN bits they replace.
+    """
+    state = tap.get_state()
+    runs = tap.track_shift(num_bits, tms, tdi)
+    skip = _skip_runs(tap, runs)
+
+    if tap.use_numpy and numpy is not None and num_bits >= NUMPY_MIN_BITS:
+        tms_bits = numpy.unpackbits(numpy.frombuffer(tms, dtype=numpy.uint8), count=num_bits, bitorder='little')
+        tdi_bits = numpy.unpackbits(numpy.frombuffer(tdi, dtype=numpy.uint8), count=num_bits, bitorder='little')
+        segments = numpy_segments(tms_bits, tdi_bits)
+    else:
+        segments = bit_segments(num_bits, tms, tdi)
+
+    states = jtag.jtag_states
+    plan = []
+    for (head, tail, is_tms) in segments:
+        if is_tms:
+            plan.append((TMS, head, tail, state))
+            bits = vector_bits(tms, head, tail)
+            for k in range(tail-head):
+                state = states[state][1 + ((bits >> k) & 1)]
+        else:
+            _plan_scan(tap, plan, head, tail, state, skip, tdi)
+            length = tail-head
+            while length and states[state][1] != state:
+                state = states[state][1]
+                length -= 1
+    return plan
+
+
+def bit_segments(num_bits, tms, tdi):
+    """
+        Cut a shift into (head, tail, is_tms) segments for the bits head
+        to tail-1, in order, like numpy_segments() but walking the TMS
+        runs of the vectors as integers.
+    """
+    tms = int.from_bytes(tms, byteorder='little') & ((1 << num_bits)-1)
+    tdi = int.from_bytes(tdi, byteorder='little')
+
+    segments = []
+    head = 0
+    while (head < num_bits):
+        # Position of the next bit where TMS is '1'
+        rest = tms >> head
+        if rest:
+            tms1Pos = head + (rest & -rest).bit_length() - 1
+        else:
+            tms1Pos = num_bits
+
+        if (tms1Pos > head):
+            segments.append((head, tms1Pos, False))
+
+        head = tms1Pos
+        if head >= num_bits:
+            break
+
+        # Position just past the next bit where TMS is '0'. The bits of
+        # ~tms past the end of the vector are all '1', so limit it to
+        # the end of the vector.
+        rest = ~tms >> head
+        tms0Pos = min(head + (rest & -rest).bit_length(), num_bits)
+
+        # TDI has to stay constant, so cut wherever it changes
+        seg = (tdi >> head) & ((1 << (tms0Pos-head))-1)
+        changes = seg ^ (seg >> 1)
+        changes &= (1 << (tms0Pos-head-1))-1
+        while changes:
+            tail = head + (changes & -changes).bit_length()
+            segments.append((head, tail, True))
+            changes >>= tail-head
+            head = tail
+        segments.append((head, tms0Pos, True))
+        head = tms0Pos
+
+    return segments
+
+
+def numpy_segments(tms_bits, tdi_bits):
+    """
+        Plan the segments of a shift from its TMS and TDI bits, NumPy
+        uint8 arrays with one bit per element. Return a list of (head,
+        tail, is_tms) for the bits head to tail-1, in order.
+
+        Bits with TMS at '1', and the '0' that follows each run of them,
+        are TMS segments, so those segments are also cut wherever TDI
+        changes. All the other bits are TDI data.
+    """
+
+    num_bits = len(tms_bits)
+
+    # In a TMS segment when TMS is '1' or was '1' on the previous bit
+    in_tms = tms_bits.copy()
+    in_tms[1:] |= tms_bits[:-1]
+
+    cuts = numpy.flatnonzero(in_tms[1:] != in_tms[:-1]) + 1
+    tdi_cuts = numpy.flatnonzero((tdi_bits[1:] != tdi_bits[:-1]) & in_tms[1:] & in_tms[:-1]) + 1
+    if len(tdi_cuts):
+        cuts = numpy.union1d(cuts, tdi_cuts)
+
+    heads = [0] + cuts.tolist()
+    tails = heads[1:] + [num_bits]
+    kinds = in_tms[heads].astype(bool).tolist()
+    return list(zip(heads, tails, kinds))
+
+
+def _skip_runs(tap, runs):
+    """
+        Pick the runs from track_shift() that need less than a SCAN, as
+        [first bit, end bit, kind]: IDLE for runs in IDLE_STATES and
+        WRITE for Shift-DR runs of an instruction that ir_policies
+        marks as WRITE_ONLY.
+    """
+    ops = tap.plan_ops
+    skip = []
+    for (start, end, state, ir) in runs:
+        if state in tap.IDLE_STATES:
+            if IDLE in ops:
+                skip.append([start, end, IDLE])
+        elif WRITE in ops and tap.ir_policy(ir) == tap.WRITE_ONLY:
+            skip.append([start, end, WRITE])
+    return skip
+
+
+def _plan_scan(tap, plan, head, tail, state, skip, tdi):
+    """
+        Plan bits head to tail-1, clocked with TMS at '0' from state.
+        skip is the list from _skip_runs(), the runs up to tail are
+        taken off it.
+    """
+    pieces = []
+    while skip and skip[0][0] < tail:
+        (start, end, kind) = skip[0]
+        if start > head:
+            _scan_pieces(tap, pieces, head, start, tdi)
+            head = start
+        stop = min(end, tail)
+        if stop > head:
+            pieces.append([kind, head, stop])
+            head = stop
+        if end > tail:
+            break
+        del skip[0]
+    if tail > head:
+        _scan_pieces(tap, pieces, head, tail, tdi)
+
+    # Keep a piece as an op of its own only if that is cheaper than
+    # sending its bits with the SCANs next to it
+    cost = tap.op_cost
+    merged = []
+    for (k, (kind, start, stop)) in enumerate(pieces):
+        if kind != SCAN:
+            before = merged[-1][2]-merged[-1][1] if merged and merged[-1][0] == SCAN else 0
+            after = pieces[k+1][2]-pieces[k+1][1] if k+1 < len(pieces) and pieces[k+1][0] == SCAN else 0
+            alone = cost(kind, stop-start)
+            if before:
+                alone += cost(SCAN, before)
+            if after:
+                alone += cost(SCAN, after)
+            if alone >= cost(SCAN, before+stop-start+after):
+                kind = SCAN
+        if kind == SCAN and merged and merged[-1][0] == SCAN:
+            merged[-1][2] = stop
+        else:
+            merged.append([kind, start, stop])
+
+    states = jtag.jtag_states
+    pos = merged[0][1] if merged else head
+    for (kind, start, stop) in merged:
+        while pos < start and states[state][1] != state:
+            state = states[state][1]
+            pos += 1
+        pos = start
+        plan.append((kind, start, stop, state))
+
+
+def _scan_pieces(tap, pieces, head, tail, tdi):
+    """
+        Add the SCAN pieces of bits head to tail-1, with the runs of
+        constant TDI bytes in them as READ pieces when tap has READ.
+    """
+    if READ in tap.plan_ops:
+        for run in CONSTANT_TDI_RUN.finditer(tdi, (head+7) >> 3, tail >> 3):
+            start = 8*run.start()
+            if start > head:
+                pieces.append([SCAN, head, start])
+            pieces.append([READ, start, 8*run.end()])
+            head = 8*run.end()
+    if tail > head:
+        pieces.append([SCAN, head, tail])
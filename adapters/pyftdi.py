@@ -21,8 +21,8 @@
 #
 #------------------------------------------------------------------------------
 
-from bitstring import BitStream, BitArray, Bits
-from adapters.jtag import jtag
+from adapters.planner import PlannedJtag, vector_bits, TMS, SCAN, WRITE, READ, IDLE
+from adapters.autotune import load_profile
 
 # INSTALLATION NOTE:
 #
@@ -37,11 +37,20 @@ from adapters.jtag import jtag
 # this may impact any other FTDI devices that you want to run in VCOM
 # mode.
 
-class PyFTDIAdapter(jtag):
+class PyFTDIAdapter(PlannedJtag):
     """ 
         A JTAG adapter for FTDI-based devices based on the python PyFTDI library and using MPSSE mode.
     """
 
+    plan_ops = (TMS, SCAN, WRITE, READ, IDLE)
+
+    # TCK frequency limit of boards that have no tuning profile
+    MAX_FREQ = 6.0e6
+
+    # Settings the autotuner tries, see tune_candidates()
+    TUNE_CHUNK_SIZES = (512, 1024, 2048, 4096)
+    TUNE_LATENCIES = (1, 2, 4, 8, 16, 32)
+
     def __init__(self, device):
         """
             Create a new FTDI JTAG connection.
@@ -55,6 +64,24 @@ class PyFTDIAdapter(jtag):
         #... and store the newly created device.
         self.device = device
 
+        # Queue the MPSSE commands for a whole shift and send them all
+        # together instead of waiting on TDO after every op
+        self.batch = True
+
+        # Do not read back TDO of TMS commands outside of Shift-DR/IR
+        self.tms_write_only = False
+
+        # Idle clocks need the clock only commands of the H series
+        if not device.clock_only:
+            self.plan_ops = tuple(op for op in self.plan_ops if op != IDLE)
+
+        # TCK frequency limit, raised by the tuning profile of the board
+        self.max_freq = self.MAX_FREQ
+        profile = load_profile(self)
+        if profile is not None:
+            print('Loading tuning profile: {}'.format(profile))
+            self.set_tuning(profile)
+
         #Create a copy of the instruction register for this device.
         #self.ir = Bits('0b000000')
 
@@ -64,6 +91,63 @@ class PyFTDIAdapter(jtag):
         """
         self.verbosity_level = level
 
+    @property
+    def serial(self):
+        """
+            USB serial number of the board, None if it has none.
+        """
+        return self.device.serial
+
+    def get_tuning(self):
+        """
+            Return the settings the autotuner tunes, as a profile.
+        """
+        return {'frequency': self.max_freq,
+                'chunk_size': self.device.chunk_size,
+                'latency': self.device.latency_bulk}
+
+    def set_tuning(self, profile):
+        """
+            Take the settings of a profile, or of part of one.
+        """
+        if 'frequency' in profile:
+            self.max_freq = profile['frequency']
+            self.device.set_frequency(self.max_freq)
+        if 'chunk_size' in profile:
+            self.device.set_chunk_size(profile['chunk_size'])
+        if 'latency' in profile:
+            self.device.set_bulk_latency(profile['latency'])
+
+    def tune_candidates(self):
+        """
+            Return the settings the autotuner tries, by profile entry.
+            Frequencies double from MAX_FREQ up to what the FTDI clocks.
+        """
+        frequencies = []
+        frequency = self.MAX_FREQ
+        while frequency < self.device.frequency_max:
+            frequencies.append(frequency)
+            frequency *= 2
+        frequencies.append(self.device.frequency_max)
+        fifo = self.device.FTDI_WRITE_PIPE_LEN
+        return {'frequency': frequencies,
+                'chunk_size': [size for size in self.TUNE_CHUNK_SIZES if size <= fifo],
+                'latency': list(self.TUNE_LATENCIES)}
+
+    def set_streaming(self, enable):
+        """
+            Read back TDO in a thread of its own while the next commands
+            are written. See JtagController.set_streaming().
+        """
+        self.device.set_streaming(enable)
+
+    def read_stats(self):
+        """
+            Return the number of waves read back as polls and as bulk
+            transfers and the number of latency timer changes.
+        """
+        return self.device.read_stats()
+
 
     def set_frequency(self, frequncey):
         """
@@ -105,170 +189,26 @@ class PyFTDIAdapter(jtag):
         """
         return 8100
 
-    def send_data(self, tms_stream, tdi_stream):
+    def op_cost(self, kind, num_bits):
         """
-            Performs a general-purpose JTAG communication.
-
-            tms_stream -- The values to be transmitted over the Test Mode Select (TMS) line.
-            tdi_stream -- The values to be transmitted to the target device.
+            Bytes of MPSSE commands and TDO for an op of num_bits.
         """
+        (nbytes, nbits) = divmod(num_bits, 8)
+        if kind == TMS:
+            return 4*((num_bits+6)//7)
+        if kind == IDLE:
+            return 3*((nbytes+0xffff)//0x10000) + (2 if nbits else 0)
+
+        # A byte command and a bits command for the rest
+        cost = (3 if nbytes else 0) + (3 if nbits else 0)
+        if kind == SCAN:
+            return cost + 2*nbytes + (1 if nbits else 0)
+        elif kind == WRITE:
+            return cost + nbytes
+        else:
+            # TDI is set with SET_BITS_LOW
+            return cost + nbytes + (1 if nbits else 0) + 3
 
-        ## Check data sizes first
-        #@@@ if (tms_stream.len > self.max_byte_sizes[0]):
-        #@@@    raise ValueError('TMS bit stream size ({}) is too big for JTAG adapter (max: {})'.format(tms_stream.len,self.max_byte_sizes[0]))
-
-        ## Check TDI size against both TDI and TDO buffer sizes since the TDO stream size will equal the TDI input stream size.
-        #@@@if (tdi_stream.len > min(self.max_byte_sizes[1:3])):
-        #@@@    raise ValueError('TDI bit stream size ({}) is too big for JTAG adapter (max: {})'.format(tms_stream.len,min(self.max_byte_sizes[1:3])))
- 
-            
-        #Create a new bitstream object to store the result of the transmission.
-        tdo_stream = BitArray()
-
-        # Although the PyFTDI MPSSE mode is expected to be a
-        # significant performance improvement over GPIO mode, it does
-        # have an unfortunate complexity with how the TMS signal is
-        # handled.
-        #
-        # The shift: VCD command sends a TMS bit vector and a TDI bit
-        # vector of the same size so that each bit of TMS corresponds
-        # to each bit of TDI. However, TMS is only needed which
-        # changing the JTAG TAP state machine. So the FTDI MPSSE
-        # registers only accept up to 7 consecutive settings of TMS
-        # with a single TDI bit output for each TMS output. Since more
-        # than 5 consecutive TMS high means reset, this is not a
-        # limitation against JTAG but makes interfacing with XVCD a
-        # little more challenging.
-        #
-        # So this will have to be handled by searching for when TMS is
-        # a '1', breaking up the bitstring and sending in pieces to
-        # the JtagController so that TMS gets handled properly.
-        #
-        # Also, all of the Jtag functions are written with bits
-        # handled through the BitSequence object which appears to make
-        # the right-most bit in an array the lsb. This is opposite to
-        # the open source bitstring, which is used here and in lots of
-        # places. It has the lsb at the left-most bit in the array. So
-        # instead of bit swapping again for BitSequence, simply
-        # rewrite the worker functions from JtagController to use
-        # bitstring and to use different command opcodes to handle
-        # bitstrings properly.
-        
-
-        # First, search through TMS bit vector for the next '1'.
-        #
-        # Send out all of the TDI bits before TMS is '1'
-        #
-        # Grab the next section of bits where TMS is high plus it
-        # being low once and grab TDI when it is first low for it to
-        # be the TDI setting during the next sequence.
-        #
-        # Repeat until done
-
-        head = 0                # head of bit sequence of interest
-        while (head < len(tms_stream)):
-            # Find position of the next bit where TMS is '1'
-            tms1Find = tms_stream.find('0b1', start=head)
-
-            if tms1Find:
-                # If a '1' exists, save its bit position
-                tms1Pos = tms1Find[0]
-            else:
-                # Else, set its position to the end
-                tms1Pos = len(tms_stream)
-
-            # Handle the bit sequence where TMS is a '0' - focus on
-            # sending TDI out with TMS set to '0'.
-            #
-            # First, check that tms1Pos has advanced past head,
-            # otherwise, it is another segment where TMS is '1', so
-            # skip to below.
-            if (tms1Pos > head):
-                ## Handle TDI bits with TMS = '0'
-                #
-                if (self.verbosity_level >= 4):
-                    print('Bit Segment with TMS as "0": ', tms_stream[head:tms1Pos], 'Head: {} TMS1Pos:{} TMS Pos: {}'.format(head, tms1Pos, tms_stream.pos))
-
-                # Write out the TDI bits with TMS set to '0'
-                tdo_stream += self.device.write_tdi_read_tdo(tdi_stream[head:tms1Pos])
-
-            # Advance head to next bit segment. If completed all bits, break out of loop
-            head = tms1Pos
-            if head >= len(tms_stream):
-                break
-
-            # Find position of the next bit where TMS is '0'
-            tms0Find = tms_stream.find('0b0', start=head)
-
-            if tms0Find:
-                # If a '0' exists, save its bit position. Since we
-                # want the last TMS bit sent in this section to return
-                # to '0', increase the position by 1.
-                tms0Pos = tms0Find[0]+1
-            else:
-                # Else, found no '0' so set its position to the end
-                tms0Pos = len(tms_stream)
-                
-            # Handle the bit sequence where TMS is a '1' with a single
-            # '0' unless have reached the end of the bit sequence.
-            #
-            # Will send out TMS with TDI set to the value when TMS is
-            # '0'. If TMS as '0' was not found, set TDI to the last
-            # value given.
-            #
-            # First, check that tms0Pos has advanced past head,
-            # otherwise, it is another segment where TMS is '0', so
-            # skip to above.
-            while (tms0Pos > head):
-
-                # Can only write a maximum of 7 TMS bits so make this
-                # next segment a maximum of 7 bits and repeat until
-                # this TMS as "1" segment is sent.
-                tail = min(tms0Pos,head+7)
-
-                #@@@if (self.verbosity_level >= 1):
-                #    if (tdi_stream[head:tail] != Bits(int=0, length=(tail-head)) and
-                #        tdi_stream[head:tail] != Bits(int=-1, length=(tail-head))):
-                #        print('^^^ TDI Segment with TMS as "1" is not constant! TDI: ', tdi_stream[head:tail], ' TMS: ', tms_stream[head:tail])
-
-                # If TDI is not constant during this TMS is '1'
-                # segment, then break it up further so can send a
-                # static TDI.
-                #
-                # Find position of the next bit where TDI changes
-                tdiFind = tdi_stream.find(Bits(bool=not tdi_stream[head]), start=head, end=tail)
-                if tdiFind:
-                    # If TDI changed during this segment, then break
-                    # up the segment so that TDI does not change with
-                    # each write_tms_tdi_read_tdo() call
-                    tail = tdiFind[0]
-
-                if (self.verbosity_level >= 4):
-                    print('Bit Segment with TMS as "1": ', tms_stream[head:tail], 'Head: {} Tail: {} TMS0Pos:{} TMS Pos: {}'.format(head, tail, tms0Pos, tms_stream.pos))
-
-                # Check the assumption that TDI does not change during
-                # this bit sequence where TMS is a '1'. It should not
-                # since it is now checked above with find of
-                # tdi_stream
-                if (self.verbosity_level >= 3):
-                    if (tdi_stream[head:tail] != Bits(int=0, length=(tail-head)) and
-                        tdi_stream[head:tail] != Bits(int=-1, length=(tail-head))):
-                        print('TDI Segment with TMS as "1" is not constant! TDI: ', tdi_stream[head:tail], ' TMS: ', tms_stream[head:tail])
-                
-                # Write out the TMS bits with TDI set to the final bit
-                # in the sequence.
-                tdo_stream += self.device.write_tms_tdi_read_tdo(tms_stream[head:tail], tdi_stream[tail-1])
-
-                # Advance head to next bit segment.
-                head = tail
-
-            # If have sent all bits, head will equal len(tms_stream) and
-            # therefore will complete loop
-
-        #... return the values returned over TDO.
-        return tdo_stream
-
-    
     def set_program(self, value):
         """
             Set the value of the program pin. This will need to be designed on
@@ -282,6 +222,69 @@ class PyFTDIAdapter(jtag):
         """
         pass
 
+    def send_plan(self, ops, num_bits, tms, tdi, cached=None):
+        """
+            Queue the MPSSE commands for the ops and read back all of
+            their TDO at the end, or after every op if not batch.
 
+            With tms_write_only, TMS commands that clock no bit in
+            Shift-DR/IR are write-only.
 
+            The commands of a cached plan are recorded the first time,
+            when they fit in a single wave, and queued as they are after.
+        """
+
+        if cached is not None and self.batch:
+            context = (self.device.queue_context(), self.tms_write_only)
+            recording = cached.compiled.get(context)
+            if recording is not None:
+                self.device.queue_recording(recording)
+                (tdo, length) = self.device.flush_tdo()
+                return tdo.to_bytes((num_bits+7)//8, byteorder='little')
+            mark = self.device.mark_queue()
+
+        tdo = 0
+        for (kind, head, tail, state) in ops:
+            if kind == TMS:
+                # TDI is constant over the op, at most 7 bits per command
+                level = (tdi[head >> 3] >> (head & 7)) & 1
+                for start in range(head, tail, 7):
+                    stop = min(start+7, tail)
+                    state = self._queue_tms_chunk(state, vector_bits(tms, start, stop), stop-start, level)
+            elif kind == SCAN:
+                self.device.queue_tdi(vector_bits(tdi, head, tail), tail-head)
+            elif kind == WRITE:
+                self.device.queue_tdi(vector_bits(tdi, head, tail), tail-head, read=False)
+            elif kind == READ:
+                self.device.queue_read(tail-head, (tdi[head >> 3] >> (head & 7)) & 1)
+            else:
+                self.device.queue_clocks(tail-head)
 
+            if not self.batch:
+                (bits, length) = self.device.flush_tdo()
+                tdo |= bits << head
+
+        if self.batch:
+            if cached is not None:
+                recording = self.device.record_queue(mark)
+                if recording is not None:
+                    cached.compiled[context] = recording
+            (tdo, length) = self.device.flush_tdo()
+        return tdo.to_bytes((num_bits+7)//8, byteorder='little')
+
+    def _queue_tms_chunk(self, state, tms, length, tdi):
+        """
+            Queue a TMS command of length (< 8) bits that starts in state
+            and return the state it ends in. With tms_write_only, TDO is
+            only read back when one of the bits is clocked in Shift-DR/IR,
+            the only states where it is meaningful.
+        """
+        states = self.jtag_states
+        read = not self.tms_write_only
+        for k in range(length):
+            if state == self.SHIFT_DR or state == self.SHIFT_IR:
+                read = True
+            state = states[state][1 + ((tms >> k) & 1)]
+
+        self.device.queue_tms(tms, length, tdi, read)
+        return state
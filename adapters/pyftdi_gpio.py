@@ -21,17 +21,64 @@
 #
 #------------------------------------------------------------------------------
 
-import bitstring
-from bitstring import BitStream
-from adapters.jtag import jtag
+from adapters.bitbang import SyncBitbang, BitbangJtag
+
+from pyftdi.ftdi import Ftdi
 
 import usb
 import sys
 import struct
 import time
 
+# Synchronous bitbang mode, as Ftdi.BitMode of newer PyFTDI and the
+# BITMODE_ constants of older ones
+if hasattr(Ftdi, 'BitMode'):
+    BITMODE_SYNCBB = Ftdi.BitMode.SYNCBB
+else:
+    BITMODE_SYNCBB = Ftdi.BITMODE_SYNCBB
+
+
+class PyFTDISyncBitbang(SyncBitbang):
+    """
+        A SyncBitbang on a PyFTDI Ftdi.
+    """
+
+    # Lowest and highest bitbang rates, by whether the FTDI is of the
+    # H series, that the PyFTDI baud rate conversion takes: above the
+    # top it raises ValueError, below the bottom the divisor overflows
+    SAMPLE_RATES = {False: (16*184, 3000000), True: (5*733, 12000000)}
+
+    def __init__(self, ftdi, tck, tdi, tdo, tms, others=0):
+        """
+            ftdi -- The PyFTDI Ftdi of the port, opened in bitbang mode
+                    with the JTAG outputs as outputs.
+            tck, tdi, tdo, tms, others -- See SyncBitbang.
+        """
+        (tx, rx) = ftdi.fifo_sizes
+        super().__init__(tck, tdi, tdo, tms, min(tx, rx-2), others, ftdi.timeouts[0]/1000)
+        self.ftdi = ftdi
+
+    def start(self, direction, frequency):
+        """
+            Switch the port to synchronous bitbang with the pins of
+            direction as outputs and return the actual TCK frequency.
+        """
+        self.ftdi.set_bitmode(direction, BITMODE_SYNCBB)
+        self.ftdi.purge_buffers()
+        return self.set_frequency(frequency)
+
+    def set_sample_rate(self, rate):
+        (low, high) = self.SAMPLE_RATES[bool(self.ftdi.is_H_series)]
+        return self.ftdi.set_baudrate(min(max(rate, low), high))
+
+    def write_samples(self, samples):
+        self.ftdi.write_data(samples)
+
+    def read_samples(self, count):
+        return self.ftdi.read_data_bytes(count, 4)
+
 
-class PyFTDIGPIOAdapter(jtag):
+class PyFTDIGPIOAdapter(BitbangJtag):
     """ 
         A JTAG adapter for FTDI-based devices based on the python PyFTDI library and using GPIO mode.
         This primarily exists to compare against the original libftdi method which was GPIO only.
@@ -62,14 +109,6 @@ class PyFTDIGPIOAdapter(jtag):
         self.verbosity_level = level
 
 
-    def set_tck_period(self, period):
-        """
-            Handle the settck virtual cable command which requests a certain TCK period. Return the actual period.
-        """
-
-        ## Actual Period depends on many factors since this tries to simply go as fast as it can. So nothing to set. Respond that it goes at 100 Hz or 10e6 ns
-        return int(10e6)
-
     @property
     def max_byte_sizes(self):
         """Return the 3-tuple of maximum bytes from (TMS, TDI (output) and TDO (input))
@@ -90,42 +129,15 @@ class PyFTDIGPIOAdapter(jtag):
         """
         return 4096
 
-    
-    #def jtag_general(self, tms_stream, tdi_stream):
-    def send_data(self, tms_stream, tdi_stream):
-        """
-            Performs a general-purpose JTAG communication.
-
-            tms_stream -- The values to be transmitted over the Test Mode Select (TMS) line.
-            tdi_stream -- The values to be transmitted to the target device.
-        """
-        
-        #Create a new bitstream object to store the result of the transmission.
-        tdo_stream = BitStream()
-
-        #For each simulatenous pair of bits in the transmission...
-        for (tms, tdi) in zip(tms_stream, tdi_stream):
-
-            #...perform the core transmission...
-            tdo = self.tick(tms, tdi)
-
-            #... and add the result to our resultant stream.
-            tdo_stream += BitStream(bool=tdo)
-
-            #Track where we are the JTAG state machine, in case TMS changes.
-            self.track_tms(tms)
-
-        #... return the values returned over TDO.
-        return tdo_stream
-
 
-    def tick(self, tms, tdi, clock_delays = 0):
+    def tick(self, tms, tdi, clock_delays = 0, read=True):
         """
             Sets the values of the TMS and TDI lines for a single cycle of JTAG communication,
             and samples TDO at the appropriate time.
 
             tms: The value of TMS.
             tdi: The value of TDI.
+            read: Sample TDO. If False, TDO is returned as False.
         """
 
         # Apply a falling edge of the clock
@@ -141,7 +153,7 @@ class PyFTDIGPIOAdapter(jtag):
 
         #Apply a rising edge, and sample the input.
         self.set_tck(True);
-        tdo = self.get_tdo()
+        tdo = self.get_tdo() if read else False
 
         #If requested, wait.
         if clock_delays:
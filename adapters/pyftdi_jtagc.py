@@ -52,10 +52,20 @@ from sys import modules, stdout
 from array import array
 from pyftdi.ftdi import Ftdi
 from pyftdi import FtdiLogger
-from threading import Lock
+from threading import Condition, Lock, Thread
+from collections import deque
 import logging
+import usb.core
+import usb.util
 
-from bitstring import BitStream, BitArray, Bits
+from adapters.bitvector import BitVector
+
+# Byte with its bit order reversed, for translating between the lsb
+# first bit vectors of XVC and the MSB first MPSSE commands
+BIT_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+# Byte as it is, the translation for the LSB first MPSSE commands
+BIT_KEEP = bytes(range(256))
 
 class JtagError(Exception):
     """Generic JTAG error"""
@@ -76,14 +86,31 @@ class JtagController:
     
     FTDI_WR_BUFFER_MAX_LEN = 0 # maximum byte length of write data to FTDI
     FTDI_RD_BUFFER_MAX_LEN = 0 # maximum byte length of read data from FTDI
+
+    # Read regimes of a wave, see _set_regime(). A poll returns at most
+    # the TDO of a full speed USB packet and its commands are written in
+    # one go. It is read back with the latency timer at its minimum so
+    # that it turns around in about a millisecond. Anything larger is a
+    # bulk transfer, left to the FTDI to send back in full packets.
+    POLL = 'poll'
+    BULK = 'bulk'
+    POLL_MAX_RLEN = 62
+    LATENCY_POLL = 1        # ms
+    LATENCY_BULK = 16       # ms, the FTDI default
+    # Empty packets that read_data_bytes() takes before returning to
+    # _read_tdo(), which then gives up after the USB read timeout
+    # without any TDO coming in
+    READ_ATTEMPTS = {POLL: 1, BULK: 4}
     
     # Private API
-    def __init__(self, trst=False, frequency=3.0E6, usb_read_timeout=5000, usb_write_timeout=5000, debug=False):
+    def __init__(self, trst=False, frequency=3.0E6, usb_read_timeout=5000, usb_write_timeout=5000, debug=False, ftdi=None):
         """
         trst uses the nTRST optional JTAG line to hard-reset the TAP
           controller
+        ftdi is the Ftdi to use instead of a new one, such as an
+          EmulatedFtdi
         """
-        self._ftdi = Ftdi()
+        self._ftdi = ftdi or Ftdi()
         self._lock = Lock()
         self._ftdi.timeouts = (usb_read_timeout, usb_write_timeout)
         self._trst = trst
@@ -103,6 +130,51 @@ class JtagController:
         self._last = None  # Last deferred TDO bit
         self._write_buff = array('B')
         self._debug = debug
+        # TMS is only driven by the TMS commands and holds its last
+        # value during data commands, so keep track of it
+        self._tms_level = bool(self.initialout & JtagController.TMS_BIT)
+        # Level TDI was last set to with SET_BITS_LOW, or None once a
+        # command wrote other TDI bits
+        self._tdi_level = None
+        # Commands queued by the queue_*() functions wait here until
+        # flush_read_tdo() is called. _batch_plan holds a (kind,
+        # length) entry for every queued command that returns TDO and
+        # _batch_rlen is the number of TDO bytes they will return.
+        self._batch_plan = []
+        self._batch_rlen = 0
+        self._batch_tdo = 0
+        self._batch_tdo_len = 0
+        # Number of writes by sync(), see mark_queue()
+        self._syncs = 0
+        # Waves hold at most _wave_rlen bytes of TDO, see set_streaming()
+        self._wave_rlen = 0
+        # Read regime of the last wave and latency timer in ms, see
+        # _set_regime(), and the number of syncs when the wave started
+        self._regime = self.POLL
+        self._latency = self.LATENCY_POLL
+        self.latency_bulk = self.LATENCY_BULK
+        # USB transfer size of the writes and reads, see set_chunk_size()
+        self.chunk_size = 0
+        # Whether the device has the clock only commands of the H series
+        self.clock_only = True
+        self._wave_syncs = 0
+        # Counters of the waves read back in each regime and of the
+        # latency timer changes, see read_stats()
+        self.regime_waves = {self.POLL: 0, self.BULK: 0}
+        self.latency_changes = 0
+        # Streaming, see set_streaming(). _stream_waves holds the
+        # (plan, TDO byte count, read regime) of the written waves that the reader
+        # thread has not decoded yet and _stream_rlen the number of TDO
+        # bytes it has yet to read. All of them are guarded by
+        # _stream_cv.
+        self._stream_thread = None
+        self._stream_cv = Condition()
+        self._stream_waves = deque()
+        self._stream_rlen = 0
+        self._stream_stop = False
+        self._stream_error = None
+        # Bit order of the data commands, see set_lsb_first()
+        self.set_lsb_first(True)
         
     # Public API
     def configure(self, url):
@@ -123,7 +195,7 @@ class JtagController:
 
         with self._lock:
             self._ftdi.open_mpsse_from_url(
-                url, direction=self.direction, frequency=self._frequency, debug=self._debug, latency=12) # @@@@@
+                url, direction=self.direction, frequency=self._frequency, debug=self._debug, latency=self._latency)
             self._ftdi_opened = True
 
             # FTDI requires to initialize all GPIOs before MPSSE kicks in
@@ -136,6 +208,10 @@ class JtagController:
             # Set the FTDI read/write chunksizes to be the same as the FTDI FIFO lengths
             self._ftdi.write_data_set_chunksize(self.FTDI_WRITE_PIPE_LEN)
             self._ftdi.read_data_set_chunksize(self.FTDI_READ_PIPE_LEN)
+            self.chunk_size = self.FTDI_WRITE_PIPE_LEN
+
+            # The FT2232D and other older MPSSEs clock TCK with data only
+            self.clock_only = self._ftdi.is_H_series
 
             # "-3" on self.FTDI_WRITE_PIPE_LEN accounts for the command
             # byte plus 2 length bytes which must also fit in the WRITE
@@ -147,9 +223,11 @@ class JtagController:
             # read_bytes function. They are still taking up space in the
             # FTDI's READ FIFO.
             self.FTDI_RD_BUFFER_MAX_LEN = self.FTDI_READ_PIPE_LEN-2
+            self._wave_rlen = self.FTDI_RD_BUFFER_MAX_LEN
 
 
     def close(self):
+        self.set_streaming(False)
         if self._ftdi_opened:
             self._ftdi.close()
             self._ftdi_opened = False
@@ -163,6 +241,43 @@ class JtagController:
 
         return self._ftdi.set_frequency(self._frequency)
 
+    @property
+    def frequency(self):
+        """Last TCK frequency asked for with set_frequency()"""
+        return self._frequency
+
+    @property
+    def frequency_max(self):
+        """Highest TCK frequency the FTDI device can clock"""
+        return self._ftdi.frequency_max
+
+    @property
+    def serial(self):
+        """USB serial number of the FTDI device, None if it has none"""
+        try:
+            dev = self._ftdi.usb_dev
+            return usb.util.get_string(dev, dev.iSerialNumber) or None
+        except (AttributeError, ValueError, usb.core.USBError):
+            return None
+
+    def set_chunk_size(self, size):
+        """Set the size of the USB transfers the commands are written
+        and the TDO is read back in, at most the FIFO size"""
+        self._flush_wave()
+        self._ftdi.write_data_set_chunksize(size)
+        self._ftdi.read_data_set_chunksize(size)
+        self.chunk_size = size
+
+    def set_bulk_latency(self, latency):
+        """Set the latency timer of bulk waves, in ms, see
+        _set_regime()"""
+        self._flush_wave()
+        self.latency_bulk = latency
+        if self._regime == self.BULK and latency != self._latency:
+            self._ftdi.set_latency_timer(latency)
+            self._latency = latency
+            self.latency_changes += 1
+
     @property
     def max_byte_sizes(self):
         """Return the 3-tuple of maximum bytes from (TMS, TDI (output) and TDO (input))
@@ -176,19 +291,84 @@ class JtagController:
         ## will handle it.
         return (self.FTDI_WR_BUFFER_MAX_LEN, self.FTDI_WR_BUFFER_MAX_LEN, self.FTDI_RD_BUFFER_MAX_LEN)
 
+    def set_streaming(self, enable):
+        """Read back TDO in a reader thread that runs alongside the
+        writes, so that the commands of the next wave are written while
+        the TDO of the previous one is read back, instead of waiting for
+        the TDO of every wave before writing the next.
+
+        Waves are then limited to half of the Read FIFO, and a wave is
+        only written once the TDO still owed by the previous ones leaves
+        room for it, so the Read FIFO never holds more than
+        FTDI_RD_BUFFER_MAX_LEN bytes."""
+        if enable == (self._stream_thread is not None):
+            return
+
+        # Let the current mode finish with the commands already queued
+        self._flush_wave()
+        if enable:
+            self._stream_stop = False
+            self._stream_thread = Thread(target=self._stream_reader, name='xvcd-tdo-reader', daemon=True)
+            self._stream_thread.start()
+            self._wave_rlen = max(self.FTDI_RD_BUFFER_MAX_LEN//2, 1)
+        else:
+            self._wait_stream()
+            with self._stream_cv:
+                self._stream_stop = True
+                self._stream_cv.notify_all()
+            self._stream_thread.join()
+            self._stream_thread = None
+            self._wave_rlen = self.FTDI_RD_BUFFER_MAX_LEN
+
+    def set_lsb_first(self, enable):
+        """Shift TDI and TDO with the LSB first MPSSE commands, which
+        take the bytes of the XVC vectors and return TDO bytes in the
+        same layout, or with the MSB first ones, for which every byte is
+        bit reversed through BIT_REVERSE on the way in and out. Only
+        call it with no commands queued."""
+        self.lsb_first = enable
+        if enable:
+            self._rw_bytes = Ftdi.RW_BYTES_PVE_NVE_LSB
+            self._rw_bits = Ftdi.RW_BITS_PVE_NVE_LSB
+            self._write_bytes = Ftdi.WRITE_BYTES_NVE_LSB
+            self._write_bits = Ftdi.WRITE_BITS_NVE_LSB
+            self._read_bytes = Ftdi.READ_BYTES_PVE_LSB
+            self._bit_order = BIT_KEEP
+            self._bytes_kind = 'lsb-bytes'
+            self._bits_kind = 'lsb-bits'
+        else:
+            self._rw_bytes = Ftdi.RW_BYTES_PVE_NVE_MSB
+            self._rw_bits = Ftdi.RW_BITS_PVE_NVE_MSB
+            self._write_bytes = Ftdi.WRITE_BYTES_NVE_MSB
+            self._write_bits = Ftdi.WRITE_BITS_NVE_MSB
+            self._read_bytes = Ftdi.READ_BYTES_PVE_MSB
+            self._bit_order = BIT_REVERSE
+            self._bytes_kind = 'bytes'
+            self._bits_kind = 'bits'
+
+    def read_stats(self):
+        """Return the number of waves read back as polls and as bulk
+        transfers and the number of latency timer changes"""
+        return (self.regime_waves[self.POLL], self.regime_waves[self.BULK], self.latency_changes)
+
     def purge(self):
         self._ftdi.purge_buffers()
 
-    ## Write out the data and clear the internal buffer for more data
-    def sync(self):
+    ## Write out the data and clear the internal buffer for more data.
+    ## Without immediate, the FTDI is left to send back the TDO of the
+    ## commands when it has a full packet of it or the latency timer
+    ## runs out.
+    def sync(self, immediate=True):
         if not self._ftdi:
             raise JtagError("FTDI controller terminated")
         if self._write_buff:
             try:
                 with self._lock:
-                    self._write_buff.extend(self._immediate)
+                    if immediate:
+                        self._write_buff.extend(self._immediate)
                     self._ftdi.write_data(self._write_buff)
                     self._write_buff = array('B')
+                    self._syncs += 1
             except usb.core.USBError:
                 pass            # FTDI should be catching the error
 
@@ -200,184 +380,427 @@ class JtagController:
             raise TypeError('Expect a byte array')
         if not self._ftdi:
             raise JtagError("FTDI controller terminated")
-        # Currrent buffer + new command + send_immediate
+        # Currrent buffer + new command + send_immediate. The TDO of
+        # the wave is only read once it is all written, so let the FTDI
+        # fill full packets with it until then.
         if (len(self._write_buff)+len(cmd)+1) >= self.FTDI_WRITE_PIPE_LEN:
-            self.sync()
+            self.sync(immediate=False)
         self._write_buff.extend(cmd)
 
 
     def write_tms_tdi_read_tdo(self, tms, tdi):
         """Write out TMS bits while holding TDI constant and reading back in TDO"""
-        if not (isinstance(tms, BitStream) or isinstance(tms, BitArray)):
-            raise JtagError('Expect a BitStream or BitArray')
-        length = len(tms)
-        if not (0 < length < 8):
-            raise JtagError('Invalid TMS length')
-        tms.reverse()           # must reverse bits since only lsb write seems to be supported
-        tms.prepend(8-len(tms)) # prepend 0's to be 8 bits long
-
-        # left-most bit will be for TDI
-        if isinstance(tdi, BitStream) or isinstance(tdi, BitArray):
-            tms[0] = tdi[0]
-        elif isinstance(tdi, bool):
-            tms[0] = tdi            
-        else:
-            raise JtagError('Incorrect type for tdi - must be BitStream, BitArray or bool')
-        
-        # apply the last TDI bit
-        #@@@if self._last is not None:
-        #@@@    out[7] = self._last
-        # print("TMS", tms, (self._last is not None) and 'w/ Last' or '')
-        # reset last bit
-        #@@@self._last = None
-
-        ## Send the byte to the FTDI
-        cmd = array('B', (Ftdi.RW_BITS_TMS_PVE_NVE, length-1, tms.uint))
-        self._stack_cmd(cmd)
-        self.sync()
+        if not isinstance(tms, BitVector):
+            raise JtagError('Expect a BitVector')
 
-        ## Read the response from FTDI
-        data = self._ftdi.read_data_bytes(1, 4)
-        if (len(data) != 1):
-            raise JtagError('Not all data read! Expected {} bytes but only read {} bytes'.format(1,len(data)))
-
-        tdo = BitArray(data)
-
-        # FTDI handles returned LSB bit data by putting the first bit
-        # in bit 7 and shifting to the right with every new bit. So
-        # the first bit clocked will be in the lowest bit number, but
-        # which bit number it will be in depends on how many bits
-        # clocked. [It is kinda stupid, if you ask me. I think the bit
-        # order should be the same as tehe bit written, but they
-        # aren't.]
-        tdo = tdo[:length]
-        
-        # return to bitstring bit ordering with left-most bit the lsb
-        tdo.reverse()
-        return tdo
+        # TDI is either a bool or the first bit of a BitVector
+        if isinstance(tdi, BitVector):
+            tdi = tdi[0]
+        elif not isinstance(tdi, bool):
+            raise JtagError('Incorrect type for tdi - must be BitVector or bool')
+
+        self.queue_tms(tms.to_int(), len(tms), tdi)
+        return self.flush_read_tdo()
 
     def write_tdi_read_tdo(self, out, use_last=False):
         """ Output a sequence of bits to TDI while reading the TDO input bits. Automatically break any byte writes based on adapter FIFO sizes. """
 
-        if not (isinstance(out, BitStream) or isinstance(out, BitArray)):
-            raise JtagError('Expect a BitStream or BitArray')
+        if not isinstance(out, BitVector):
+            raise JtagError('Expect a BitVector')
 
         ## @@@ Not used at the moment
         #if use_last:
         #    #(out, self._last) = (out[:-1], bool(out[-1]))
         #    self._last = out[-1]
 
-        byte_count = out.len//8
-        pos = 8*byte_count
-        bit_count = out.len-pos
+        # queue_tdi() separates the bits into BYTE and BIT commands,
+        # in as many waves as the Read FIFO needs
+        self.queue_tdi(out.to_int(), len(out))
+        return self.flush_read_tdo()
+
+    def queue_tms_tdi_read_tdo(self, tms, tdi):
+        """Queue TMS bits while holding TDI constant. Same as
+        write_tms_tdi_read_tdo() but TDO is only returned by
+        flush_read_tdo()"""
+        self.queue_tms(tms.to_int(), len(tms), tdi)
+
+    def queue_tdi_read_tdo(self, out):
+        """Queue a sequence of TDI bits with TMS at '0'. Same as
+        write_tdi_read_tdo() but TDO is only returned by
+        flush_read_tdo()"""
+        if len(out):
+            self.queue_tdi(out.to_int(), len(out))
+
+    def flush_read_tdo(self):
+        """Send all of the queued commands and return the TDO bits of
+        all of them as a single BitVector"""
+        (tdo, length) = self.flush_tdo()
+        return BitVector.from_int(tdo, length)
+
+    # The queue_tms()/queue_tdi()/flush_tdo() functions work on bit
+    # vectors held in an integer with the first bit as the lsb, which
+    # is the bit order of the vectors in the XVC shift: command.
+
+    def queue_tms(self, tms, length, tdi, read=True):
+        """Queue length TMS bits (first bit in the lsb of tms) while
+        holding TDI constant. With read False, a write-only command is
+        used and the TDO bits are returned as '0's."""
+        if not (0 < length < 8):
+            raise JtagError('Invalid TMS length')
 
-        # Separate into BYTE and BIT commands
-        tdo = BitArray()
-        if byte_count:
-            ## Since TDO bit length will be equal to TDI bit length,
-            ## set max_rw_bits to the minimum of the TDI or TDO bit
-            ## sizes.
-            max_rw_bits = min(self.max_byte_sizes[1:3])*8
-
-            # Start head and tail at the beginning bit index
-            head = 0
-            tail = 0
-
-            #@@@while(tdo.len//8 < byte_count):
-            while(head < pos):
-                # Set tail to either be the maximum bytes to
-                # read/write or the final bit, pos, whichever is
-                # smaller. These are bit indexes.
-                tail = min((head+max_rw_bits),pos)
-                tdo += self._write_read_bytes(out[head:tail])
-                head = tail
+        # TMS bits are sent lsb first, TDI is held at the level of bit 7
+        tms_byte = tms & ((1 << length)-1)
+        if tdi:
+            tms_byte |= 0x80
 
-        if bit_count:
-            # Do not have to deal with bit length here because already know bit_count is b/w 0 and 7
-            tdo += self._write_read_bits(out[pos:])
+        if read:
+            self._queue_cmd(array('B', (Ftdi.RW_BITS_TMS_PVE_NVE, length-1, tms_byte)), 'tms', length, 1)
+        else:
+            self._queue_cmd(array('B', (Ftdi.WRITE_BITS_TMS_NVE, length-1, tms_byte)), 'skip', length, 0)
+        self._tms_level = bool((tms >> (length-1)) & 1)
 
-        return tdo
+    def queue_tdi(self, out, length, read=True):
+        """Queue length TDI bits (first bit in the lsb of out) with TMS
+        at '0'. With read False, the bits are sent with write-only
+        commands, which need no room in the Read FIFO, and their TDO is
+        returned as '0's."""
 
-    def _write_read_bits(self, out):
-        """Output bits on TDI while reading TDO bits in"""
+        if self._tms_level and length:
+            # TMS was left high by the last TMS command, so clock the
+            # first bit with a TMS command to bring TMS back to '0'
+            self.queue_tms(0, 1, out & 1)
+            out >>= 1
+            length -= 1
 
-        # a bitstring.BitStream() has first bit in left-most array position (ie. msb first)
-        length = out.len
-        byte = BitArray(out)    # copy out so can modify it
-        byte.append(8-length)   # pad 0's to be 8 bits long
+        byte_count = length//8
+        data = (out & ((1 << length)-1)).to_bytes(byte_count+1, byteorder='little')
 
-        # Check number of bits.
-        if not (0 < length <= 8):
-            raise JtagError('Wrong number of bits: {}'.format(length))
+        if not read:
+            self._queue_tdi_write_only(data, length)
+            return
 
-        #@@@#print('out: ', out, 'length: ', length, 'byte: ', byte, 'byte as uint: ', byte.uint)
-        
-        # length of 0 for 1 bit, length of 7 for 8 bits, etc.
-        cmd = array('B', (Ftdi.RW_BITS_PVE_NVE_MSB, length-1, byte.uint))
+        self._queue_rw_bytes(data, 0, byte_count)
 
-        #@@@#print('cmd: ', cmd)
-        
-        self._stack_cmd(cmd)
-        self.sync()
-        
-        data = self._ftdi.read_data_bytes(1, 4)
-        if (len(data) != 1):
-            raise JtagError('Not all data read! Expected {} bytes but only read {} bytes'.format(1,len(data)))
+        bit_count = length-8*byte_count
+        if bit_count:
+            # MSB first commands take the first bit in bit 7
+            byte = self._bit_order[data[byte_count]]
+            self._queue_cmd(array('B', (self._rw_bits, bit_count-1, byte)), self._bits_kind, bit_count, 1)
 
-        tdo = BitArray(data)
+    def queue_read(self, length, tdi):
+        """Queue length bits with TMS at '0' and TDI held at tdi. Whole
+        bytes are clocked with read-only commands, which saves sending
+        their TDI, as when reading back CFG_OUT or ILA data."""
 
-        # Only pass back the same number of bits as clocked
-        # out. Although MSB, a MSB bit read left shifts the bits
-        # starting at bit 0. So it is right shifted MSB from reads by
-        # left shifted MSB on bit writes. (Go Fugure?)
-        tdo = tdo[8-length:]
-        return tdo
+        if self._tms_level and length:
+            # Same as in queue_tdi()
+            self.queue_tms(0, 1, tdi)
+            length -= 1
 
-    def _write_read_bytes(self, out):
-        """Output bytes on TDI while reading TDO bits in"""
+        byte_count = length//8
+        if byte_count:
+            self._queue_read_bytes(byte_count, bool(tdi))
 
-        # a bitstring.BitStream() has first bit in left-most array position (ie. msb first)
-        bytes_ = out.bytes
-        
-        olen = len(bytes_)
-        #print("WRITE {} BYTES: 0x{}".format(olen, bytes_.hex()))
-        #print("WRITE {} BYTES".format(olen))
-
-        # Check number of bits.
-        #
-        # If this function was a write-only function, could smartly
-        # handle writing more bytes than will fit into the write FIFO
-        # by sending them in waves. However, this function writes and
-        # reads the same number of bytes. So the byte length of the
-        # out vector must be less than the size of both the Write and
-        # Read FIFO.
-        #
-        # What's more, when writing, also need to write a command byte
-        # and two length bytes. So account for them as well so that
-        # the entire write will fit in the Write FIFO. This makes it
-        # so that there is a USB read for every USB write. May not be
-        # completely necessary but seems to be a little more
-        # efficient.
-        #
-        if olen > self.FTDI_RD_BUFFER_MAX_LEN:
-            raise JtagError("Byte length of Read data ({}) is larger than Read buffer ({})".format(olen, self.FTDI_RD_BUFFER_MAX_LEN))
-        if olen > self.FTDI_WR_BUFFER_MAX_LEN:
-            raise JtagError("Byte length of Write data ({}) is larger then Write Buffer ({})".format(olen, self.FTDI_WR_BUFFER_MAX_LEN))
-
-        # The byte length to pass to the MPSSE is -1 the actual length, LSB first
-        cmd = array('B', (Ftdi.RW_BYTES_PVE_NVE_MSB, (olen-1) & 0xff,
-                          ((olen-1) >> 8) & 0xff))
-        cmd.extend(bytes_)
+        bit_count = length-8*byte_count
+        if bit_count:
+            byte = 0xff if tdi else 0
+            self._queue_cmd(array('B', (self._rw_bits, bit_count-1, byte)), self._bits_kind, bit_count, 1)
+
+    def _queue_rw_bytes(self, data, head, end):
+        """Queue bytes head to end-1 of data, in the XVC layout, with
+        write and read commands"""
+        while (head < end):
+            # Split the bytes so that the TDO of each wave of commands
+            # fits in the Read FIFO.
+            room = self._wave_rlen - self._batch_rlen
+            if not room:
+                self._flush_wave()
+                continue
+
+            olen = min(room, end-head)
+            cmd = array('B', (self._rw_bytes, (olen-1) & 0xff,
+                              ((olen-1) >> 8) & 0xff))
+            cmd.frombytes(data[head:head+olen].translate(self._bit_order))
+            self._queue_cmd(cmd, self._bytes_kind, 8*olen, olen)
+            head += olen
+
+    def _queue_read_bytes(self, count, tdi):
+        """Queue count bytes of TDI held at tdi with read-only commands"""
+        if self._tdi_level != tdi:
+            # TCK low, TMS at its current level and TDI at tdi
+            value = self.initialout & ~(self.TCK_BIT | self.TDI_BIT | self.TMS_BIT)
+            if tdi:
+                value |= self.TDI_BIT
+            if self._tms_level:
+                value |= self.TMS_BIT
+            self._stack_cmd(array('B', (Ftdi.SET_BITS_LOW, value, self.direction)))
+            self._tdi_level = tdi
+
+        head = 0
+        while (head < count):
+            room = self._wave_rlen - self._batch_rlen
+            if not room:
+                self._flush_wave()
+                continue
+
+            olen = min(room, count-head)
+            cmd = array('B', (self._read_bytes, (olen-1) & 0xff,
+                              ((olen-1) >> 8) & 0xff))
+            self._queue_cmd(cmd, self._bytes_kind, 8*olen, olen, writes=False)
+            head += olen
+
+    def queue_clocks(self, length):
+        """Queue length TCK cycles with TMS at '0' that neither write
+        TDI nor read TDO. Their TDO is returned as '0's. Devices without
+        the clock only commands write '0's to TDI instead."""
+
+        if self._tms_level and length:
+            # Same as in queue_tdi()
+            self.queue_tms(0, 1, False)
+            length -= 1
+
+        if not self.clock_only:
+            self._queue_tdi_write_only(bytes((length+7)//8), length)
+            return
+
+        byte_count = length//8
+        for head in range(0, byte_count, 0x10000):
+            olen = min(0x10000, byte_count-head)
+            cmd = array('B', (Ftdi.CLK_BYTES_NO_DATA, (olen-1) & 0xff, ((olen-1) >> 8) & 0xff))
+            self._queue_cmd(cmd, 'skip', 8*olen, 0, writes=False)
+
+        bit_count = length-8*byte_count
+        if bit_count:
+            self._queue_cmd(array('B', (Ftdi.CLK_BITS_NO_DATA, bit_count-1)), 'skip', bit_count, 0, writes=False)
+
+    def _queue_tdi_write_only(self, data, length):
+        """Queue the first length bits of data, in the XVC layout, with
+        write-only commands"""
+        byte_count = length//8
+        for head in range(0, byte_count, self.FTDI_WR_BUFFER_MAX_LEN):
+            olen = min(self.FTDI_WR_BUFFER_MAX_LEN, byte_count-head)
+            cmd = array('B', (self._write_bytes, (olen-1) & 0xff,
+                              ((olen-1) >> 8) & 0xff))
+            cmd.frombytes(data[head:head+olen].translate(self._bit_order))
+            self._queue_cmd(cmd, 'skip', 8*olen, 0)
+
+        bit_count = length-8*byte_count
+        if bit_count:
+            byte = self._bit_order[data[byte_count]]
+            self._queue_cmd(array('B', (self._write_bits, bit_count-1, byte)), 'skip', bit_count, 0)
+
+    def queue_context(self):
+        """Return what the commands queued next depend on besides their
+        arguments, for keeping recordings from record_queue()"""
+        return (self._tms_level, self._tdi_level, self.lsb_first, self._wave_rlen)
+
+    def mark_queue(self):
+        """Mark the end of the commands queued so far, for
+        record_queue()"""
+        return (self._syncs, len(self._write_buff), len(self._batch_plan), self._batch_rlen)
+
+    def record_queue(self, mark):
+        """Return a recording of the commands queued since mark, from
+        mark_queue(), that queue_recording() queues again without
+        building them. None if some of them were already sent."""
+        (syncs, wlen, plen, rlen) = mark
+        if syncs != self._syncs:
+            return None
+        return (self._write_buff[wlen:].tobytes(), tuple(self._batch_plan[plen:]),
+                self._batch_rlen - rlen, self._tms_level, self._tdi_level)
+
+    def queue_recording(self, recording):
+        """Queue the commands of a recording from record_queue(), made
+        with the same queue_context()"""
+        (cmds, plan, rlen, tms_level, tdi_level) = recording
+        if self._batch_rlen + rlen > self._wave_rlen:
+            self._flush_wave()
+        if (len(self._write_buff)+len(cmds)+1) >= self.FTDI_WRITE_PIPE_LEN:
+            self.sync(immediate=False)
+        self._write_buff.frombytes(cmds)
+        self._batch_plan.extend(plan)
+        self._batch_rlen += rlen
+        self._tms_level = tms_level
+        self._tdi_level = tdi_level
+
+    def flush_tdo(self):
+        """Send all of the queued commands and return a tuple of the TDO
+        bits (first bit in the lsb) and their number"""
+        self._flush_wave()
+        self._wait_stream()
+        tdo = (self._batch_tdo, self._batch_tdo_len)
+        self._batch_tdo = 0
+        self._batch_tdo_len = 0
+        return tdo
+
+    def _queue_cmd(self, cmd, kind, length, rlen, writes=True):
+        """Stack a command returning rlen bytes of TDO, first sending
+        the already queued commands if the TDO would no longer fit in
+        the Read FIFO. writes is False for commands that leave TDI
+        alone."""
+        if self._batch_rlen + rlen > self._wave_rlen:
+            self._flush_wave()
+        if writes:
+            self._tdi_level = None
         self._stack_cmd(cmd)
+        self._batch_plan.append((kind, length))
+        self._batch_rlen += rlen
+
+    def _flush_wave(self):
+        """Write out the stacked commands, read back all of their TDO
+        bytes with a single read and slice the TDO bits out of them.
+        When streaming, the reader thread does the reading instead."""
+        if self._batch_plan:
+            self._set_regime()
         self.sync()
-
-        data = self._ftdi.read_data_bytes(olen, 4)
-        if (len(data) != olen):
-            raise JtagError('Not all data read! Expected {} bytes but only read {} bytes'.format(olen,len(data)))
-
-        #print("READ {} BYTES:  0x{}".format(len(data), data.tobytes().hex()))
-        #print("READ {} BYTES".format(len(data)))
-
-        return BitArray(data)
-
-
+        self._wave_syncs = self._syncs
+        if not self._batch_plan:
+            return
+
+        if self._stream_thread is not None:
+            self._post_wave()
+            return
+
+        olen = self._batch_rlen
+        data = b''
+        if olen:
+            data = self._read_tdo(olen, self._regime)
+
+        self._decode_wave(self._batch_plan, data)
+        self._batch_plan = []
+        self._batch_rlen = 0
+
+    def _set_regime(self):
+        """Pick the read regime of the wave about to be written out and
+        set the latency timer for it, if it is not already. Only done
+        when the regime changes, as it takes a USB control transfer."""
+        if self._batch_rlen <= self.POLL_MAX_RLEN and self._syncs == self._wave_syncs:
+            (regime, latency) = (self.POLL, self.LATENCY_POLL)
+        else:
+            (regime, latency) = (self.BULK, self.latency_bulk)
+        self._regime = regime
+        self.regime_waves[regime] += 1
+        if latency != self._latency:
+            self._ftdi.set_latency_timer(latency)
+            self._latency = latency
+            self.latency_changes += 1
+
+    def _decode_wave(self, plan, data):
+        """Slice the TDO bits of the commands in plan out of data, the
+        TDO bytes they returned, and add them to the batch TDO"""
+        tdo = self._batch_tdo
+        tdo_len = self._batch_tdo_len
+        pos = 0
+        for (kind, length) in plan:
+            # See queue_tms() and queue_tdi() for the commands. The
+            # FTDI puts the first TDO bit of a TMS or LSB first bits
+            # command in bit 8-length, of a MSB first bits command in
+            # bit length-1 and reads bytes in the bit order of the
+            # command. Write-only commands read nothing.
+            if kind == 'skip':
+                tdo_len += length
+                continue
+            elif kind == 'lsb-bytes':
+                nbytes = length//8
+                bits = int.from_bytes(data[pos:pos+nbytes], byteorder='little')
+                pos += nbytes
+            elif kind == 'bytes':
+                nbytes = length//8
+                bits = int.from_bytes(data[pos:pos+nbytes].translate(BIT_REVERSE), byteorder='little')
+                pos += nbytes
+            elif kind == 'tms' or kind == 'lsb-bits':
+                bits = data[pos] >> (8-length)
+                pos += 1
+            else:
+                bits = BIT_REVERSE[data[pos] & ((1 << length)-1)] >> (8-length)
+                pos += 1
+            tdo |= bits << tdo_len
+            tdo_len += length
+
+        self._batch_tdo = tdo
+        self._batch_tdo_len = tdo_len
+
+    def _post_wave(self):
+        """Hand the written wave over to the reader thread, then wait
+        until the Read FIFO has room for the TDO of the next one"""
+        limit = self.FTDI_RD_BUFFER_MAX_LEN - self._wave_rlen
+        with self._stream_cv:
+            self._stream_waves.append((self._batch_plan, self._batch_rlen, self._regime))
+            self._stream_rlen += self._batch_rlen
+            self._stream_cv.notify_all()
+            self._stream_cv.wait_for(lambda: self._stream_error or self._stream_rlen <= limit)
+        self._batch_plan = []
+        self._batch_rlen = 0
+        self._raise_stream_error()
+
+    def _wait_stream(self):
+        """Wait for the reader thread to decode all of the posted waves"""
+        if self._stream_thread is None:
+            return
+        with self._stream_cv:
+            self._stream_cv.wait_for(lambda: self._stream_error or not self._stream_waves)
+        self._raise_stream_error()
+
+    def _raise_stream_error(self):
+        """Raise the error the reader thread stopped on, if any. The
+        TDO of the shift is lost, so the batch starts over."""
+        error = self._stream_error
+        if error is None:
+            return
+        with self._stream_cv:
+            self._stream_error = None
+            self._stream_waves.clear()
+            self._stream_rlen = 0
+        self._batch_tdo = 0
+        self._batch_tdo_len = 0
+        raise error
+
+    def _stream_reader(self):
+        """Reader thread of set_streaming(). Read back and decode the
+        TDO of the posted waves in the order they were written."""
+        cv = self._stream_cv
+        while True:
+            with cv:
+                cv.wait_for(lambda: self._stream_stop or self._stream_waves)
+                if self._stream_stop:
+                    return
+                (plan, olen, regime) = self._stream_waves[0]
+            try:
+                self._decode_wave(plan, self._read_tdo(olen, regime, self._stream_read))
+            except Exception as e:
+                with cv:
+                    self._stream_error = e
+                    self._stream_waves.clear()
+                    cv.notify_all()
+                continue
+            with cv:
+                self._stream_waves.popleft()
+                cv.notify_all()
+
+    def _stream_read(self, count):
+        """Give back the room of count TDO bytes read by the reader
+        thread in the Read FIFO"""
+        with self._stream_cv:
+            self._stream_rlen -= count
+            self._stream_cv.notify_all()
+
+    def _read_tdo(self, olen, regime, progress=None):
+        """Read olen TDO bytes with the attempts of regime, the read
+        regime of their wave, calling progress with the number of bytes
+        of every chunk that comes in. The writes of the wave they belong
+        to are done, so they arrive within the TCK time of the wave, and this only gives
+        up after the USB read timeout without any of them."""
+        data = bytearray()
+        attempts = self.READ_ATTEMPTS[regime]
+        timeout = self._ftdi.timeouts[0]/1000
+        deadline = time.monotonic() + timeout
+        while len(data) < olen:
+            chunk = self._ftdi.read_data_bytes(olen-len(data), attempts)
+            if chunk:
+                data.extend(chunk)
+                deadline = time.monotonic() + timeout
+                if progress is not None:
+                    progress(len(chunk))
+            elif time.monotonic() > deadline:
+                raise JtagError('Not all data read! Expected {} bytes but only read {} bytes'.format(olen,len(data)))
+        return bytes(data)
@@ -15,9 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
-import bitstring
-from bitstring import BitStream
-from adapters.jtag import jtag
+from adapters.planner import PlannedJtag, vector_bits, TMS, SCAN, WRITE
+from adapters.bitvector import BitVector
 import usb
 import sys
 import struct
@@ -56,7 +55,25 @@ AIO0_ADC_CMD           = 0x60  # Do an ADC conversion on AIO0 (AN6 pin on pic)
 AIO1_ADC_CMD           = 0x61  # Do an ADC conversion on AIO1 (AN11 pin on pic)
 RESET_CMD              = 0xff  # Cause a power-on reset.
 
-class jtag_xula(jtag):
+# Flag bits for JTAG_CMD
+GET_TDO_MASK = 0x01     # Set if gathering TDO bits.
+PUT_TMS_MASK = 0x02     # Set if TMS bits are included in the packets.
+TMS_VAL_MASK = 0x04     # Static value for TMS if PUT_TMS_MASK is cleared.
+PUT_TDI_MASK = 0x08     # Set if TDI bits are included in the packets.
+TDI_VAL_MASK = 0x10     # Static value for TDI if PUT_TDI_MASK is cleared.
+
+JTAG_CMD_HDR_LEN = 6    # Command, number of clocks and flags
+USBGEN_EP_SIZE = 32     # Bytes in a USB packet of the firmware
+
+class jtag_xula(PlannedJtag):
+
+    # The firmware shifts data in Shift-DR/IR with TDI_TDO_CMD, or
+    # TDI_CMD when TDO is not needed. Anything else is clocked with
+    # JTAG_CMD, which takes both TMS and TDI bits.
+    plan_ops = (TMS, SCAN, WRITE)
+
+    # TMS back to Shift-DR/IR from Exit1-DR/IR
+    SHIFT_AGAIN_TMS = BitVector.from_int(0b010, 3)
 
     def __init__(self, debug=False):
         super().__init__()
@@ -82,8 +99,6 @@ class jtag_xula(jtag):
 
         self.handle.claimInterface(0)
 
-        self.ir = bitstring.BitStream('0b000000')
-
     def set_verbosity(self, level):
         self.verbosity_level = level
 
@@ -116,52 +131,118 @@ class jtag_xula(jtag):
         return 4096
 
     
-    def send_data(self, TMS_stream, TDI_stream):
-        TDO_stream = BitStream()
-
-        index = 0
-        n = len(TDI_stream)
-
-        while(index < n):
-            if((self.get_state() == self.SHIFT_DR or self.get_state() == self.SHIFT_IR)
-                    and TMS_stream[index] == False):
-
-                end = TMS_stream.find(BitStream('0b1'), index)
-                if(end):
-                    end = end[0]
-                else:
-                    end = len(TMS_stream)
-
-                if(self.get_state() == self.SHIFT_IR):
-                    self.ir = TDI_stream[index:end+1]
-                    self.ir.reverse()
-
-                    if(self.verbosity_level >= 2):
-                        print('New IR: {}'.format(self.ir.bin))
+    def op_cost(self, kind, num_bits):
+        """
+            Bytes over USB for an op of num_bits, as sent by send_plan()
+            from Shift-DR/IR.
+        """
+        nbytes = (num_bits+7)//8
+        if kind == TMS:
+            # Interlaced TMS and TDI bytes, and TDO back
+            return JTAG_CMD_HDR_LEN + 3*nbytes
+
+        # Command, TDI bytes and the 3 bits back to Shift-DR/IR, which
+        # go with the next JTAG_CMD
+        cost = 5 + nbytes + 2
+        if kind == SCAN:
+            cost += nbytes
+        return cost
+
+    def send_plan(self, ops, num_bits, tms, tdi, cached=None):
+        """
+            Send the data in Shift-DR/IR of SCAN and WRITE ops with
+            jtag_data() and everything else with as few JTAG_CMDs as
+            possible. The moves between two jtag_data() calls, including
+            the way back to Shift-DR/IR after the first, go in one.
+        """
+        tdo = 0
+
+        # (first bit or None to drop its TDO, number of bits, TMS, TDI)
+        # of the moves for the next JTAG_CMD
+        moves = []
+
+        for (kind, head, tail, state) in ops:
+            if(kind == TMS):
+                moves.append((head, tail-head, vector_bits(tms, head, tail), vector_bits(tdi, head, tail)))
+                continue
+
+            # The bits up to Shift-DR/IR, with TMS at '0', are moves too
+            start = head
+            while(head < tail and state != self.SHIFT_DR and state != self.SHIFT_IR):
+                state = self.jtag_states[state][1]
+                head += 1
+            if(head > start):
+                moves.append((start, head-start, 0, vector_bits(tdi, start, head)))
+
+            if(head < tail):
+                tdo |= self.send_moves(moves)
+                moves = []
+                TDO_stream = self.jtag_data(BitVector.from_int(vector_bits(tdi, head, tail), tail-head),
+                                            kind == SCAN, shift_again=False)
+                tdo |= TDO_stream.to_int() << head
+                moves.append((None, len(self.SHIFT_AGAIN_TMS), self.SHIFT_AGAIN_TMS.to_int(), 0))
+
+        tdo |= self.send_moves(moves)
+        return tdo.to_bytes((num_bits+7)//8, byteorder='little')
+
+    def send_moves(self, moves):
+        """
+            Clock moves, as built by send_plan(), with a single JTAG_CMD
+            and return their TDO at the bits they came from.
+        """
+        if(not moves):
+            return 0
+
+        (tms, tdi, num_bits) = (0, 0, 0)
+        for (head, count, tms_bits, tdi_bits) in moves:
+            tms |= tms_bits << num_bits
+            tdi |= tdi_bits << num_bits
+            num_bits += count
+
+        read = any(head is not None for (head, count, tms_bits, tdi_bits) in moves)
+        bits = self.jtag_cmd(num_bits, tms, tdi, read)
+
+        tdo = 0
+        for (head, count, tms_bits, tdi_bits) in moves:
+            if(head is not None):
+                tdo |= (bits & ((1 << count)-1)) << head
+            bits >>= count
+        return tdo
+
+    def jtag_cmd(self, num_bits, tms, tdi, tdo=True):
+        """
+            Clock num_bits of TMS and TDI, integers with the first bit as
+            the lsb, with JTAG_CMD and return TDO the same way, or 0 if
+            tdo is False.
+
+            The TMS and TDI bytes are interlaced. The first packet holds
+            the header and the first bytes, the others are full packets.
+            The firmware answers every packet with its TDO bytes when
+            asked to, so those are read packet by packet, otherwise all
+            of the packets go in one write.
+        """
+        nbytes = (num_bits+7)//8
+        data = bytearray(2*nbytes)
+        data[0::2] = tms.to_bytes(nbytes, byteorder='little')
+        data[1::2] = tdi.to_bytes(nbytes, byteorder='little')
 
-                if(self.ir == bitstring.BitStream('0b000101')):
-                    TDO_stream += self.jtag_data(TDI_stream[index:end], False)
-                else:
-                    TDO_stream += self.jtag_data(TDI_stream[index:end], True)
-                index = end
+        flags = PUT_TMS_MASK | PUT_TDI_MASK | (GET_TDO_MASK if tdo else 0)
+        data[0:0] = struct.pack("<BIB", JTAG_CMD, num_bits, flags)
 
-            else:
-                TDO_stream += self.jtag_general(TMS_stream[index:index+1],
-                                                TDI_stream[index:index+1])
-                index += 1
+        if(not tdo):
+            self.handle.bulkWrite(usb.ENDPOINT_OUT + 1, bytes(data), timeout=10000)
+            return 0
 
-        return TDO_stream
+        r = bytearray()
+        for start in range(0, len(data), USBGEN_EP_SIZE):
+            self.handle.bulkWrite(usb.ENDPOINT_OUT + 1, bytes(data[start:start+USBGEN_EP_SIZE]), timeout=10000)
+            r.extend(self.handle.bulkRead(usb.ENDPOINT_IN + 1, USBGEN_EP_SIZE, timeout=10000))
 
+        return int.from_bytes(bytes(r[:nbytes]), byteorder='little') & ((1 << num_bits)-1)
 
     def jtag_general(self, TMS_stream, TDI_stream):
-        TDO_stream = BitStream()
-
-        for (tms, tdi) in zip(TMS_stream, TDI_stream):
-            tdo = self.tick(tms, tdi)
-            TDO_stream += BitStream(bool=tdo)
-            self.track_tms(tms)
-
-        return TDO_stream
+        TDO_bits = self.jtag_cmd(len(TMS_stream), TMS_stream.to_int(), TDI_stream.to_int())
+        return BitVector.from_int(TDO_bits, len(TMS_stream))
 
 
     def tick(self, tms, tdi):
@@ -178,7 +259,7 @@ class jtag_xula(jtag):
 
         return (r[1] & 0x4) != 0;
 
-    def jtag_data(self, TDI_stream, tdo):
+    def jtag_data(self, TDI_stream, tdo, shift_again=True):
 
         if(tdo):
             data = struct.pack("<BI", TDI_TDO_CMD, len(TDI_stream))
@@ -186,29 +267,22 @@ class jtag_xula(jtag):
             data = struct.pack("<BI", TDI_CMD, len(TDI_stream))
         self.handle.bulkWrite(usb.ENDPOINT_OUT + 1, data)
 
-        n_bits = TDI_stream.len
-        TDI_stream += bitstring.BitStream((8 - n_bits) % 8)
-        TDI_stream.reverse()
-        TDI_stream.byteswap()
-        data = TDI_stream.tobytes()
+        n_bits = len(TDI_stream)
+        data = TDI_stream.to_bytes()
 
         self.handle.bulkWrite(usb.ENDPOINT_OUT + 1, data, timeout=10000)
 
         if(tdo):
             r = self.handle.bulkRead(usb.ENDPOINT_IN + 1, len(data), timeout=10000)
 
-            TDO_stream = bitstring.pack('bytes:{}'.format(len(r)), r)
-            TDO_stream.byteswap()
-            TDO_stream.reverse()
-            TDO_stream = TDO_stream[0:n_bits]
+            TDO_stream = BitVector.from_bytes(bytes(r), n_bits)
         else:
-            TDO_stream = BitStream(n_bits)
-
-        # TDI_TDO_CMD and TDI_CMD always ends with TMS=1
-        self.track_tms(True)
+            TDO_stream = BitVector(n_bits)
 
-        # Go back to "Shift DR" or "Shift IR"
-        self.jtag_general(BitStream('0b010'), BitStream('0b000'))
+        # TDI_TDO_CMD and TDI_CMD always ends with TMS=1, so go back
+        # to "Shift DR" or "Shift IR", unless the caller does
+        if(shift_again):
+            self.jtag_cmd(len(self.SHIFT_AGAIN_TMS), self.SHIFT_AGAIN_TMS.to_int(), 0, False)
 
         return TDO_stream
 
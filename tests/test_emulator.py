@@ -0,0 +1,285 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+#
+# The adapters against the emulated FTDI of adapters/emulator.py: every
+# shift must return the TDO of a second emulated chain clocked with the
+# same TMS and TDI bit by bit.
+#
+#------------------------------------------------------------------------------
+
+import random
+import threading
+
+import pytest
+
+from adapters.emulator import EmulatedChain, EmulatedFtdi, EmulatedTap, Emulator
+from adapters.papilio_one import PapilioOne
+from adapters.planner import NUMPY_MIN_BITS
+
+# Instructions of the 7 series TAP of EmulatedTap
+IDCODE = 0b001001
+CFG_IN = 0b000101
+BYPASS = 0b111111
+
+
+def reference(chain, num_bits, tms, tdi):
+    """ TDO of a shift clocked through chain a bit at a time. """
+    tdo = 0
+    for k in range(num_bits):
+        if chain.clock((tms[k >> 3] >> (k & 7)) & 1, (tdi[k >> 3] >> (k & 7)) & 1):
+            tdo |= 1 << k
+    return tdo.to_bytes((num_bits+7)//8, 'little')
+
+
+class Shift:
+    """ TMS and TDI of a shift built bit run by bit run. """
+
+    def __init__(self):
+        self.tms = 0
+        self.tdi = 0
+        self.num_bits = 0
+
+    def add(self, tms, tdi, count):
+        self.tms |= tms << self.num_bits
+        self.tdi |= tdi << self.num_bits
+        self.num_bits += count
+
+    def moves(self, bits, rng):
+        for bit in bits:
+            self.add(int(bit), rng.getrandbits(1), 1)
+
+    def scan(self, tdi, count):
+        """ Scan count bits from Shift-DR/IR and leave to Exit1. """
+        self.add(0, tdi, count-1)
+        self.add(1, tdi >> (count-1), 1)
+
+    def vectors(self):
+        nbytes = (self.num_bits+7)//8
+        return (self.num_bits, self.tms.to_bytes(nbytes, 'little'), self.tdi.to_bytes(nbytes, 'little'))
+
+
+def run_bits(rng, length):
+    """ TDI of length bits in runs of '0', '1' and random bits. """
+    tdi = 0
+    k = 0
+    while k < length:
+        count = min(rng.randint(1, 600), length-k)
+        tdi |= rng.choice((rng.getrandbits(count), 0, (1 << count)-1)) << k
+        k += count
+    return tdi
+
+
+def random_shifts(rng, count, min_bits=1, max_bits=1200):
+    """ Shifts of IR and DR scans, idle clocks and random TMS moves, some
+        of them repeated to hit the plan cache. The first one resets the
+        TAP, which the adapters start out of step with. DR scans are
+        min_bits to max_bits long. """
+    shifts = []
+    for n in range(count):
+        if shifts and rng.random() < 0.3:
+            shifts.append(rng.choice(shifts))
+            continue
+        shift = Shift()
+        if not n:
+            shift.moves('11111', rng)
+        shift.moves('0', rng)
+        for k in range(rng.randint(1, 4)):
+            kind = rng.random()
+            if kind < 0.3:
+                # Run-Test/Idle to Shift-IR and back
+                shift.moves('1100', rng)
+                shift.scan(rng.choice((IDCODE, CFG_IN, BYPASS, rng.getrandbits(6))), 6)
+                shift.moves('10', rng)
+            elif kind < 0.7:
+                # Run-Test/Idle to Shift-DR and back, with random,
+                # all '0', all '1' or runs of each TDI
+                length = rng.randint(min_bits, max_bits)
+                tdi = rng.choice((rng.getrandbits(length), 0, (1 << length)-1, run_bits(rng, length)))
+                shift.moves('100', rng)
+                shift.scan(tdi, length)
+                if rng.random() < 0.3:
+                    # Through Pause-DR
+                    shift.add(0, rng.getrandbits(20), 20)
+                    shift.moves('1', rng)
+                shift.moves('10', rng)
+            elif kind < 0.85:
+                shift.add(0, rng.getrandbits(1), rng.randint(1, 300))
+            else:
+                # Random moves, back to Run-Test/Idle with a reset
+                shift.moves(''.join(rng.choice('01') for k in range(rng.randint(1, 12))), rng)
+                shift.moves('111110', rng)
+        shifts.append(shift.vectors())
+    return shifts
+
+
+def check_adapter(adapter, chain, shifts, seed=0, **options):
+    """ Assert that every shift of random_shifts(), given options,
+        returns the TDO of chain. The adapter reads back all TDO, as its
+        IR policies are dropped. """
+    adapter.ir_policies.clear()
+    adapter.plan_cache.clear()
+    for (num_bits, tms, tdi) in random_shifts(random.Random(seed), shifts, **options):
+        assert adapter.send_bytes(num_bits, tms, tdi) == reference(chain, num_bits, tms, tdi)
+
+
+def mpsse(**options):
+    return Emulator(ftdi=EmulatedFtdi(**options))
+
+
+@pytest.mark.parametrize('setup', ['batch', 'unbatched', 'streaming', 'msb', 'ft2232d', 'small_chunks', 'no_cache'])
+def test_mpsse_matches_chain(setup):
+    if setup == 'ft2232d':
+        adapter = mpsse(fifo_sizes=(384, 128), is_H_series=False)
+    else:
+        adapter = mpsse()
+    if setup == 'unbatched':
+        adapter.batch = False
+    elif setup == 'streaming':
+        adapter.set_streaming(True)
+    elif setup == 'msb':
+        adapter.device.set_lsb_first(False)
+    elif setup == 'small_chunks':
+        adapter.set_tuning({'chunk_size': 64})
+    elif setup == 'no_cache':
+        adapter.plan_cache.size = 0
+    try:
+        check_adapter(adapter, EmulatedChain(), 80)
+    finally:
+        if setup == 'streaming':
+            adapter.set_streaming(False)
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+@pytest.mark.parametrize('setup', ['batch', 'ft2232d'])
+def test_mpsse_long_scans_match_chain(setup, use_numpy):
+    # DR scans long enough for planner.numpy_segments() when use_numpy
+    if use_numpy:
+        pytest.importorskip('numpy')
+    if setup == 'ft2232d':
+        adapter = mpsse(fifo_sizes=(384, 128), is_H_series=False)
+    else:
+        adapter = mpsse()
+    adapter.use_numpy = use_numpy
+    check_adapter(adapter, EmulatedChain(), 12, seed=3, min_bits=NUMPY_MIN_BITS, max_bits=3*NUMPY_MIN_BITS)
+
+
+def test_streaming_reads_with_the_regime_of_the_wave(monkeypatch):
+    # The reader thread is held back on the bulk wave of a long scan
+    # until the poll wave of its tail is set up, and must still read the
+    # bulk wave with the attempts of a bulk transfer
+    adapter = mpsse()
+    controller = adapter.device
+    ftdi = controller._ftdi
+    adapter.set_streaming(True)
+    try:
+        rng = random.Random(0)
+        chain = EmulatedChain()
+        shift = Shift()
+        shift.moves('111110100', rng)
+        assert adapter.send_bytes(*shift.vectors()) == reference(chain, *shift.vectors())
+
+        regimes = []
+        both_set = threading.Event()
+        set_regime = controller._set_regime
+        def record_regime():
+            set_regime()
+            regimes.append(controller._regime)
+            if len(regimes) == 2:
+                both_set.set()
+        monkeypatch.setattr(controller, '_set_regime', record_regime)
+
+        attempts = []
+        read_data_bytes = ftdi.read_data_bytes
+        def held_read(size, attempt=1, request_gen=None):
+            if not attempts:
+                both_set.wait(5)
+            attempts.append(attempt)
+            return read_data_bytes(size, attempt, request_gen)
+        monkeypatch.setattr(ftdi, 'read_data_bytes', held_read)
+
+        length = 8*controller._wave_rlen + 16
+        shift = Shift()
+        shift.scan(rng.getrandbits(length), length)
+        shift.moves('10', rng)
+        assert adapter.send_bytes(*shift.vectors()) == reference(chain, *shift.vectors())
+        assert regimes == [controller.BULK, controller.POLL]
+        assert attempts[0] == controller.READ_ATTEMPTS[controller.BULK]
+        assert attempts[-1] == controller.READ_ATTEMPTS[controller.POLL]
+    finally:
+        adapter.set_streaming(False)
+
+
+def test_mpsse_tms_write_only_keeps_shift_tdo():
+    # TMS commands are write-only unless they clock a bit in Shift-DR/IR,
+    # whose TDO still has to come back
+    adapter = mpsse()
+    adapter.tms_write_only = True
+    check_adapter(adapter, EmulatedChain(), 40)
+
+
+def test_mpsse_cfg_in_is_write_only_on_zynq():
+    # The PL of a Zynq holds CFG_IN and the ARM DAP, nearest TDO, BYPASS
+    ftdi = EmulatedFtdi(chain=EmulatedChain([EmulatedTap(), EmulatedTap(ir_len=4, idcode=0x4BA00477, idcode_ir=0b1110)]))
+    adapter = Emulator(ftdi=ftdi)
+    rng = random.Random(1)
+    data = rng.getrandbits(4000)
+
+    shift = Shift()
+    shift.moves('111110', rng)
+    shift.moves('1100', rng)
+    shift.scan(CFG_IN << 4 | 0b1111, 10)
+    shift.moves('1100', rng)
+    head = shift.num_bits
+    shift.scan(data, 4000)
+    shift.moves('10', rng)
+    (num_bits, tms, tdi) = shift.vectors()
+
+    ftdi.reset_stats()
+    tdo = int.from_bytes(adapter.send_bytes(num_bits, tms, tdi), 'little')
+    # All but the last bit, clocked with TMS at '1' by a TMS command
+    assert (tdo >> head) & ((1 << 3999)-1) == 0
+    assert ftdi.read_bytes < 100
+    assert ftdi.chain.taps[0].ir == CFG_IN
+
+
+@pytest.mark.parametrize('is_H_series', [False, True])
+def test_sync_bitbang_matches_chain(is_H_series):
+    ftdi = EmulatedFtdi(fifo_sizes=(384, 128), is_H_series=is_H_series)
+    adapter = PapilioOne(ftdi=ftdi)
+    adapter.set_verbosity(0)
+    check_adapter(adapter, EmulatedChain(), 30)
+
+
+def test_gpio_ticks_match_chain():
+    class PapilioOneGpio(PapilioOne):
+        SYNC_BITBANG = False
+
+    adapter = PapilioOneGpio(ftdi=EmulatedFtdi())
+    adapter.set_verbosity(0)
+    check_adapter(adapter, EmulatedChain(), 10, seed=2)
+
+
+def test_sync_bitbang_settck_is_clamped():
+    adapter = PapilioOne(ftdi=EmulatedFtdi(fifo_sizes=(384, 128), is_H_series=False))
+    # 3 MHz of samples at most, two per TCK
+    assert adapter.set_tck_period(100) == 666
+    assert adapter.set_tck_period(10000) == 10000
+
+
+def test_emulated_baudrate_limits():
+    ftdi = EmulatedFtdi(is_H_series=False)
+    with pytest.raises(ValueError):
+        ftdi.set_baudrate(4000000)
+    assert EmulatedFtdi(is_H_series=True).set_baudrate(4000000) == 4000000
@@ -0,0 +1,386 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+#
+# The server side of xvcd_server.py with the emulator adapter.
+#
+#------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from adapters.emulator import Emulator, EmulatedChain, EmulatedFtdi
+from tests.test_emulator import BYPASS, IDCODE, Shift, reference
+from xvcd_server import XvcConnection, XvcScheduler
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'xvcd_server.py')
+
+# xvc_vector_len of the emulator adapter, TMS and TDI bytes together
+VECTOR_LEN = Emulator(ftdi=EmulatedFtdi()).xvc_vector_len
+
+
+def server_opts(**options):
+    opts = argparse.Namespace(verbose=0, bitvector=False, share=False)
+    vars(opts).update(options)
+    return opts
+
+
+class FailingEmulator(Emulator):
+    """ Emulator whose USB transfers fail once failing is set """
+
+    failing = False
+
+    def send_bytes(self, num_bits, tms, tdi):
+        if self.failing:
+            raise OSError('USB transfer failed')
+        return super().send_bytes(num_bits, tms, tdi)
+
+
+def test_scheduler_survives_failed_park():
+    # The holder leaves in Shift-DR and bringing the TAP back to
+    # Run-Test/Idle fails: the queued commands of the other client fail
+    # and the scheduler goes on serving it
+    async def scenario():
+        jtag = FailingEmulator(ftdi=EmulatedFtdi())
+        jtag.set_verbosity(0)
+        opts = server_opts(share=True)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        scheduler = XvcScheduler(jtag, executor, opts)
+        holder = scheduler.open(XvcConnection(jtag, opts, 'holder'))
+        other = scheduler.open(XvcConnection(jtag, opts, 'other'))
+
+        # Run-Test/Idle to Shift-DR
+        scheduler.tap.track_shift(3, bytes((0b001,)), bytes(1))
+        scheduler.holder = holder
+        queued = asyncio.ensure_future(scheduler.submit(other, (b'getinfo',)))
+        await asyncio.sleep(0)
+        scheduler.close(holder)
+
+        jtag.failing = True
+        task = asyncio.ensure_future(scheduler.run())
+        try:
+            with pytest.raises(OSError):
+                await asyncio.wait_for(queued, 5)
+            assert scheduler.holder is None
+            assert not task.done()
+
+            jtag.failing = False
+            reply = await asyncio.wait_for(scheduler.submit(other, (b'getinfo',)), 5)
+            assert reply == 'xvcServer_v1.0:{}\n'.format(jtag.xvc_vector_len).encode()
+        finally:
+            task.cancel()
+            executor.shutdown()
+
+    asyncio.run(scenario())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, proc=None, timeout=15):
+    """ Wait until a server accepts connections on port """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if proc is not None and proc.poll() is not None:
+                raise AssertionError('server exited with code {}'.format(proc.returncode))
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_server(*args):
+    """ Start xvcd_server.py with the emulator adapter and args """
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, SERVER, 'emulator', '--local', '--port', str(port)] + list(args),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, proc)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    return (proc, port)
+
+
+class XvcClient:
+    """ An XVC client, with the emulated chain it expects to talk to.
+        Unless retry is False, it connects again while it is turned away,
+        as the server may not have released the adapter from the last
+        client yet. """
+
+    def __init__(self, port, seed=0, retry=True):
+        self.chain = EmulatedChain()
+        self.rng = random.Random(seed)
+        deadline = time.monotonic() + 10
+        while True:
+            self.sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if not retry:
+                return
+            try:
+                self.getinfo()
+                return
+            except ConnectionError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data, chunk=None):
+        """ Send data, in pieces of chunk bytes if given """
+        if chunk is None:
+            self.sock.sendall(data)
+            return
+        for start in range(0, len(data), chunk):
+            self.sock.sendall(data[start:start+chunk])
+            time.sleep(0.002)
+
+    def recv(self, count):
+        data = b''
+        while len(data) < count:
+            more = self.sock.recv(count - len(data))
+            if not more:
+                raise ConnectionError('closed by the server')
+            data += more
+        return data
+
+    def getinfo(self):
+        self.send(b'getinfo:')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            more = self.sock.recv(64)
+            if not more:
+                raise ConnectionError('closed by the server')
+            reply += more
+        return reply
+
+    def shift(self, shift, chunk=None):
+        """ Send the shift: of a Shift and assert that it returns the TDO
+            of the chain """
+        (num_bits, tms, tdi) = shift.vectors()
+        self.send(b'shift:' + num_bits.to_bytes(4, 'little') + tms + tdi, chunk)
+        assert self.recv(len(tms)) == reference(self.chain, num_bits, tms, tdi)
+
+    def load_ir(self, ir, reset=False):
+        """ Shift ir into the IR and go to Run-Test/Idle """
+        shift = Shift()
+        if reset:
+            shift.moves('111110', self.rng)
+        shift.moves('1100', self.rng)
+        shift.scan(ir, 6)
+        shift.moves('10', self.rng)
+        self.shift(shift)
+
+    def scan_dr(self, length, chunk=None):
+        """ Shift length random bits through the DR from Run-Test/Idle """
+        shift = Shift()
+        shift.moves('100', self.rng)
+        shift.scan(self.rng.getrandbits(length), length)
+        shift.moves('10', self.rng)
+        self.shift(shift, chunk)
+
+
+def assert_closed(client):
+    """ Assert that the server closed the connection of client """
+    try:
+        assert client.sock.recv(1) == b''
+    except ConnectionResetError:
+        pass
+
+
+@pytest.fixture(params=[['--pipeline'], ['--asyncio'], ['--asyncio', '--share']], ids=lambda args: ' '.join(args))
+def server(request):
+    (proc, port) = start_server(*request.param)
+    yield port
+    proc.kill()
+    proc.wait()
+
+
+def test_server_fragmented_shift(server):
+    client = XvcClient(server)
+    try:
+        assert client.getinfo() == 'xvcServer_v1.0:{}\n'.format(VECTOR_LEN).encode()
+        client.load_ir(IDCODE, reset=True)
+        # Commands cut anywhere, header included, and several of them in
+        # a single send
+        client.scan_dr(32, chunk=1)
+        client.scan_dr(1000, chunk=7)
+        client.send(b'settck:' + (100).to_bytes(4, 'little'), chunk=3)
+        assert len(client.recv(4)) == 4
+        client.send(2*(b'settck:' + (100).to_bytes(4, 'little')))
+        assert len(client.recv(8)) == 8
+        client.scan_dr(300, chunk=200)
+    finally:
+        client.close()
+
+
+def test_server_refuses_oversized_shift(server):
+    client = XvcClient(server)
+    try:
+        client.load_ir(IDCODE, reset=True)
+        # A shift: whose TMS and TDI take all of xvc_vector_len
+        client.scan_dr(8*(VECTOR_LEN//2) - 5)
+        # One bit more needs a byte more of each
+        num_bits = 8*(VECTOR_LEN//2) + 1
+        client.send(b'shift:' + num_bits.to_bytes(4, 'little'))
+        assert_closed(client)
+    finally:
+        client.close()
+
+    # The adapter is free for the next client
+    client = XvcClient(server, seed=1)
+    try:
+        client.load_ir(IDCODE, reset=True)
+        client.scan_dr(32)
+    finally:
+        client.close()
+
+
+def test_asyncio_server_turns_away_second_client():
+    # Both ports serve the same adapter, which takes one client at a time
+    other = free_port()
+    (proc, port) = start_server('--asyncio', '--port', str(other))
+    try:
+        wait_for_port(other, proc)
+        first = XvcClient(port)
+        try:
+            first.load_ir(IDCODE, reset=True)
+            second = XvcClient(other, seed=1, retry=False)
+            try:
+                assert_closed(second)
+            finally:
+                second.close()
+            first.scan_dr(32)
+        finally:
+            first.close()
+
+        client = XvcClient(other, seed=2)
+        try:
+            client.load_ir(IDCODE, reset=True)
+            client.scan_dr(32)
+        finally:
+            client.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_shared_server_keeps_the_ir_of_each_client():
+    # Two clients with different instructions take turns on the adapter,
+    # each one seeing the TAP as it left it
+    (proc, port) = start_server('--asyncio', '--share')
+    errors = []
+
+    def run(client, ir):
+        try:
+            client.load_ir(ir, reset=True)
+            for k in range(20):
+                client.scan_dr(client.rng.randint(1, 200))
+                if k % 5 == 4:
+                    client.load_ir(ir)
+        except Exception as error:
+            errors.append(error)
+
+    try:
+        clients = [XvcClient(port, seed=1), XvcClient(port, seed=2)]
+        try:
+            # Turn by turn, then both at once
+            clients[0].load_ir(IDCODE, reset=True)
+            clients[1].load_ir(BYPASS, reset=True)
+            for k in range(5):
+                clients[0].scan_dr(32)
+                clients[1].scan_dr(64)
+
+            threads = [threading.Thread(target=run, args=(client, ir)) for (client, ir) in zip(clients, (IDCODE, BYPASS))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not errors
+        finally:
+            for client in clients:
+                client.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='kills the worker with SIGKILL')
+def test_supervisor_restarts_worker(tmp_path):
+    port = free_port()
+    config = tmp_path / 'cables.ini'
+    config.write_text('[emulated]\nadapter = emulator\nport = {}\noptions = --asyncio\n'.format(port))
+    log = tmp_path / 'supervisor.log'
+
+    def workers():
+        return re.findall(r'Started worker (\d+) on port', log.read_text())
+
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    with open(log, 'w') as out:
+        proc = subprocess.Popen([sys.executable, SERVER, '--supervise', str(config), '--local'],
+                                stdout=out, stderr=subprocess.STDOUT, env=env)
+    try:
+        wait_for_port(port, proc)
+        client = XvcClient(port)
+        try:
+            client.load_ir(IDCODE, reset=True)
+        finally:
+            client.close()
+
+        (pid,) = workers()
+        os.kill(int(pid), signal.SIGKILL)
+        deadline = time.monotonic() + 15
+        while len(workers()) < 2:
+            assert time.monotonic() < deadline and proc.poll() is None
+            time.sleep(0.1)
+
+        wait_for_port(port, proc)
+        client = XvcClient(port, seed=1)
+        try:
+            client.load_ir(IDCODE, reset=True)
+            client.scan_dr(32)
+        finally:
+            client.close()
+
+        # SIGTERM stops the supervisor along with its worker
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(10) == 0
+        with pytest.raises(OSError):
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
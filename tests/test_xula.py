@@ -0,0 +1,170 @@
+#------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+#
+# The XuLA adapter against XulaFirmware, a stand-in for the USB handle of
+# the board that runs the JTAG commands of its firmware on an emulated
+# chain.
+#
+#------------------------------------------------------------------------------
+
+import random
+import struct
+
+import pytest
+
+usb = pytest.importorskip('usb')
+
+from adapters import xula
+from adapters.emulator import EmulatedChain
+from tests.test_emulator import Shift, check_adapter, reference
+
+
+class XulaFirmware:
+    """
+        The USB handle of a XuLA, as opened by jtag_xula. Commands are
+        taken from the bytes written, whatever the packets they come in,
+        and the TDO of each write is queued for a read.
+
+        JTAG_CMD answers every packet with the TDO bytes of the TMS and
+        TDI byte pairs in it. TDI_TDO_CMD and TDI_CMD clock their TDI with
+        TMS at '0', except for the last bit with TMS at '1'.
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.data = bytearray()
+        self.replies = []
+        # (command, bits left, flags) of the command taking data
+        self.command = None
+        self.writes = 0
+
+    # The device side of jtag_xula.__init__()
+    def open(self):
+        return self
+
+    def detachKernelDriver(self, interface):
+        pass
+
+    def claimInterface(self, interface):
+        pass
+
+    def bulkWrite(self, endpoint, data, timeout=None):
+        assert endpoint == usb.ENDPOINT_OUT + 1
+        self.writes += 1
+        self.data.extend(data)
+        tdo = bytearray()
+        while self.run(tdo):
+            pass
+        if tdo:
+            self.replies.append(bytes(tdo))
+        return len(data)
+
+    def bulkRead(self, endpoint, size, timeout=None):
+        assert endpoint == usb.ENDPOINT_IN + 1
+        reply = self.replies.pop(0)
+        assert len(reply) <= size
+        return reply
+
+    def run(self, tdo):
+        """ Take the next command or data bytes, if all of them are
+            there, and append their TDO to tdo. Return False when more
+            bytes are needed. """
+        if self.command is None:
+            if not self.data:
+                return False
+            cmd = self.data[0]
+            if cmd == xula.JTAG_CMD:
+                if len(self.data) < xula.JTAG_CMD_HDR_LEN:
+                    return False
+                (cmd, num_bits, flags) = struct.unpack('<BIB', self.data[:xula.JTAG_CMD_HDR_LEN])
+                assert flags & xula.PUT_TMS_MASK and flags & xula.PUT_TDI_MASK
+                del self.data[:xula.JTAG_CMD_HDR_LEN]
+            elif cmd == xula.TDI_TDO_CMD or cmd == xula.TDI_CMD:
+                if len(self.data) < 5:
+                    return False
+                (cmd, num_bits) = struct.unpack('<BI', self.data[:5])
+                flags = xula.GET_TDO_MASK if cmd == xula.TDI_TDO_CMD else 0
+                del self.data[:5]
+            elif cmd == xula.TMS_TDI_TDO_CMD:
+                if len(self.data) < 2:
+                    return False
+                mask = self.data[1]
+                del self.data[:2]
+                bit = self.chain.clock(mask & 0x1, (mask >> 1) & 1)
+                tdo.extend((cmd, 0x4 if bit else 0))
+                return True
+            else:
+                raise AssertionError('Unexpected command 0x{:02x}'.format(cmd))
+            if num_bits:
+                self.command = (cmd, num_bits, flags)
+            return True
+
+        (cmd, num_bits, flags) = self.command
+        count = min(num_bits, 8)
+        if cmd == xula.JTAG_CMD:
+            if len(self.data) < 2:
+                return False
+            (tms, tdi) = self.data[0:2]
+            del self.data[:2]
+        else:
+            if not self.data:
+                return False
+            # TMS at '1' on the last bit, to Exit1-DR/IR
+            tms = 1 << (num_bits-1) if num_bits <= 8 else 0
+            tdi = self.data.pop(0)
+        byte = 0
+        for k in range(count):
+            if self.chain.clock((tms >> k) & 1, (tdi >> k) & 1):
+                byte |= 1 << k
+        if flags & xula.GET_TDO_MASK:
+            tdo.append(byte)
+        num_bits -= count
+        self.command = (cmd, num_bits, flags) if num_bits else None
+        return True
+
+
+class XulaBus:
+    def __init__(self, device):
+        self.devices = [device]
+
+
+def xula_adapter(monkeypatch, chain):
+    firmware = XulaFirmware(chain)
+    firmware.idVendor = 0x04d8
+    firmware.idProduct = 0xff8c
+    monkeypatch.setattr(xula.usb, 'busses', lambda: [XulaBus(firmware)])
+    adapter = xula.jtag_xula()
+    adapter.set_verbosity(0)
+    return (adapter, firmware)
+
+
+def test_xula_matches_chain(monkeypatch):
+    (adapter, firmware) = xula_adapter(monkeypatch, EmulatedChain())
+    check_adapter(adapter, EmulatedChain(), 40, seed=4)
+    assert not firmware.replies and not firmware.data and firmware.command is None
+
+
+def test_xula_scan_takes_few_writes(monkeypatch):
+    # A long DR scan goes with TDI_TDO_CMD and the moves around it with
+    # JTAG_CMD, instead of a transfer per bit
+    (adapter, firmware) = xula_adapter(monkeypatch, EmulatedChain())
+    rng = random.Random(5)
+    shift = Shift()
+    shift.moves('111110100', rng)
+    shift.scan(rng.getrandbits(4000), 4000)
+    shift.moves('10', rng)
+    (num_bits, tms, tdi) = shift.vectors()
+    assert adapter.send_bytes(num_bits, tms, tdi) == reference(EmulatedChain(), num_bits, tms, tdi)
+    assert firmware.writes < 10
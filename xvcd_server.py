@@ -21,14 +21,208 @@ import socket
 import socketserver
 import sys
 import time
-import bitstring
-from math import ceil
+from adapters.jtag import jtag as JtagTap
+from adapters.bitvector import BitVector
+from adapters.autotune import Autotuner, TuneError, save_profile, profiles_path
 import argparse
 import importlib
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import queue
+import threading
+import configparser
+import os
+import shlex
+import signal
+import subprocess
 
 XVC_VERSION = 1.0
 
-class xvcd_server(socketserver.BaseRequestHandler):
+# Most buffers handed to a single sendmsg(), below any system IOV_MAX
+SENDMSG_MAX_BUFFERS = 512
+
+# Commands and replies that can wait between the stages of a pipelined
+# connection
+PIPELINE_DEPTH = 4
+
+# Supervisor: a worker that dies is restarted after a delay that doubles
+# up to SUPERVISOR_MAX_BACKOFF seconds, and goes back to 1 s once a worker
+# stayed up for SUPERVISOR_STABLE_TIME seconds.
+SUPERVISOR_MAX_BACKOFF = 30
+SUPERVISOR_STABLE_TIME = 60
+
+def send_replies(sock, replies):
+    """ Send all of the buffers in the list replies, gathered into a single
+        sendmsg() where possible, and empty the list. """
+    if not hasattr(sock, 'sendmsg'):
+        # No sendmsg() on Windows
+        sock.sendall(b''.join(replies))
+        del replies[:]
+        return
+
+    while replies:
+        sent = sock.sendmsg(replies[0:SENDMSG_MAX_BUFFERS])
+
+        # Drop what went out and keep the rest of a partial send
+        done = 0
+        while done < len(replies) and sent >= len(replies[done]):
+            sent -= len(replies[done])
+            done += 1
+        del replies[0:done]
+        if sent:
+            replies[0] = memoryview(replies[0])[sent:]
+
+class XvcProtocolError(Exception):
+    """Invalid XVC command received from the client"""
+
+def xvc_header_length(cmdSnippet):
+    """ Return the length of the fixed part of the command whose first two
+        characters are cmdSnippet. """
+    if (cmdSnippet == b'ge'):
+        return 8            # "getinfo:"
+    elif (cmdSnippet == b'se'):
+        return 11           # "settck:<set period>"
+    elif (cmdSnippet == b'sh'):
+        return 10           # "shift:<num bits>"
+    raise XvcProtocolError('Invalid command snippet "{}"'.format(cmdSnippet))
+
+def xvc_parse_header(data, vectorLen):
+    """ Parse the fixed part of a command, as sized by xvc_header_length().
+        Return the command tuple of XvcReader.next_command(), except that
+        for shift: it is only (b'shift', <num bits>) as the vectors
+        follow. A shift: whose TMS and TDI vectors together are longer
+        than vectorLen bytes, the xvc_vector_len of the adapter, is refused
+        like xvcServer.c does, before anything is allocated for it. """
+    if (data[0:2] == b'ge'):
+        if (data != b'getinfo:'):
+            raise XvcProtocolError('Invalid command "{}"'.format(data))
+        return (b'getinfo',)
+
+    if (data[0:2] == b'se'):
+        if (data[0:7] != b'settck:'):
+            raise XvcProtocolError('Invalid command "{}"'.format(data[0:7]))
+        return (b'settck', int.from_bytes(data[7:11], byteorder='little'))
+
+    if (data[0:6] != b'shift:'):
+        raise XvcProtocolError('Invalid command "{}"'.format(data[0:6]))
+    numBits = int.from_bytes(data[6:10], byteorder='little')
+    if (2 * ((numBits + 7) // 8) > vectorLen):
+        raise XvcProtocolError('TMS and TDI vectors of a shift of {} bits are longer than the {} bytes of xvc_vector_len'.format(numBits, vectorLen))
+    return (b'shift', numBits)
+
+class XvcReader:
+    """
+        Buffered reader of XVC commands from a client socket.
+
+        Data is received with recv_into() into a preallocated bytearray and
+        as many complete commands as are already buffered are parsed without
+        touching the socket again. The TMS and TDI vectors of a shift: are
+        memoryview slices of that buffer, so they are only valid until the
+        next call to next_command().
+
+        Replies given to reply() are held back and sent together with a
+        single sendmsg() when the reader runs out of buffered commands and
+        has to wait on the socket.
+    """
+
+    def __init__(self, sock, vectorLen):
+        self.sock = sock
+        self.vectorLen = vectorLen
+        # Large enough for a shift: with vectors of vectorLen bytes
+        self.buf = bytearray(10 + vectorLen)
+        self.view = memoryview(self.buf)
+        self.start = 0          # first byte not parsed yet
+        self.end = 0            # end of the received bytes
+        self.replies = []
+
+    def reply(self, data):
+        """ Queue a reply to be sent before waiting for more commands """
+        self.replies.append(data)
+
+    def flush(self):
+        """ Send all of the queued replies """
+        send_replies(self.sock, self.replies)
+
+    def _fill(self, length):
+        """ Receive until at least length bytes past self.start are
+            buffered. Return False if the connection closed or failed. """
+
+        while (self.end - self.start < length):
+            if (self.start + length > len(self.buf)):
+                # Not enough room left, so move the unparsed bytes to
+                # the front of the buffer. No command is longer than it.
+                count = self.end - self.start
+                self.buf[0:count] = bytes(self.view[self.start:self.end])
+                self.start = 0
+                self.end = count
+
+            # The client may be waiting on replies before sending more
+            self.flush()
+
+            try:
+                count = self.sock.recv_into(self.view[self.end:])
+            except ConnectionResetError:
+                print('Connection reset by peer')
+                return False
+            except OSError:
+                print('Unknown error during socket read')
+                return False
+
+            if not count:
+                # Possibly an error like timeout or the client closed the
+                # connection.
+                return False
+            self.end += count
+
+        return True
+
+    def next_command(self):
+        """
+            Return the next command from the client as one of
+
+                (b'getinfo',)
+                (b'settck', <set period>)
+                (b'shift', <num bits>, <tms vector>, <tdi vector>)
+
+            or None if the connection closed. Raise XvcProtocolError for
+            an invalid command.
+        """
+
+        ## The first two characters differentiate the commands
+        if not self._fill(2):
+            return None
+
+        cmdLength = xvc_header_length(bytes(self.view[self.start:self.start+2]))
+        if not self._fill(cmdLength):
+            return None
+
+        cmd = xvc_parse_header(bytes(self.view[self.start:self.start+cmdLength]), self.vectorLen)
+        if (cmd[0] != b'shift'):
+            self.start += cmdLength
+            return cmd
+
+        numBits = cmd[1]
+        numBytes = (numBits + 7) // 8
+
+        # Read the TMS & TDI vectors
+        if not self._fill(cmdLength + 2*numBytes):
+            print('Reading "shift:" TMS & TDI vector parameters failed - ABORTING!')
+            return None
+
+        start = self.start + cmdLength
+        self.start = start + 2*numBytes
+        return (b'shift', numBits,
+                self.view[start:start+numBytes],
+                self.view[start+numBytes:start+2*numBytes])
+
+class XvcConnection:
+    """
+        State of one client connection and the handling of its commands
+        on the adapter. Used by both the socketserver and the asyncio
+        servers.
+    """
 
     # This code has been updated to handle all of the Virtual
     # Cable commands and restructered to operate more like
@@ -41,351 +235,832 @@ class xvcd_server(socketserver.BaseRequestHandler):
     # "xvcServer.c" is licensed under CC0 1.0 Universal (http://creativecommons.org/publicdomain/zero/1.0/)
     # by Avnet and is used by Xilinx for XAPP1251.
 
-    def sread(self, length):
-        data = b''              # start with empty byte array
-        while (length):
-            #@@@# Is there a more efficient way to handle reading data into a buffer for Python?
-            try:
-                newData = self.request.recv(length)
-                if not newData:
-                    # Possibly an error like timeout, so return the
-                    # empty byte array to flag error.
-                    #@@@#print('Error during socket read')
-                    return b''
-                    
-            except ConnectionResetError:
-                print('Connection reset by peer')
-                return b''
+    def __init__(self, jtag, opts, peer=None):
+        self.jtag = jtag        # adapter the commands go to
+        self.opts = opts        # command line options
+        self.peer = peer        # address of the client
 
-            # catch all others
-            except:             
-                print('Unknown error during socket read')
-                return b''
-
-            # Add read data into the data array and update length variable
-            data += newData
-            length -= len(newData)
-
-        return data
-
-    def byteVectToBitStreamOLD(self, byteVect, bitLen):
-        """ Take a byte array, byteVect, where bit 0 of the first byte, byte
-            0, is the lsb, or "first" bit. Create a BitStream() where the lsb is
-            the first, or left-most bit with index 0 for easy handling as a
-            BitStream(). Truncate the BitSTream so that it is bitLen long. """
-        
-        bs = bitstring.pack('bytes:{}'.format(len(byteVect)), byteVect)
-
-        # Fix LSB first
-        bs.byteswap()
-        bs.reverse()
-
-        # Return truncated BitStream
-        return bs[0:bitLen]
-
-    def byteVectToBitStream(self, byteVect, bitLen):
-        """ Take a byte array, byteVect, where bit 0 of the first byte, byte
-            0, is the lsb, or "first" bit. Create a BitStream() where the lsb is
-            the first, or left-most bit with index 0 for easy handling as a
-            BitStream(). Truncate the BitSTream so that it is bitLen long. """
-
-        # bit vectors are sent by shift: command with bit 0 of byte 0
-        # the first bit. Pad bits are therefore in the msbs of the
-        # last byte. Therefore, create BitStream() first, then byte
-        # swap before truncating.
-        
-        # Use BitStream() constructor directly for creating TMS
-        # and TDI BitStreams. Assuming that it is more efficient
-        # than previous method with bitstring.pack().
-        #
-        # Actually measured the time difference between
-        # byteVectToBitStreamOLD() and byteVectToBitStream() and found
-        # byteVectToBitStreamOLD() to take on average 6ms while
-        # byteVectToBitStream() took only 4ms. When processing two
-        # byte vectors in shift: command, this is a total savings of 4 ms
-        bs = bitstring.BitStream(bytes=byteVect, length=len(byteVect)*8) # length is a bit length
-
-        # Fix LSB first
+        # Running list of the last bps to compute an average when verbose
+        self.bpsList = []
+
+        # False if the last shift: was answered without going to the
+        # adapter (see the ISE fix in runCommand())
+        self.shifted = False
+
+    def byteVectToBin(self, byteVect, bitLen):
+        """ Return the first bitLen bits of the byte array byteVect, where
+            bit 0 of byte 0 is the first bit, as a string of '0' and '1'
+            with the first bit left-most. """
+        return ''.join('{:08b}'.format(b)[::-1] for b in byteVect)[0:bitLen]
+
+    def shiftBitVector(self, TMS, TDI, numBits):
+        """ Shift the TMS and TDI byte arrays through the adapter's
+            send_data() as BitVectors and return the TDO byte array.
+            This is the original shift: path from before send_bytes(). """
+
+        startTime = time.time()
+
+        # BitVectors have the first, lsb bit in index 0, like the
+        # byte arrays, so this is only a copy
+        TMS = BitVector.from_bytes(TMS, numBits)
+        TDI = BitVector.from_bytes(TDI, numBits)
+
+        stopTime  = time.time()
+
+        if(self.opts.verbose >= 2):
+            print('TMS/TDI conversion time: {}'.format(stopTime-startTime))
+
+        TDO = self.jtag.send_data(TMS, TDI)
+
+        return TDO.to_bytes()
+
+    def runCommand(self, cmd):
+        """ Run a command returned by XvcReader.next_command() on the
+            adapter and return the reply to send back to the client. """
+
+        if (cmd[0] == b'getinfo'):
+            ## From https://github.com/Xilinx/XilinxVirtualCable#message-getinfo:
+            #
+            # getinfo
+            #
+            # The primary use of "getinfo:" message is to get the XVC
+            # server version. The server version provides a client a
+            # way of determining the protocol capabilites of the
+            # server.
+            #
+            # Server Returns:
+            #
+            # “xvcServer_v1.0:<xvc_vector_len>\n”
+            # Where:
+            #
+            # <xvc_vector_len> is the max width of the vector that can be shifted
+            #                  into the server (in ASCII)
+            #
+
+            ## The xvc_vector_len that is returned for the
+            ## getinfo: message is not well documented. It
+            ## appears to be the maximum TMS+TDI vector
+            ## length in bytes that is allowed. Keep in
+            ## mind that the returned TDO vector will have
+            ## a maximum of 2x xvc_vector_len. Therefore,
+            ## return the minimum of TMS+TDI or TDO*2
+            XVC_INFO = "xvcServer_v{:.1f}:{}\n".format(XVC_VERSION, self.jtag.xvc_vector_len)
+            if(self.opts.verbose >= 1):
+                print('CMD=getinfo - Response: {}'.format(XVC_INFO))
+
+            return XVC_INFO.encode()
+
+        elif (cmd[0] == b'settck'):
+            ## From https://github.com/Xilinx/XilinxVirtualCable#message-settck:
+            #            
+            # The "settck:" message configures the server TCK
+            # period. When sending JTAG vectors the TCK rate may need
+            # to be varied to accomodate cable and board signal
+            # integrity conditions. This command is used by clients to
+            # adjust the TCK rate in order to slow down or speed up
+            # the shifting of JTAG vectors.
+            #
+            # Syntax:
+            # Client Sends:   "settck:<set period>"
+            # Server Returns: “<current period>”
+            #
+            # Where:
+            #
+            # <set period>      is TCK period specified in ns. This value is a little-endian
+            #                   integer value.
+            # <current period>  is the value set on the server by the settck command. If
+            #                   the server cannot set the value then it will return the
+            #                   current value.
+            #
+
+            set_period = cmd[1]
+
+            ## Ask the JTAG adapter to set the TCK period and
+            #  return the period that it says it can do
+            current_period = self.jtag.set_tck_period(set_period)
+
+            if(self.opts.verbose >= 1):
+                print('CMD=settck:{} - Response={}'.format(set_period, current_period))
+
+            return current_period.to_bytes(4, byteorder='little')
+
+        ## From https://github.com/Xilinx/XilinxVirtualCable#message-shift:
+        #            
+        # The "shift:" message is used to shift JTAG vectors in and out of a
+        # device. The number of bits to shift is specified as the first shift
+        # command parameter followed by the TMS and TDI data vectors. The TMS
+        # and TDI vectors are sized according to the number of bits to shift,
+        # rouneded to the nearest byte. For instance if shifting in 13 bits the
+        # byte vectors will be rounded to 2 bytes. Upon completion of the JTAG
+        # shift operation the server will return a byte sized vector containing
+        # the sampled target TDO value for each shifted TCK clock.
+        # 
+        # Syntax:
+        # Client Sends:   "shift:<num bits><tms vector><tdi vector>"
+        # Server Returns: “<tdo vector>”
+        # 
+        # Where:
+        # 
+        # <num bits>   : is a integer in little-endian mode. This represents the number
+        #                of TCK clk toggles needed to shift the vectors out
+        # <tms vector> : is a byte sized vector with all the TMS shift in bits Bit 0 in
+        #                Byte 0 of this vector is shifted out first. The vector is
+        #                num_bits and rounds up to the nearest byte.
+        # <tdi vector> : is a byte sized vector with all the TDI shift in bits Bit 0 in
+        #                Byte 0 of this vector is shifted out first. The vector is
+        #                num_bits and rounds up to the nearest byte.
+        # <tdo vector> : is a byte sized vector with all the TDO shift out bits Bit 0 in
+        #                Byte 0 of this vector is shifted out first. The vector is
+        #                num_bits and rounds up to the nearest byte.
         #
-        # [@@@ Save time by dealing with bits in original order? Probably not since putting into the natural order of a BitStream()]
-        #@@@#for bn in range(0,len(byteVect)):
-        #@@@#    bs.reverse(start=bn*8,end=(bn*8)+8)
-        #@@@#b3 = bitstring.BitStream('')
-        #@@@#for bn in range(0,len(byteVect)):
-        #@@@#    a = bs[bn*8:(bn+1)*8]
-        #@@@#    a.reverse()
-        #@@@#    b3 += a
-        #@@@#return b3[0:bitLen]
-
-        ## Using built-in commands are way faster than looping in
-        ## Python. Like 100x faster in some case with large vectors.
-        bs.byteswap()
-        bs.reverse()
-
-        # Return truncated BitStream
-        return bs[0:bitLen]
 
-    
-    def handle(self):
+        # Command must be shift: to get this far. TMS and TDI are
+        # in the XVC byte layout with bit 0 of byte 0 as the first
+        # bit.
+        (numBits, TMS, TDI) = cmd[1:]
+        numBytes = (numBits + 7) // 8
 
-        if(self.server.has_client_connected):
-            if(self.server.opts.verbose >= 2):
-                print('Another client attempted to connect - REJECTING!')
-            return
-        self.server.has_client_connected = True
+        if(self.opts.verbose >= 2):
+            print('CMD=shift:')
+            print('shift: Num Bits: {} = Num Bytes: {}:'.format(numBits, numBytes))
+
+        if(self.opts.verbose >= 3):
+            print('TMS bitstream: {}'.format(self.byteVectToBin(TMS, numBits)))
+            print('TDI bitstream: {}'.format(self.byteVectToBin(TDI, numBits)))
+
+        # Fix for bug in Xilinx ISE (TMS of '0b11101', first bit left-most)
+        if(self.jtag.get_state() == self.jtag.EXIT_1_IR and numBits == 5 and (TMS[0] & 0x1f) == 0x17):
+            if(self.opts.verbose >= 2):
+                print('Avoiding "route via Capture-IR"-bug')
+
+            self.shifted = False
+            return b'\x1f'
+
+
+        self.shifted = True
+        startTime = time.time()
+        if(self.opts.bitvector):
+            TDO = self.shiftBitVector(TMS, TDI, numBits)
+        else:
+            TDO = self.jtag.send_bytes(numBits, TMS, TDI)
+        stopTime  = time.time()
 
-        #@@@try:
+        if(self.opts.verbose >= 2):
+            sendTime = stopTime-startTime
+            bps =  numBits/sendTime
+
+            ## Now store in a running list so can compute a running average
+            self.bpsList.append(bps)
+            # Only keep the last ten bps
+            if len(self.bpsList) > 10:
+                self.bpsList.pop(0) # remove the oldest one
+
+            #@@@#print('>>>> bpsList: ', self.bpsList)
+            print('>>> send_data() time: {:.3f} - bps: {:.0f} - Avg. bps: {:.0f} <<<'.format(sendTime, self.bpsList[-1], sum(self.bpsList)/len(self.bpsList)))
+
+            cache = getattr(self.jtag, 'plan_cache', None)
+            if(cache is not None):
+                print('>>> plan cache: {} hits - {} misses - {} plans <<<'.format(cache.hits, cache.misses, len(cache)))
+
+            if(hasattr(self.jtag, 'read_stats')):
+                print('>>> reads: {} polls - {} bulk - {} latency changes <<<'.format(*self.jtag.read_stats()))
+
+        if(self.opts.verbose >= 3):
+            print('TDO bitstream: {}'.format(self.byteVectToBin(TDO, numBits)))
+
+        # Return the TDO vector as response to "shift:" message
+        return TDO
+
+async def read_command(stream, vectorLen):
+    """ asyncio version of XvcReader.next_command() reading from an asyncio
+        StreamReader. The vectors of a shift: are memoryviews of a bytes
+        object, so they stay valid. """
+    try:
+        cmdSnippet = await stream.readexactly(2)
+        data = cmdSnippet + await stream.readexactly(xvc_header_length(cmdSnippet)-2)
+        cmd = xvc_parse_header(data, vectorLen)
+        if (cmd[0] != b'shift'):
+            return cmd
+
+        numBytes = (cmd[1] + 7) // 8
+        vectors = memoryview(await stream.readexactly(2*numBytes))
+        return (b'shift', cmd[1], vectors[0:numBytes], vectors[numBytes:])
+
+    except asyncio.IncompleteReadError:
+        # The client closed the connection
+        return None
+    except ConnectionResetError:
+        print('Connection reset by peer')
+        return None
+
+class XvcSession:
+    """ A client of an adapter shared through XvcScheduler """
+
+    def __init__(self, conn, weight):
+        self.conn = conn
+        self.weight = weight
+        self.closed = False
+
+        # Queued commands as (finish tag, time queued, cmd, future)
+        self.queue = collections.deque()
+        self.finish = 0.0       # finish tag of the last queued command
+
+        # What the client left on the adapter when another client took it
+        self.state = JtagTap.RUN_TEST_IDLE
+        self.ir = None          # IR as (bit count, TDI bits) of its last IR
+                                # scan, RESET_IR or None if unknown
+        self.tck_period = None
+
+        # Queue latency statistics, in seconds
+        self.count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+class XvcScheduler:
+    """
+        Shares one adapter between several clients.
+
+        Commands from all clients are queued and served with weighted fair
+        queueing (self-clocked: the finish tag of a command is the virtual
+        time plus its bit count over the weight of its client). The adapter
+        only goes to another client when its TAP is in Run-Test/Idle or
+        Test-Logic-Reset, which is tracked from the TMS of every shift. Until
+        then, only the client holding the adapter is served.
+
+        Before serving a client again, its TCK period, its last IR scan and
+        the TAP state it left the adapter in are restored.
+    """
+
+    SAFE_STATES = (JtagTap.RUN_TEST_IDLE, JtagTap.TEST_LOGIC_RESET)
+
+    # IR as left by Test-Logic-Reset
+    RESET_IR = JtagTap.RESET_IR
+
+    def __init__(self, jtag, executor, opts):
+        self.jtag = jtag
+        self.executor = executor
+        self.opts = opts
+        self.sessions = []
+        self.holder = None      # session whose TAP state is on the adapter
+        self.vtime = 0.0
+        self.wakeup = asyncio.Event()
+
+        # TAP state and IR as seen from the shifts sent to the adapter
+        self.tap = JtagTap()
+        self.tck_period = None
+
+    def open(self, conn, weight=1.0):
+        session = XvcSession(conn, weight)
+        self.sessions.append(session)
+        return session
+
+    def close(self, session):
+        """ Drop a client. Its queued commands are cancelled and, if it
+            holds the adapter, the TAP is brought back to Run-Test/Idle
+            before another client is served. """
+        session.closed = True
+        for (finish, queued, cmd, future) in session.queue:
+            future.cancel()
+        session.queue.clear()
+        self.sessions.remove(session)
+        self.wakeup.set()
+
+        if(self.opts.verbose >= 1 and session.count):
+            print('Client {}: {} commands, queue latency avg {:.3f} ms max {:.3f} ms'.format(
+                session.conn.peer, session.count, 1e3*session.latency_total/session.count, 1e3*session.latency_max))
+
+    async def submit(self, session, cmd):
+        """ Queue a command of session and return its reply """
+        loop = asyncio.get_running_loop()
+        cost = max(cmd[1], 1) if cmd[0] == b'shift' else 1
+        session.finish = max(self.vtime, session.finish) + cost/session.weight
+        future = loop.create_future()
+        session.queue.append((session.finish, loop.time(), cmd, future))
+        self.wakeup.set()
+        return await future
+
+    def _fail(self, error):
+        """ Fail every queued command with error """
+        for session in self.sessions:
+            for (finish, queued, cmd, future) in session.queue:
+                if not future.done():
+                    future.set_exception(error)
+            session.queue.clear()
+
+    def _pick(self):
+        """ Return the session to serve next, if any """
+        if (self.holder is not None and self.tap.get_state() not in self.SAFE_STATES):
+            # In the middle of a scan, so stay with the holder
+            return self.holder if self.holder.queue else None
+
+        ready = [session for session in self.sessions if session.queue]
+        return min(ready, key=lambda session: session.queue[0][0], default=None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
         while(True):
+            if (self.holder is not None and self.holder.closed):
+                try:
+                    await loop.run_in_executor(self.executor, self._park)
+                except Exception as error:
+                    # The TAP state is lost, so fail what the clients
+                    # queued for it rather than serve them from it
+                    print('Adapter error while parking the TAP: {}'.format(error))
+                    self.holder = None
+                    self._fail(error)
+                    continue
+
+            session = self._pick()
+            if session is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
 
-            ## Read the first two characters to differentiate the commands
-            #print('sread(2)')
-            cmdSnippet = self.sread(2)
-
-            #@@@#print(cmdSnippet)
-
-            ## Handle commands
-            if (cmdSnippet == b''):
-                #@@@#print('Socket Error. Ignoring.')
-                break
-            elif (cmdSnippet == b'ge'):
-                ## From https://github.com/Xilinx/XilinxVirtualCable#message-getinfo:
-                #
-                # getinfo
-                #
-                # The primary use of "getinfo:" message is to get the XVC
-                # server version. The server version provides a client a
-                # way of determining the protocol capabilites of the
-                # server.
-                #
-                # Server Returns:
-                #
-                # “xvcServer_v1.0:<xvc_vector_len>\n”
-                # Where:
-                #
-                # <xvc_vector_len> is the max width of the vector that can be shifted
-                #                  into the server (in ASCII)
-                #
-
-                # Expect this to be "getinfo:", so read the rest of the
-                # command and verify it, just in case
-                data = self.sread(6)
-
-                #@@@#print(data)
-
-                if (data == b'tinfo:'):
-                    ## The xvc_vector_len that is returned for the
-                    ## getinfo: message is not well documented. It
-                    ## appears to be the maximum TMS+TDI vector
-                    ## length in bytes that is allowed. Keep in
-                    ## mind that the returned TDO vector will have
-                    ## a maximum of 2x xvc_vector_len. Therefore,
-                    ## return the minimum of TMS+TDI or TDO*2
-                    XVC_INFO = "xvcServer_v{:.1f}:{}\n".format(XVC_VERSION, self.server.jtag.xvc_vector_len)
-                    #@@@#print(XVC_INFO.encode())
-                    if(self.server.opts.verbose >= 1):
-                        print('CMD=getinfo - Response: {}'.format(XVC_INFO))
-                        
-                    self.request.sendall(XVC_INFO.encode())
-                    continue    ## get next input
-                else:
-                    print('Invalid command "{}". Aborting!'.format(cmdSnippet + data))
-                    break       ## Abort
+            (finish, queued, cmd, future) = session.queue.popleft()
+            self.vtime = finish
 
-            elif (cmdSnippet == b'se'): 
-                ## From https://github.com/Xilinx/XilinxVirtualCable#message-settck:
-                #            
-                # The "settck:" message configures the server TCK
-                # period. When sending JTAG vectors the TCK rate may need
-                # to be varied to accomodate cable and board signal
-                # integrity conditions. This command is used by clients to
-                # adjust the TCK rate in order to slow down or speed up
-                # the shifting of JTAG vectors.
-                #
-                # Syntax:
-                # Client Sends:   "settck:<set period>"
-                # Server Returns: “<current period>”
-                #
-                # Where:
-                #
-                # <set period>      is TCK period specified in ns. This value is a little-endian
-                #                   integer value.
-                # <current period>  is the value set on the server by the settck command. If
-                #                   the server cannot set the value then it will return the
-                #                   current value.
-                #
-
-                # Expect this to be "settck:<set period>", so read the rest of the
-                # command and verify it, just in case
-                data = self.sread(9)
-
-                if (data[0:5] == b'ttck:'):
-                    ## YES, it is settck:<set period>
-                    #
-                    # Now, grab the period argument
-                    set_period = int.from_bytes(data[5:9], byteorder='little')
-
-                    ## Ask the JTAG adapter to set the TCK period and
-                    #  return the period that it says it can do
-                    current_period = self.server.jtag.set_tck_period(set_period)
-
-                    if(self.server.opts.verbose >= 1):
-                        print('CMD={}:{} - Response={}'.format(cmdSnippet+data[0:5], set_period, current_period))
-
-                    self.request.sendall(current_period.to_bytes(4, byteorder='little'))
-                    continue ## get next input
-                else:
-                    print('Invalid command "{}". Aborting!'.format(cmdSnippet + data))
+            latency = loop.time() - queued
+            session.count += 1
+            session.latency_total += latency
+            session.latency_max = max(session.latency_max, latency)
+            if(self.opts.verbose >= 2):
+                print('Client {}: queue latency {:.3f} ms'.format(session.conn.peer, 1e3*latency))
+
+            try:
+                reply = await loop.run_in_executor(self.executor, self._run, session, cmd)
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+
+            if not future.done():
+                future.set_result(reply)
+
+    # The functions below run in the executor of the adapter
+
+    def _run(self, session, cmd):
+        if (cmd[0] != b'getinfo' and self.holder is not session):
+            self._switch(session)
+
+        reply = session.conn.runCommand(cmd)
+
+        if (cmd[0] == b'settck'):
+            session.tck_period = cmd[1]
+            self.tck_period = cmd[1]
+        elif (cmd[0] == b'shift' and session.conn.shifted):
+            self.tap.track_shift(cmd[1], cmd[2], cmd[3])
+            session.state = self.tap.get_state()
+            session.ir = self.tap.live_ir
+
+        return reply
+
+    def _switch(self, session):
+        """ Restore what session left on the adapter. The TAP is in one of
+            SAFE_STATES when this is called. """
+        if (session.tck_period is not None and session.tck_period != self.tck_period):
+            self.jtag.set_tck_period(session.tck_period)
+            self.tck_period = session.tck_period
+
+        tms = ''
+        tdi = ''
+        state = self.tap.get_state()
+        if (session.state != JtagTap.TEST_LOGIC_RESET and session.ir is not None and session.ir != self.tap.live_ir):
+            if (session.ir == self.RESET_IR):
+                # Go through Test-Logic-Reset to reset the IR
+                tms += '11111'
+                state = JtagTap.TEST_LOGIC_RESET
+            else:
+                # Replay the last IR scan of the client, ending in
+                # Run-Test/Idle
+                (length, bits) = session.ir
+                if (state == JtagTap.TEST_LOGIC_RESET):
+                    tms += '0'
+                tms += '1100' + '0'*(length-1) + '1' + '10'
+                tdi += '0'*(len(tms)-length-2) + '{:0{}b}'.format(bits, length)[::-1] + '00'
+                state = JtagTap.RUN_TEST_IDLE
+
+        if (session.state == JtagTap.TEST_LOGIC_RESET and state != JtagTap.TEST_LOGIC_RESET):
+            tms += '11111'
+        elif (session.state == JtagTap.RUN_TEST_IDLE and state == JtagTap.TEST_LOGIC_RESET):
+            tms += '0'
+        tdi += '0'*(len(tms)-len(tdi))
+
+        self._send(tms, tdi)
+        self.holder = session
+
+    def _park(self):
+        """ Bring the TAP back to Run-Test/Idle after its holder left in
+            the middle of a scan """
+        if (self.tap.get_state() not in self.SAFE_STATES):
+            self._send('111110', '000000')
+        self.holder = None
+
+    def _send(self, tms, tdi):
+        """ Shift TMS and TDI given as strings of '0' and '1', first bit
+            left-most """
+        numBits = len(tms)
+        if numBits:
+            numBytes = (numBits + 7) // 8
+            TMS = int(tms[::-1], 2).to_bytes(numBytes, byteorder='little')
+            TDI = int(tdi[::-1], 2).to_bytes(numBytes, byteorder='little')
+            self.jtag.send_bytes(numBits, TMS, TDI)
+            self.tap.track_shift(numBits, TMS, TDI)
+
+class XvcAsyncServer:
+    """
+        XVC server built on asyncio. A single event loop listens on any
+        number of ports, each one serving an adapter. The blocking adapter
+        calls run in a single thread executor per adapter, so different
+        adapters work in parallel while the calls to one adapter stay in
+        order.
+
+        An adapter serves one client at a time and other clients are
+        rejected, unless opts.share is set. Then all clients of an adapter
+        go through its XvcScheduler. A connection releases its adapter as
+        soon as its handler exits, for whatever reason, and TCP keepalive
+        is enabled so that dead peers are eventually noticed.
+    """
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.listeners = []     # (host, port, jtag, weight)
+        self.executors = {}     # jtag -> executor running its calls
+        self.schedulers = {}    # jtag -> XvcScheduler when sharing
+        self.owners = {}        # jtag -> XvcConnection using it
+        self.servers = []
+
+    def add_listener(self, host, port, jtag, weight=1.0):
+        """ Serve the adapter jtag on host:port. When sharing the adapter,
+            weight is the share of its clients connecting to this port. """
+        self.listeners.append((host, port, jtag, weight))
+        if jtag not in self.executors:
+            self.executors[jtag] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            if(self.opts.share):
+                self.schedulers[jtag] = XvcScheduler(jtag, self.executors[jtag], self.opts)
+
+    async def serve_forever(self):
+        for (host, port, jtag, weight) in self.listeners:
+            server = await asyncio.start_server(functools.partial(self.handle_client, jtag, weight), host, port, reuse_address=True)
+            self.servers.append(server)
+
+        tasks = [asyncio.ensure_future(server.serve_forever()) for server in self.servers]
+        tasks += [asyncio.ensure_future(scheduler.run()) for scheduler in self.schedulers.values()]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for server in self.servers:
+                server.close()
+            for executor in self.executors.values():
+                executor.shutdown(wait=False)
+
+    async def handle_client(self, jtag, weight, stream, writer):
+        conn = XvcConnection(jtag, self.opts, writer.get_extra_info('peername'))
+        scheduler = self.schedulers.get(jtag)
+
+        if (scheduler is not None):
+            session = scheduler.open(conn, weight)
+        elif (self.owners.get(jtag) is not None):
+            if(self.opts.verbose >= 2):
+                print('Another client attempted to connect - REJECTING!')
+            writer.close()
+            return
+        else:
+            self.owners[jtag] = conn
+
+        try:
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            loop = asyncio.get_running_loop()
+            executor = self.executors[jtag]
+            while(True):
+                try:
+                    cmd = await read_command(stream, jtag.xvc_vector_len)
+                except XvcProtocolError as error:
+                    print('{}. Aborting!'.format(error))
                     break       ## Abort
 
-            elif (cmdSnippet == b'sh'): 
-                ## From https://github.com/Xilinx/XilinxVirtualCable#message-shift:
-                #            
-                # The "shift:" message is used to shift JTAG vectors in and out of a
-                # device. The number of bits to shift is specified as the first shift
-                # command parameter followed by the TMS and TDI data vectors. The TMS
-                # and TDI vectors are sized according to the number of bits to shift,
-                # rouneded to the nearest byte. For instance if shifting in 13 bits the
-                # byte vectors will be rounded to 2 bytes. Upon completion of the JTAG
-                # shift operation the server will return a byte sized vector containing
-                # the sampled target TDO value for each shifted TCK clock.
-                # 
-                # Syntax:
-                # Client Sends:   "shift:<num bits><tms vector><tdi vector>"
-                # Server Returns: “<tdo vector>”
-                # 
-                # Where:
-                # 
-                # <num bits>   : is a integer in little-endian mode. This represents the number
-                #                of TCK clk toggles needed to shift the vectors out
-                # <tms vector> : is a byte sized vector with all the TMS shift in bits Bit 0 in
-                #                Byte 0 of this vector is shifted out first. The vector is
-                #                num_bits and rounds up to the nearest byte.
-                # <tdi vector> : is a byte sized vector with all the TDI shift in bits Bit 0 in
-                #                Byte 0 of this vector is shifted out first. The vector is
-                #                num_bits and rounds up to the nearest byte.
-                # <tdo vector> : is a byte sized vector with all the TDO shift out bits Bit 0 in
-                #                Byte 0 of this vector is shifted out first. The vector is
-                #                num_bits and rounds up to the nearest byte.
-                #
-
-                # Expect this to be "shift:<num bits><tms vector><tdi vector>", so read the rest of the
-                # command and verify it, just in case
-                data = self.sread(4)
-
-                if (data == b'ift:'):
-                    ## YES, it is "shift:"
-                    #
-                    # However, since all of the real processing
-                    # happens for this command, handle it below. Here,
-                    # simple output a verbose message and continue
-                    # below
-
-                    if(self.server.opts.verbose >= 2):
-                        print('CMD={}:'.format(cmdSnippet+data))
+                if (cmd is None):
+                    break
 
-                else:
-                    print('Invalid command "{}". Aborting!'.format(cmdSnippet + data))
+                try:
+                    if (scheduler is not None):
+                        reply = await scheduler.submit(session, cmd)
+                    else:
+                        reply = await loop.run_in_executor(executor, conn.runCommand, cmd)
+                except Exception as error:
+                    print('Adapter error: {}. Aborting!'.format(error))
                     break       ## Abort
+                writer.write(reply)
+                await writer.drain()
+
+        except ConnectionError:
+            print('Connection to {} lost'.format(conn.peer))
 
+        finally:
+            # Release the adapter for the next client
+            if (scheduler is not None):
+                scheduler.close(session)
             else:
-                print('Invalid command snippet "{}". Aborting!'.format(cmdSnippet))
-                break       ## Abort
+                del self.owners[jtag]
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+class XvcWorker:
+    """ One cable of the supervisor: its config section and its process. """
+
+    def __init__(self, name, adapter, url, port, args):
+        self.name = name
+        self.adapter = adapter
+        self.url = url
+        self.port = port
+        self.args = args
+        self.proc = None
+        self.started = 0
+        self.backoff = 1
+        self.restart_at = 0
+        self.restarts = 0
+
+
+class XvcSupervisor:
+    """
+        Run one xvcd_server.py worker process per cable listed in a config
+        file, so the bit processing of each board runs on its own core,
+        and restart the workers that exit. Each section of the file is a
+        cable:
+
+            [board-a]
+            adapter = ft2232h
+            url = ftdi://ftdi:2232h:FT123456/1
+            port = 2542
+
+            [board-b]
+            adapter = ft4232h
+            serial = FT654321
+            port = 2543
+            options = --asyncio --share
+
+        'serial' builds the URL from the adapter FTDI_URL, 'interface' can
+        pick another port of the chip and 'options' are extra command line
+        options for this worker only.
+    """
+
+    def __init__(self, config, host, opts):
+        self.host = host
+        self.opts = opts
+        self.workers = []
+
+        parser = configparser.ConfigParser()
+        if(not parser.read(config)):
+            raise ValueError('cannot read {}'.format(config))
+
+        ports = set()
+        for name in parser.sections():
+            section = parser[name]
+            adapter = section.get('adapter')
+            if(adapter is None or 'port' not in section):
+                raise ValueError('[{}] needs an adapter and a port'.format(name))
+            port = section.getint('port')
+            if(port in ports):
+                raise ValueError('[{}] port {} is already used'.format(name, port))
+            ports.add(port)
+
+            url = section.get('url')
+            if(url is None and 'serial' in section):
+                url = self.serial_url(adapter, section['serial'], section.get('interface'))
+
+            self.workers.append(XvcWorker(name, adapter, url, port, shlex.split(section.get('options', ''))))
+
+        if(not self.workers):
+            raise ValueError('{} does not list any cable'.format(config))
+
+    @staticmethod
+    def serial_url(adapter, serial, interface=None):
+        """ Insert serial into the default FTDI_URL of an adapter module. """
+        mod = importlib.import_module('adapters.' + adapter)
+        base = getattr(mod.jtag_adapter, 'FTDI_URL', None)
+        if(base is None):
+            raise ValueError('adapter {} has no FTDI URL, use url ='.format(adapter))
+        (base, default_interface) = base.rsplit('/', 1)
+        return '{}:{}/{}'.format(base, serial, interface or default_interface)
+
+    def command(self, worker):
+        """ Command line of the worker process of a cable. """
+        cmd = [sys.executable, os.path.abspath(__file__), worker.adapter, '--port', str(worker.port), '--worker']
+        if(self.opts.local):
+            cmd.append('--local')
+        if(self.opts.verbose):
+            cmd.append('-' + 'v' * self.opts.verbose)
+        for flag in ('debug', 'pipeline', 'bitvector', 'no_batch', 'no_write_only', 'write_only_user', 'tms_write_only', 'stream'):
+            if(getattr(self.opts, flag)):
+                cmd.append('--' + flag.replace('_', '-'))
+        if(self.opts.plan_cache is not None):
+            cmd += ['--plan-cache', str(self.opts.plan_cache)]
+        return cmd + worker.args
+
+    def start(self, worker):
+        env = dict(os.environ)
+        if(worker.url is not None):
+            env['FTDI_DEVICE'] = worker.url
+        worker.proc = subprocess.Popen(self.command(worker), env=env)
+        worker.started = time.monotonic()
+        print('[{}] Started worker {} on port {}'.format(worker.name, worker.proc.pid, worker.port))
+
+    def poll(self):
+        """ Restart the workers that exited, with a growing delay. """
+        now = time.monotonic()
+        for worker in self.workers:
+            if(worker.proc is None):
+                if(now >= worker.restart_at):
+                    worker.restarts += 1
+                    self.start(worker)
+                continue
 
-            ## Command must be shift: to get this far, but have not read the argument yet - still could be invalid
-            #
-            # Read the bit length parameter
-            numBitsArg = self.sread(4)
-            if (not numBitsArg):
-                print('Reading "shift:" bit length parameter failed - Aborting!')
-                break ## An error occurred - simply abort here
+            code = worker.proc.poll()
+            if(code is None):
+                continue
 
-            numBits = int.from_bytes(numBitsArg, byteorder='little')
-            numBytes = (numBits + 7) // 8
+            if(now - worker.started >= SUPERVISOR_STABLE_TIME):
+                worker.backoff = 1
+            print('[{}] Worker exited with code {}, restarting in {} s'.format(worker.name, code, worker.backoff))
+            worker.proc = None
+            worker.restart_at = now + worker.backoff
+            worker.backoff = min(2 * worker.backoff, SUPERVISOR_MAX_BACKOFF)
+
+    def stop(self):
+        # SIGINT lets the workers run their atexit cleanup and close the cable
+        for worker in self.workers:
+            if(worker.proc is not None and worker.proc.poll() is None):
+                if(os.name == 'nt'):
+                    worker.proc.terminate()
+                else:
+                    worker.proc.send_signal(signal.SIGINT)
+        for worker in self.workers:
+            if(worker.proc is None):
+                continue
+            try:
+                worker.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                worker.proc.kill()
+                worker.proc.wait()
+
+    @staticmethod
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    def serve_forever(self):
+        print_connection_strings(self.host, [(worker.name, worker.port) for worker in self.workers])
+
+        # Being stopped with SIGTERM, as by systemd or kill, or SIGHUP
+        # takes the same way out as Ctrl-C, so the workers and their
+        # cables are not left behind
+        for name in ('SIGTERM', 'SIGHUP'):
+            if(hasattr(signal, name)):
+                signal.signal(getattr(signal, name), self.interrupt)
+
+        for worker in self.workers:
+            self.start(worker)
+        try:
+            while True:
+                time.sleep(0.5)
+                self.poll()
+        finally:
+            self.stop()
 
-            #@@@# Should we check buffer size like in xvcServer.c? Do we care in Python?
 
-            if(self.server.opts.verbose >= 2):
-                print('shift: Num Bits: {} = Num Bytes: {}:'.format(numBits, numBytes))
+class xvcd_server(socketserver.BaseRequestHandler):
 
-            # Read the TMS & TDI vectors
-            vectArg = self.sread(numBytes * 2)
-            if (not vectArg):
-                print('Reading "shift:" TMS & TDI vector parameters failed - ABORTING!')
-                break ## An error occurred - simply abort here
+    def handlePipelined(self, reader, conn):
+        """ Serve the connection with the network and the adapter work in
+            separate stages connected by bounded queues:
+
+              - this thread reads, decodes and validates the commands,
+              - an adapter thread runs them with conn.runCommand(),
+              - a sender thread sends the replies back.
+
+            The next command is decoded and the previous reply is sent
+            while the adapter is busy with the current one. The queues are
+            FIFOs and every command gets exactly one reply, so the replies
+            go out in the order of the commands. """
+
+        commands = queue.Queue(PIPELINE_DEPTH)
+        replies = queue.Queue(PIPELINE_DEPTH)
+
+        def adapterStage():
+            failed = False
+            while(True):
+                cmd = commands.get()
+                if (cmd is None):
+                    break
+                if failed:
+                    continue    ## drain until the network stage stops
+                try:
+                    replies.put(conn.runCommand(cmd))
+                except Exception as error:
+                    print('Adapter error: {}. Aborting!'.format(error))
+                    failed = True
+                    # Unblock the network stage waiting on the client
+                    try:
+                        self.request.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            replies.put(None)
+
+        def senderStage():
+            failed = False
+            done = False
+            while not done:
+                # Gather whatever replies are ready into a single send
+                batch = [replies.get()]
+                while batch[-1] is not None and not replies.empty():
+                    batch.append(replies.get())
+                if batch[-1] is None:
+                    batch.pop()
+                    done = True
+                if failed:
+                    continue    ## drain until the adapter stage stops
+                try:
+                    send_replies(self.request, batch)
+                except OSError:
+                    failed = True
+
+        threads = [threading.Thread(target=adapterStage, name='xvcd-adapter'),
+                   threading.Thread(target=senderStage, name='xvcd-sender')]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while(True):
+                try:
+                    cmd = reader.next_command()
+                except XvcProtocolError as error:
+                    print('{}. Aborting!'.format(error))
+                    break       ## Abort
 
-            startTime = time.time()
+                if (cmd is None):
+                    break
 
-            # Split args in TMS data and TDI data
-            #@@@#vectArg = [vectArg[0:numBytes], vectArg[numBytes:2*numBytes]]
-            #@@@#TMS = self.byteVectToBitStream(vectArg[0], numBits)
-            #@@@#TDI = self.byteVectToBitStream(vectArg[1], numBits)
+                if (cmd[0] == b'shift'):
+                    # The vectors are only valid until the next
+                    # next_command(), so copy them for the adapter stage
+                    cmd = (cmd[0], cmd[1], bytes(cmd[2]), bytes(cmd[3]))
 
-            # Split args in TMS data and TDI data, creating
-            # BitStream()s that have the first, lsb bit in index 0
-            # (ie. left-most)
-            TMS = self.byteVectToBitStream(vectArg[0:numBytes], numBits)
-            TDI = self.byteVectToBitStream(vectArg[numBytes:2*numBytes], numBits)
+                commands.put(cmd)
+        finally:
+            commands.put(None)
+            for thread in threads:
+                thread.join()
 
-            stopTime  = time.time()
+    def handle(self):
 
+        if(self.server.has_client_connected):
             if(self.server.opts.verbose >= 2):
-                print('TMS/TDI conversion time: {}'.format(stopTime-startTime))
-
-            if(self.server.opts.verbose >= 3):
-                print('TMS bitstream: {}'.format(TMS.bin))
-                print('TDI bitstream: {}'.format(TDI.bin))
-
-            # Fix for bug in Xilinx ISE
-            if(self.server.jtag.get_state() == self.server.jtag.EXIT_1_IR and TMS == bitstring.BitStream('0b11101')):
-                if(self.server.opts.verbose >= 2):
-                    print('Avoiding "route via Capture-IR"-bug')
+                print('Another client attempted to connect - REJECTING!')
+            return
+        self.server.has_client_connected = True
 
-                self.request.sendall(b'\x1f')
-                continue
+        try:
+            conn = XvcConnection(self.server.jtag, self.server.opts, self.client_address)
 
+            reader = XvcReader(self.request, self.server.jtag.xvc_vector_len)
 
-            startTime = time.time()
-            TDO = self.server.jtag.send_data(TMS, TDI)
-            stopTime  = time.time()
+            if(self.server.opts.pipeline):
+                self.handlePipelined(reader, conn)
+            else:
+                while(True):
 
-            if(self.server.opts.verbose >= 2):
-                sendTime = stopTime-startTime
-                bps =  numBits/sendTime
-
-                ## Now store in a running list so can compute a running average
-                if 'bpsList' in vars():
-                    bpsList.append(bps)
-                    # Only keep the last ten bps
-                    if len(bpsList) > 10:
-                        bpsList.pop(0) # remove the oldest one
-                else:
-                    # Create the list since it doe snot yet exist
-                    bpsList = [bps]
+                    ## Read the next complete command
+                    try:
+                        cmd = reader.next_command()
+                    except XvcProtocolError as error:
+                        print('{}. Aborting!'.format(error))
+                        break       ## Abort
 
-                #@@@#print('>>>> bpsList: ', bpsList)
-                print('>>> send_data() time: {:.3f} - bps: {:.0f} - Avg. bps: {:.0f} <<<'.format(sendTime, bps, sum(bpsList)/len(bpsList)))
+                    if (cmd is None):
+                        #@@@#print('Socket Error. Ignoring.')
+                        break
 
-            if(self.server.opts.verbose >= 3):
-                print('TDO bitstream: {}'.format(TDO.bin))
+                    reader.reply(conn.runCommand(cmd))
 
-            # Add padding
-            TDO += bitstring.BitStream((8 - TDO.len) % 8)
-            TDO.reverse()
-            TDO.byteswap()
+                # Send whatever replies are still waiting
+                try:
+                    reader.flush()
+                except OSError:
+                    pass
 
-            # Return the TDO vector as response to "shift:" message
-            # and continue to top of loop.
-            self.request.sendall(TDO.bytes)
+        finally:
+            # Abort the server
+            self.finish()
 
-        #@@@except KeyboardInterrupt:
-        #    print("\nExiting Xilinx Virtual Cable Driver Server\n")            
-        #    pass
-        
-        # Abort the server
-        self.finish()
-        
-        # Allow a new client to connect
-        self.server.has_client_connected = False
+            # Allow a new client to connect, even if handling the
+            # client raised
+            self.server.has_client_connected = False
 
 
 def get_ip():
@@ -399,19 +1074,83 @@ def get_ip():
     finally:
         s.close()
     return IP
+
+def print_connection_strings(host, ports):
+    """ Print a helpful message indicating how to use the XVCD server.
+        ports is a list of (name, port), name may be None. """
+    print("Starting XVCD server. In the relevant tool, use the following cable plugin command:\n")
+    print("If ISE iMPACT, Open Cable Plug-in with:")
+    for (name, port) in ports:
+        print(("    xilinx_xvc host={0}:{1} disableversioncheck=true").format(host,port) + ("    # " + name if name else ""))
+    print("\nIf Vivado, in the Tcl Console:")
+    print( "    connect_hw_server")
+    for (name, port) in ports:
+        print(("    open_hw_target -xvc_url {0}:{1}").format(host,port) + ("    # " + name if name else ""))
+    print("\nYou should be able to use the relevant tool normally.\n")
                         
 if(__name__ == '__main__'):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--reset', action='store_true', help='Pulses the PROGRAM_B pin before starting server')
-    parser.add_argument('adapter', help='Select which JTAG adapter to use')
-    parser.add_argument('--port', default=2542, type=int)
+    parser.add_argument('adapter', nargs='?', help='Select which JTAG adapter to use')
+    parser.add_argument('--port', action='append', type=int, help='TCP port to listen on (default: 2542). Can be given several times with --asyncio')
     parser.add_argument('--verbose', '-v', action='count', default=0, help='Increase verbosity level')
     parser.add_argument('--debug', '-d', action='store_true', help='Enable debug output')
     parser.add_argument('--local', '-l', action='store_true', help='Use to bind to local HOST typically when running on same computer as Xilinx tools')
+    parser.add_argument('--asyncio', action='store_true', help='Use the asyncio server, which can listen on several ports')
+    parser.add_argument('--share', action='store_true', help='With --asyncio, let several clients share the adapter instead of rejecting all but the first')
+    parser.add_argument('--weight', action='append', default=[], metavar='PORT=WEIGHT', help='With --share, relative share of the adapter for clients of PORT (default: 1)')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap reading commands and sending replies with the adapter USB transfers')
+    parser.add_argument('--bitvector', action='store_true', help='Convert shift: vectors to BitVectors and use the adapter send_data() instead of send_bytes()')
+    parser.add_argument('--no-batch', action='store_true', help='Send the MPSSE commands of a shift one op at a time instead of as a single batch')
+    parser.add_argument('--no-write-only', action='store_true', help='Read back TDO of every Shift-DR scan, even for CFG_IN')
+    parser.add_argument('--write-only-user', action='store_true', help='Also skip reading back TDO of USER1-4 Shift-DR scans, for SPI flash loaders that do not check it')
+    parser.add_argument('--tms-write-only', action='store_true', help='Do not read back TDO of TMS commands that clock no bit in Shift-DR/IR (MPSSE adapters)')
+    parser.add_argument('--stream', action='store_true', help='Read back TDO in its own thread while the next commands are written (MPSSE adapters)')
+    parser.add_argument('--plan-cache', type=int, metavar='SIZE', help='Number of compiled shifts kept for shifts that repeat, as when polling (default: 256, 0 to disable)')
+    parser.add_argument('--autotune', action='store_true', help='Find the fastest settings the JTAG chain still works with, save them in the tuning profile of the board and exit (MPSSE adapters)')
+    parser.add_argument('--supervise', metavar='CONFIG', help='Run one worker process per cable listed in CONFIG and restart them when they exit')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
 
     opts = parser.parse_args()
 
+    if(opts.local):
+        #@@@#HOST = 'localhost'
+        HOST = '127.0.0.1'
+    else:
+        HOST = get_ip()
+
+    if(opts.supervise):
+        if(opts.adapter or opts.port or opts.reset or opts.autotune):
+            parser.error('--supervise takes the adapters and ports from its config file')
+        try:
+            supervisor = XvcSupervisor(opts.supervise, HOST, opts)
+        except (ValueError, ImportError, configparser.Error) as e:
+            parser.error(str(e))
+        try:
+            supervisor.serve_forever()
+        except KeyboardInterrupt:
+            print("\nExiting Xilinx Virtual Cable Driver Server\n")
+            sys.exit(0)
+
+    if(opts.adapter is None):
+        parser.error('an adapter is needed unless --supervise is given')
+
+    ports = opts.port or [2542]
+    if(len(ports) > 1 and not opts.asyncio):
+        parser.error('listening on several ports needs --asyncio')
+    if(opts.share and not opts.asyncio):
+        parser.error('--share needs --asyncio')
+
+    try:
+        weights = {int(port): float(weight) for (port, weight) in (arg.split('=') for arg in opts.weight)}
+    except ValueError:
+        parser.error('--weight must be PORT=WEIGHT')
+    if(any(weight <= 0 for weight in weights.values())):
+        parser.error('--weight must be positive')
+    if(opts.plan_cache is not None and opts.plan_cache < 0):
+        parser.error('--plan-cache must not be negative')
+
     # Load JTAG adapter
     try:
         mod = importlib.import_module('adapters.' + opts.adapter)
@@ -422,26 +1161,62 @@ if(__name__ == '__main__'):
     jtag = mod.jtag_adapter(opts.debug)
     jtag.set_verbosity(opts.verbose)
 
+    if(opts.autotune):
+        if(not hasattr(jtag, 'tune_candidates')):
+            parser.error('--autotune needs an MPSSE adapter')
+        try:
+            profile = Autotuner(jtag).tune()
+        except TuneError as e:
+            print('Autotune failed: {}'.format(e))
+            sys.exit(1)
+        print('Tuned settings: {}'.format(profile))
+        key = save_profile(jtag, profile)
+        if(key is None):
+            print('Not saved: the board has no USB serial number or XVCD_PROFILES is empty')
+        else:
+            print('Saved as the profile of {} in {}'.format(key, profiles_path()))
+        sys.exit(0)
+
+    if(opts.no_batch):
+        jtag.batch = False
+
+    if(opts.tms_write_only):
+        jtag.tms_write_only = True
+
+    if(opts.plan_cache is not None and hasattr(jtag, 'plan_cache')):
+        jtag.plan_cache.size = opts.plan_cache
+
+    if(opts.stream):
+        if(not hasattr(jtag, 'set_streaming')):
+            parser.error('--stream needs an MPSSE adapter')
+        jtag.set_streaming(True)
+
+    if(opts.no_write_only):
+        jtag.ir_policies.clear()
+    elif(opts.write_only_user):
+        jtag.ir_policies.update((ir, jtag.WRITE_ONLY) for ir in jtag.USER_IRS)
+
     if(opts.reset):
         jtag.reset()
 
-    if(opts.local):
-        #@@@#HOST = 'localhost'
-        HOST = '127.0.0.1'
-    else:
-        HOST = get_ip()
-        
     #Print a helpful message indicating how to use the XVCD server.
-    print("Starting XVCD server. In the relevant tool, use the following cable plugin command:\n")
-    print("If ISE iMPACT, Open Cable Plug-in with:")
-    print(("    xilinx_xvc host={0}:{1} disableversioncheck=true\n").format(HOST,opts.port))
-    print("If Vivado, in the Tcl Console:")
-    print( "    connect_hw_server")
-    print(("    open_hw_target -xvc_url {0}:{1}\n").format(HOST,opts.port))
-    print("You should be able to use the relevant tool normally.\n")
+    #Workers leave it to their supervisor.
+    if(not opts.worker):
+        print_connection_strings(HOST, [(None, port) for port in ports])
+
+    if(opts.asyncio):
+        server = XvcAsyncServer(opts)
+        for port in ports:
+            server.add_listener(HOST, port, jtag, weights.get(port, 1.0))
+
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            print("\nExiting Xilinx Virtual Cable Driver Server\n")
+            sys.exit(0)
 
     socketserver.TCPServer.allow_reuse_address = True
-    server = socketserver.TCPServer((HOST, opts.port), xvcd_server)
+    server = socketserver.TCPServer((HOST, ports[0]), xvcd_server)
     server.has_client_connected = False     # Single client for now, deny other requests
     server.opts = opts     ## pass the command line options to the server
     server.jtag = jtag     ## pass to the server which adapter has been selected